@@ -0,0 +1,123 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import hashlib
+import math
+import threading
+import time
+
+from shapely import wkt
+
+
+def make_tileclusters(count: int, cell: float = 1000.0, size: float = 600.0) -> dict[str, str]:
+    """
+    WKT of `count` tileclusters (`N1-E1`, `N1-E2`...), squares of `size` laid out
+    on a square lattice of `cell` metres from the origin.
+    """
+    columns = math.ceil(math.sqrt(count))
+    geometries = {}
+    for i in range(count):
+        x, y = (i % columns) * cell, (i // columns) * cell
+        geometries[f"N1-E{i + 1}"] = f"POLYGON(({x} {y}, {x + size} {y}, {x + size} {y + size}, {x} {y + size}, {x} {y}))"
+    return geometries
+
+
+class FakeCursor:
+    def __init__(self, conn: "FakeConnection"):
+        self.conn = conn
+        self.rows: list[tuple] = []
+
+    def __enter__(self) -> "FakeCursor":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def rowcount(self) -> int:
+        return len(self.rows)
+
+    def close(self) -> None:
+        pass
+
+    def fetchall(self) -> list[tuple]:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self) -> tuple | None:
+        return self.rows.pop(0) if self.rows else None
+
+    def execute(self, query: str, vars=None) -> None:
+        self.conn.round_trip()
+        self.rows = self.conn.answer(query, vars)
+
+
+class FakeConnection:
+    """
+    Stand-in for the psycopg2 connection to the Giswater database, answering the queries
+    of the seeding service from `geometries` (tilecluster_id: WKT): the tilecluster view,
+    `gw_fct_setselectors`, `gw_fct_getfeatureboundary` and the materialized view refreshes.
+
+    Every statement costs `round_trip` seconds, a view refresh `view_refresh` more.
+    """
+    def __init__(self, geometries: dict[str, str], round_trip: float = 0.0005, view_refresh: float = 0.005):
+        self.geometries = geometries
+        self.round_trip_seconds = round_trip
+        self.view_refresh_seconds = view_refresh
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def round_trip(self) -> None:
+        with self.lock:
+            self.round_trips += 1
+        if self.round_trip_seconds:
+            time.sleep(self.round_trip_seconds)
+
+    def _boundary(self, tilecluster_id: str) -> dict:
+        # A quarter of the tilecluster changed since the last seed
+        minx, miny, maxx, maxy = wkt.loads(self.geometries[tilecluster_id]).bounds
+        midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+        return {"type": "Polygon", "coordinates": [[[minx, miny], [midx, miny], [midx, midy], [minx, midy], [minx, miny]]]}
+
+    def answer(self, query: str, vars) -> list[tuple]:
+        if "REFRESH MATERIALIZED VIEW" in query:
+            time.sleep(self.view_refresh_seconds)
+            return []
+        if "gw_fct_setselectors" in query:
+            return [(n, {"status": "Accepted"}) for n, _ in enumerate(vars[0], start=1)]
+        if "gw_fct_getfeatureboundary" in query:
+            if "unnest" not in query:
+                return [(self._boundary(next(iter(self.geometries))),)]
+            # One (ids, inputs) pair of parameters per schema
+            return [
+                (tilecluster_id, self._boundary(tilecluster_id))
+                for ids in vars[::2] for tilecluster_id in ids
+            ]
+        if "WITH RECURSIVE deps" in query:
+            return []
+        if "WITH ORDINALITY AS v(name, n)" in query:
+            return [(name, 1000 + n, True) for n, name in enumerate(vars[0])]
+        if "md5(ST_AsBinary(geom))" in query:
+            return [(tilecluster_id, hashlib.md5(geometry.encode()).hexdigest()) for tilecluster_id, geometry in sorted(self.geometries.items())]
+        if "ST_ASTEXT(geom)" in query:
+            return [(tilecluster_id, self.geometries[tilecluster_id]) for tilecluster_id in vars[0] if tilecluster_id in self.geometries]
+        if "SELECT tilecluster_id FROM" in query:
+            return [(tilecluster_id,) for tilecluster_id in sorted(self.geometries)]
+        if query.strip() == "SELECT 1":
+            return [(1,)]
+        return []
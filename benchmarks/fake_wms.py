@@ -0,0 +1,75 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import io
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, ImageDraw
+
+
+class FakeWMS:
+    """
+    Local WMS answering every GetMap with a PNG of the requested size after `latency`
+    seconds (plus up to `jitter` more), so seeding can be measured without a QGIS server.
+
+    The images have a few shapes drawn on them, MapProxy stores them as regular tiles
+    instead of linking them to a single colour tile.
+    """
+    def __init__(self, latency: float = 0.02, jitter: float = 0.0, port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        wms = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                wms.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/wms"
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        params = {key.lower(): values[0] for key, values in parse_qs(urlparse(request.path).query).items()}
+        width, height = int(params.get("width", 256)), int(params.get("height", 256))
+        image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        for i in range(0, max(width, height), 64):
+            draw.line((i, 0, 0, i), fill=(30, 90, 200, 255), width=3)
+            draw.ellipse((i, i, i + 24, i + 24), fill=(200, 40, 40, 255))
+        body = io.BytesIO()
+        image.save(body, "PNG")
+
+        request.send_response(200)
+        request.send_header("Content-Type", "image/png")
+        request.send_header("Content-Length", str(body.tell()))
+        request.end_headers()
+        request.wfile.write(body.getvalue())
+
+    def start(self) -> "FakeWMS":
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-wms", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,349 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+# The service modules live at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The service modules read their folders from the environment when imported, the
+# benchmark keeps everything it writes in its own work folder
+WORK_DIR = tempfile.mkdtemp(prefix="mapproxy-service-benchmark-")
+os.environ["MAPPROXY_CONFIG_PATH"] = os.path.join(WORK_DIR, "service")
+os.environ["MAPPROXY_TILES_PATH"] = os.path.join(WORK_DIR, "tiles")
+os.environ["SEED_LOG_PATH"] = os.path.join(WORK_DIR, "logs")
+
+from flask import Flask
+from mapproxy.multiapp import make_wsgi_app
+from shapely import wkt
+from werkzeug.test import EnvironBuilder
+
+import metrics
+from dispatcher import PrefixDispatcher
+from make_conf import make_config
+from seeding import seed
+from tile_cache import TileCache, TileConfigs, TileSettings
+from tile_metrics import TileMetrics
+from tile_validators import TileValidators
+
+from fake_db import FakeConnection, make_tileclusters
+from fake_wms import FakeWMS
+
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+
+# Grid fitting the tileclusters of the largest size, see `make_tileclusters`
+GRID = {"srs": "EPSG:25831", "origin": "nw", "bbox": [0, 0, 131072, 131072]}
+RES = [512, 256, 128, 64, 32, 16, 8, 4, 2, 1]
+TILE_SIZE = 256
+MATERIALIZED_VIEWS = ["bench.v_edit_arc", "bench.v_edit_node"]
+
+# Metrics where more is better, the others are durations
+HIGHER_IS_BETTER = {"requests_per_second"}
+
+
+def benchmark_config(wms_url: str, seed_concurrency: int) -> dict:
+    return {
+        "tileclusters_table": "bench.v_tilecluster",
+        "data_db_schema": "bench",
+        "tiling_db_schema": "bench_tiling",
+        "db_url_remote": "postgresql://benchmark@localhost/benchmark",
+        "materialized_views": MATERIALIZED_VIEWS,
+        # The fake connection can not be pooled, views are refreshed on it
+        "view_refresh_concurrency": 1,
+        "selectors": [{"N": True}],
+        "crs": GRID["srs"],
+        "grid": GRID,
+        "res": RES,
+        "sources": {"inventory_source": {"url": wms_url, "layers": "inventory"}},
+        "seed_max_concurrency": seed_concurrency,
+        "seed_initial_concurrency": seed_concurrency,
+    }
+
+
+@contextlib.contextmanager
+def quiet(log_file) -> Iterator[None]:
+    # The service prints a line per tilecluster, it goes to the log of the run instead
+    with contextlib.redirect_stdout(log_file):
+        yield
+
+def timed(func: Callable[[], None], repeat: int = 1, before: Callable[[], None] | None = None) -> float:
+    """Best time of `repeat` runs of `func`, `before` (not timed) runs before each of them"""
+    best = math.inf
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+class Run:
+    def __init__(self, args: argparse.Namespace, work_dir: str, log_file):
+        self.args = args
+        self.work_dir = work_dir
+        self.log_file = log_file
+        self.results: list[dict] = []
+        self.wms = FakeWMS(args.wms_latency, args.wms_jitter).start()
+        self.config = benchmark_config(self.wms.url, args.seed_concurrency)
+        self.generated_config_path = os.path.join(work_dir, "config-out")
+        self.temp_folder = os.path.join(work_dir, "temp")
+        self.tiles_dir = os.environ["MAPPROXY_TILES_PATH"]
+        Path(self.temp_folder).mkdir(parents=True, exist_ok=True)
+        Path(os.environ["SEED_LOG_PATH"]).mkdir(parents=True, exist_ok=True)
+        metrics.configure(os.path.join(self.temp_folder, "metrics"))
+
+    def connection(self, geometries: dict[str, str]) -> FakeConnection:
+        return FakeConnection(geometries, self.args.db_round_trip, self.args.view_refresh)
+
+    def geom_folder(self, config_name: str) -> str:
+        return os.path.join(self.generated_config_path, f"{config_name}_geom")
+
+    def record(self, benchmark: str, size: int | None, **values) -> None:
+        result = {"benchmark": benchmark, "size": size, **values}
+        self.results.append(result)
+        print(json.dumps(result), flush=True)
+
+    def make_config(self, size: int, geometries: dict[str, str]) -> None:
+        config_name = f"bench_{size}"
+        conn = self.connection(geometries)
+        with quiet(self.log_file):
+            seconds = timed(lambda: make_config(
+                self.config, conn, self.generated_config_path, self.geom_folder(config_name), config_name,
+            ), self.args.repeat)
+        self.record("make_config", size, seconds=round(seconds, 4), db_round_trips=conn.round_trips // self.args.repeat)
+
+    def refresh_tileclusters(self, size: int, geometries: dict[str, str]) -> None:
+        # The server module sets up the service folders and the MapProxy app when imported
+        with quiet(self.log_file):
+            from server import refresh_tileclusters
+        metrics.configure(os.path.join(self.temp_folder, "metrics"))
+
+        config_name = f"bench_{size}"
+        geom_folder = self.geom_folder(config_name)
+        conn = self.connection(geometries)
+        with quiet(self.log_file):
+            seconds = timed(
+                lambda: refresh_tileclusters(self.config, geom_folder, conn, config_name),
+                self.args.repeat, lambda: shutil.rmtree(geom_folder, ignore_errors=True),
+            )
+        self.record("refresh_tileclusters", size, seconds=round(seconds, 4), db_round_trips=conn.round_trips // self.args.repeat)
+
+        # Same geometries again, no WKT file is written
+        conn = self.connection(geometries)
+        with quiet(self.log_file):
+            seconds = timed(lambda: refresh_tileclusters(self.config, geom_folder, conn, config_name), self.args.repeat)
+        self.record("refresh_tileclusters_unchanged", size, seconds=round(seconds, 4), db_round_trips=conn.round_trips // self.args.repeat)
+
+    def seed(self, size: int, geometries: dict[str, str]) -> None:
+        config_name = f"bench_{size}"
+        geom_folder = self.geom_folder(config_name)
+        coverage = lambda tilecluster_id, mapzones: {
+            "srs": self.config["crs"],
+            "datasource": os.path.join(geom_folder, f"{tilecluster_id}.wkt"),
+        }
+        conn = self.connection(geometries)
+        wms_requests = self.wms.requests
+        shutil.rmtree(os.path.join(self.tiles_dir, config_name), ignore_errors=True)
+
+        with quiet(self.log_file):
+            start_time = time.perf_counter()
+            results = seed(
+                self.config, conn, self.generated_config_path, self.temp_folder, config_name, coverage,
+                levels=self.args.seed_levels,
+            )
+            seconds = time.perf_counter() - start_time
+
+        tiles = sum(result.tiles.written for result in results if result.tiles is not None)
+        self.record(
+            "seed", size, seconds=round(seconds, 4), seconds_per_tilecluster=round(seconds / size, 5),
+            tiles=tiles, wms_requests=self.wms.requests - wms_requests, db_round_trips=conn.round_trips,
+        )
+
+    def tile_paths(self, config_name: str, geometries: dict[str, str]) -> list[str]:
+        """WMTS paths of the seeded tile at the centre of every tilecluster, at every seeded level"""
+        minx, _, _, maxy = GRID["bbox"]
+        paths = []
+        for tilecluster_id, geometry in geometries.items():
+            centroid = wkt.loads(geometry).centroid
+            for level in self.args.seed_levels:
+                tile_span = RES[level] * TILE_SIZE
+                x, y = int((centroid.x - minx) // tile_span), int((maxy - centroid.y) // tile_span)
+                paths.append(f"/{config_name}/wmts/tiles/{tilecluster_id}/main_grid/{level}/{x}/{y}.png")
+        return paths
+
+    def tile_throughput(self, size: int, geometries: dict[str, str]) -> None:
+        """
+        Tiles served by MapProxy alone and through the middlewares the server puts in front of
+        it (dispatcher, metrics, validators, memory cache), as the uWSGI workers call them.
+        """
+        config_name = f"bench_{size}"
+        paths = self.tile_paths(config_name, geometries)
+        mapproxy_app = make_wsgi_app(self.generated_config_path, allow_listing=True, debug=False)
+        tile_configs = TileConfigs(os.path.join(self.temp_folder, "tile_cache"), lambda _: TileSettings(None, 3600))
+
+        def stack(memory_cache: bool):
+            tile_app = mapproxy_app
+            if memory_cache:
+                tile_app = TileCache(lambda: mapproxy_app, tile_configs, 64 * 1024 * 1024, 512 * 1024)
+            tile_validators = TileValidators(lambda: tile_app, lambda: mapproxy_app, tile_configs)
+            tile_metrics = TileMetrics(lambda: tile_validators)
+            return PrefixDispatcher(Flask("benchmark").wsgi_app, ["/seeding"], lambda: tile_metrics)
+
+        def serve(app, headers: dict | None = None) -> float:
+            environs = [EnvironBuilder(path=path, headers=headers).get_environ() for path in paths]
+            statuses = {}
+            def start_response(status, headers, exc_info=None):
+                statuses[status] = statuses.get(status, 0) + 1
+
+            def run():
+                for i in range(self.args.requests):
+                    result = app(dict(environs[i % len(environs)]), start_response)
+                    b"".join(result)
+                    if hasattr(result, "close"):
+                        result.close()
+            # Warm up (configs loaded, tiles read once) before measuring
+            with quiet(self.log_file):
+                for environ in environs:
+                    b"".join(app(dict(environ), start_response))
+                statuses.clear()
+                seconds = timed(run, self.args.repeat)
+            if not any(status.startswith(("200", "304")) for status in statuses):
+                raise RuntimeError(f"No tile served: {statuses}")
+            return self.args.requests / seconds
+
+        self.record("tiles_mapproxy", size, requests_per_second=round(serve(mapproxy_app)))
+        self.record("tiles_server", size, requests_per_second=round(serve(stack(memory_cache=True))))
+        self.record("tiles_server_no_memory_cache", size, requests_per_second=round(serve(stack(memory_cache=False))))
+
+        # Revalidation of tiles a client already has
+        etags = {}
+        app = stack(memory_cache=True)
+        def keep_etag(status, headers, exc_info=None):
+            etags.update(headers)
+        b"".join(app(EnvironBuilder(path=paths[0]).get_environ(), keep_etag))
+        self.record("tiles_server_not_modified", size, requests_per_second=round(serve(app, {"If-None-Match": etags["ETag"]})))
+
+    def stop(self) -> None:
+        self.wms.stop()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: list[dict], baseline_file: str, tolerance: float) -> list[str]:
+    """Results more than `tolerance` (a fraction) worse than the same benchmark of the baseline"""
+    with open(baseline_file, "r") as f:
+        baseline = {(result["benchmark"], result["size"]): result for result in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        old = baseline.get((result["benchmark"], result["size"]))
+        if old is None:
+            continue
+        for metric in ("seconds", "requests_per_second"):
+            if metric not in result or not old.get(metric):
+                continue
+            ratio = result[metric] / old[metric]
+            if metric in HIGHER_IS_BETTER:
+                ratio = 1 / ratio if ratio else math.inf
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{result['benchmark']} ({result['size']} tileclusters): {metric} {old[metric]} -> {result[metric]} "
+                    f"({(ratio - 1) * 100:.0f}% worse)"
+                )
+    return regressions
+
+def parse_sizes(value: str) -> list[int]:
+    return [int(size) for size in value.split(",") if size]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=(
+        "Benchmark make_config, refresh_tileclusters, seed and tile serving against a local fake WMS "
+        "and a fake database, no outside service is needed. Results are written as JSON."
+    ))
+    parser.add_argument("--sizes", type=parse_sizes, default=[10, 1000, 10000], help="tilecluster counts, e.g. 10,1000,10000")
+    # Seeding takes about half a second per tilecluster, 10000 of them take more than an hour
+    parser.add_argument("--seed-sizes", type=parse_sizes, default=[10, 1000], help="tilecluster counts to seed, e.g. 10,1000,10000")
+    parser.add_argument("--seed-levels", type=parse_sizes, default=[7, 8], help="levels seeded for each tilecluster")
+    parser.add_argument("--seed-concurrency", type=int, default=4, help="concurrent WMS renders of a seed")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each timing, the best one is kept")
+    parser.add_argument("--requests", type=int, default=5000, help="tile requests of each throughput run")
+    parser.add_argument("--wms-latency", type=float, default=0.02, help="seconds the fake WMS takes per render")
+    parser.add_argument("--wms-jitter", type=float, default=0.0, help="extra random seconds per render, at most")
+    parser.add_argument("--db-round-trip", type=float, default=0.0005, help="seconds per statement of the fake database")
+    parser.add_argument("--view-refresh", type=float, default=0.005, help="seconds per materialized view refresh")
+    parser.add_argument("--output", help=f"results file (default: {RESULTS_FOLDER}/<time>.json)")
+    parser.add_argument("--compare", help="results file to compare with, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown tolerated by --compare, as a fraction")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder (configs, tiles, log)")
+    args = parser.parse_args()
+    seed_sizes = args.seed_sizes
+
+    work_dir = WORK_DIR
+    print(f"Working in {work_dir}")
+    started = datetime.datetime.now(datetime.timezone.utc)
+    with open(os.path.join(work_dir, "run.log"), "w") as log_file:
+        run = Run(args, work_dir, log_file)
+        try:
+            for size in sorted(set(args.sizes) | set(seed_sizes)):
+                geometries = make_tileclusters(size)
+                run.refresh_tileclusters(size, geometries)
+                run.make_config(size, geometries)
+                if size in seed_sizes:
+                    run.seed(size, geometries)
+            if seed_sizes:
+                size = min(seed_sizes)
+                run.tile_throughput(size, make_tileclusters(size))
+        finally:
+            run.stop()
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{started:%Y%m%dT%H%M%SZ}.json")
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "started": started.isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+            "results": run.results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.compare:
+        regressions = compare(run.results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regression against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
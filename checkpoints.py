@@ -0,0 +1,230 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import datetime
+import json
+import threading
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from mapproxy.seed.util import ProgressLog, ProgressStore
+
+# Tilecluster states of a seed run
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS {schema}.seed_progress (
+    config text NOT NULL,
+    tilecluster_id text NOT NULL,
+    run_id text NOT NULL,
+    kind text NOT NULL,
+    started timestamp NOT NULL,
+    status text NOT NULL,
+    level integer,
+    levels integer[],
+    progress jsonb,
+    error text,
+    updated timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (config, tilecluster_id)
+)
+"""
+
+_created_tables: set[tuple[str, str]] = set()
+_created_tables_lock = threading.Lock()
+
+def _create_table(conn: psycopg2.extensions.connection, db_url: str, schema: str) -> None:
+    with _created_tables_lock:
+        if (db_url, schema) in _created_tables:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute(PROGRESS_TABLE.format(schema=schema))
+        conn.commit()
+        _created_tables.add((db_url, schema))
+
+
+class UnfinishedSeedError(RuntimeError):
+    """A new seed run would throw away the checkpoints of an unfinished run of another kind"""
+    def __init__(self, config_name: str, run_id: str, kind: str, pending: int):
+        self.run_id = run_id
+        self.kind = kind
+        super().__init__(
+            f"Seed run {run_id} ({kind}) of {config_name} has {pending} unfinished tileclusters, "
+            f"resume it or discard it with discard=true"
+        )
+
+
+class _CheckpointStore(ProgressStore):
+    """
+    MapProxy progress store of one tilecluster, kept in its `seed_progress` row instead of a file.
+
+    The progress identifier tells the tile walker which subtrees it already processed,
+    it only applies to a seed of the same levels.
+    """
+    def __init__(self, checkpoints: "SeedCheckpoints", tilecluster_id: str, levels: list[int] | None, progress: list | None):
+        self.checkpoints = checkpoints
+        self.tilecluster_id = tilecluster_id
+        self.levels = levels
+        # JSON turned the (index, subtiles) tuples into lists, MapProxy compares them as tuples
+        self.progress = [tuple(step) for step in progress] if progress is not None else None
+        self.level: int | None = None
+
+    def get(self, task_identifier):
+        if self.levels is None or list(task_identifier[-1]) != self.levels:
+            return None
+        return self.progress
+
+    def add(self, task_identifier, progress_identifier):
+        self.levels = list(task_identifier[-1])
+        self.progress = progress_identifier
+
+    def write(self):
+        self.checkpoints.save_progress(self.tilecluster_id, self.level, self.levels, self.progress)
+
+    def remove(self):
+        self.levels = self.progress = None
+
+
+class CheckpointLog(ProgressLog):
+    """Progress log that also tells its store the level the walker is at"""
+    def log_progress(self, progress, level, bbox, tiles):
+        self.progress_store.level = level
+        super().log_progress(progress, level, bbox, tiles)
+
+
+class SeedCheckpoints:
+    """
+    Progress of a seed run of a config, one `{tiling_db_schema}.seed_progress` row per
+    tilecluster, so a run interrupted by a reload, a crash or a cancellation can be resumed.
+
+    Only the last run of each config is kept. A resumed run skips the tileclusters already
+    done and continues the others from the progress MapProxy's walker stored for them.
+
+    A new run only replaces an unfinished one of the same kind, or any with `discard`.
+    """
+    def __init__(self, config: dict, config_name: str, kind: str, conn: psycopg2.extensions.connection, discard: bool = False):
+        self.schema = config["tiling_db_schema"]
+        self.config_name = config_name
+        self.kind = kind
+        self.conn = conn
+        self.discard = discard
+        self.run_id = uuid.uuid4().hex
+        self.started = datetime.datetime.now()
+        self.resumed = False
+        # Status and stored walker progress of the tileclusters of the run
+        self.rows: dict[str, tuple[str, list[int] | None, list | None]] = {}
+        # The connection is shared by the seeding workers
+        self.lock = threading.Lock()
+        _create_table(conn, config["db_url_remote"], self.schema)
+
+    @classmethod
+    def load(cls, config: dict, config_name: str, conn: psycopg2.extensions.connection) -> "SeedCheckpoints | None":
+        """Last run of the config, None if there is none or every tilecluster of it is done"""
+        _create_table(conn, config["db_url_remote"], config["tiling_db_schema"])
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT tilecluster_id, run_id, kind, started, status, levels, progress "
+                f"FROM {config['tiling_db_schema']}.seed_progress WHERE config = %s ORDER BY started DESC",
+                (config_name,)
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        if not rows:
+            return None
+
+        # Runs replace each other, rows of an older one were left by runs started at the same time
+        _, run_id, kind, started, _, _, _ = rows[0]
+        other_runs = {row[1] for row in rows if row[1] != run_id}
+        if other_runs:
+            print(f"Ignoring the checkpoints of older seed runs {', '.join(sorted(other_runs))} of {config_name}")
+            rows = [row for row in rows if row[1] == run_id]
+        if all(status == DONE for _, _, _, _, status, _, _ in rows):
+            return None
+
+        checkpoints = cls(config, config_name, kind, conn)
+        checkpoints.run_id = run_id
+        checkpoints.started = started
+        checkpoints.resumed = True
+        checkpoints.rows = {tilecluster_id: (status, levels, progress) for tilecluster_id, _, _, _, status, levels, progress in rows}
+        return checkpoints
+
+    @property
+    def pending(self) -> list[str]:
+        return sorted(tilecluster_id for tilecluster_id, (status, _, _) in self.rows.items() if status != DONE)
+
+    def check_unfinished(self) -> None:
+        """Raise `UnfinishedSeedError` if the last run of the config is unfinished and of another kind"""
+        if self.resumed or self.discard:
+            return
+        with self.lock, self.conn.cursor() as cursor:
+            self._check_unfinished(cursor)
+            self.conn.commit()
+
+    def _check_unfinished(self, cursor) -> None:
+        cursor.execute(
+            f"SELECT run_id, kind, count(*) FROM {self.schema}.seed_progress "
+            f"WHERE config = %s AND status <> %s AND kind <> %s GROUP BY run_id, kind",
+            (self.config_name, DONE, self.kind)
+        )
+        unfinished = cursor.fetchone()
+        if unfinished is not None:
+            self.conn.rollback()
+            raise UnfinishedSeedError(self.config_name, *unfinished)
+
+    def begin(self, tilecluster_ids: list[str]) -> list[str]:
+        """
+        Record the tileclusters of the run, returns the ones still to seed. The checkpoints
+        of the previous run are replaced, see `check_unfinished`.
+        """
+        new_ids = [tilecluster_id for tilecluster_id in tilecluster_ids if tilecluster_id not in self.rows]
+        with self.lock, self.conn.cursor() as cursor:
+            if not self.resumed:
+                if not self.discard:
+                    self._check_unfinished(cursor)
+                cursor.execute(f"DELETE FROM {self.schema}.seed_progress WHERE config = %s", (self.config_name,))
+            if new_ids:
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {self.schema}.seed_progress (config, tilecluster_id, run_id, kind, started, status) VALUES %s",
+                    [(self.config_name, tilecluster_id, self.run_id, self.kind, self.started, PENDING) for tilecluster_id in new_ids],
+                    page_size=1000,
+                )
+            self.conn.commit()
+
+        for tilecluster_id in new_ids:
+            self.rows[tilecluster_id] = (PENDING, None, None)
+        if self.resumed:
+            done = sum(1 for status, _, _ in self.rows.values() if status == DONE)
+            print(f"Resuming seed run {self.run_id} of {self.config_name}: {done} of {len(self.rows)} tileclusters already done")
+        return [tilecluster_id for tilecluster_id in tilecluster_ids if self.rows[tilecluster_id][0] != DONE]
+
+    def _update(self, tilecluster_id: str, assignments: str, values: tuple) -> None:
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {self.schema}.seed_progress SET {assignments}, updated = now() WHERE config = %s AND tilecluster_id = %s",
+                (*values, self.config_name, tilecluster_id)
+            )
+            self.conn.commit()
+
+    def progress_store(self, tilecluster_id: str) -> _CheckpointStore:
+        _, levels, progress = self.rows.get(tilecluster_id, (PENDING, None, None))
+        self._update(tilecluster_id, "status = %s, error = NULL", (RUNNING,))
+        return _CheckpointStore(self, tilecluster_id, levels, progress)
+
+    def save_progress(self, tilecluster_id: str, level: int | None, levels: list[int] | None, progress: list | None) -> None:
+        self._update(tilecluster_id, "level = %s, levels = %s, progress = %s", (level, levels, json.dumps(progress)))
+
+    def done(self, tilecluster_id: str) -> None:
+        self._update(tilecluster_id, "status = %s, progress = NULL", (DONE,))
+        self.rows[tilecluster_id] = (DONE, None, None)
+
+    def failed(self, tilecluster_id: str, error: str) -> None:
+        # The stored progress is kept, a resume continues from it
+        self._update(tilecluster_id, "status = %s, error = %s", (FAILED, error))
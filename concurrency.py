@@ -0,0 +1,311 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.client import HTTPException
+from typing import Iterator
+
+import multiprocess
+from mapproxy.cache.file import FileCache
+from mapproxy.config import base_config
+from mapproxy.seed.seeder import SeedProgress, TileSeedWorker, TileWalker, TileWorkerPool
+from mapproxy.seed.util import ProgressLog, exp_backoff, format_seed_task
+from mapproxy.source import SourceError
+from mapproxy.util.lock import LockTimeout
+
+# Seconds between two adjustments of the concurrency
+ADJUST_INTERVAL = 5.0
+# Without `seed_target_latency`, renders slower than this factor of the fastest ones seen are too slow
+LATENCY_FACTOR = 2.0
+# The fastest latency seen is forgotten by this factor at every adjustment, renders get slower with the zoom level
+LATENCY_DRIFT = 1.01
+# Seconds a paused worker waits before checking whether it may take tiles again
+PAUSE_INTERVAL = 0.1
+
+
+class SourceStats:
+    """Source renders of the seed workers, shared with their processes"""
+    def __init__(self):
+        # Requests, errors and seconds spent
+        self.values = multiprocess.Array("d", 3)
+
+    def record(self, seconds: float, error: bool) -> None:
+        with self.values.get_lock():
+            self.values[0] += 1
+            self.values[1] += error
+            self.values[2] += seconds
+
+    def totals(self) -> tuple[int, int, float]:
+        with self.values.get_lock():
+            return int(self.values[0]), int(self.values[1]), self.values[2]
+
+
+class StoreStats:
+    """Tiles the seed workers stored in file caches, shared with their processes"""
+    def __init__(self):
+        # Tiles stored, single colour tiles linked instead, bytes written and bytes the links saved
+        self.values = multiprocess.Array("d", 4)
+
+    def record(self, stored: int, linked: int, bytes_written: int, bytes_saved: int) -> None:
+        with self.values.get_lock():
+            self.values[0] += stored
+            self.values[1] += linked
+            self.values[2] += bytes_written
+            self.values[3] += bytes_saved
+
+    def totals(self) -> tuple[int, int, int, int]:
+        with self.values.get_lock():
+            return tuple(int(value) for value in self.values)
+
+
+@contextmanager
+def _counting_stores(cache: FileCache, stats: StoreStats) -> Iterator[None]:
+    """
+    Count the tiles stored through `cache` in `stats`. The worker processes forked
+    meanwhile inherit the counting methods.
+    """
+    store, store_single_color_tile = cache._store, cache._store_single_color_tile
+    linking = threading.local()
+
+    def counted_store(tile, location):
+        store(tile, location)
+        # The image a single colour tile links to is written once, the tile itself counts as linked
+        stats.record(0 if getattr(linking, "active", False) else 1, 0, os.path.getsize(location), 0)
+
+    def counted_store_single_color_tile(tile, tile_loc, color):
+        linking.active = True
+        try:
+            store_single_color_tile(tile, tile_loc, color)
+        finally:
+            linking.active = False
+        # Symbolic and hard links both have the size of the image they share
+        stats.record(1, 1, 0, os.path.getsize(tile_loc))
+
+    cache._store, cache._store_single_color_tile = counted_store, counted_store_single_color_tile
+    try:
+        yield
+    finally:
+        del cache._store, cache._store_single_color_tile
+
+
+class _Gate:
+    """Number of workers of a pool allowed to take tiles, the others wait"""
+    def __init__(self, stats: SourceStats, allowed: int):
+        self.stats = stats
+        self.allowed = multiprocess.Value("i", allowed)
+        self.next_index = multiprocess.Value("i", 0)
+        # Tiles seeded by the workers of the pool
+        self.tiles = multiprocess.Value("l", 0)
+
+    def join(self) -> int:
+        with self.next_index.get_lock():
+            index = self.next_index.value
+            self.next_index.value += 1
+        return index
+
+
+class _AdaptiveSeedWorker(TileSeedWorker):
+    def _tile_count(self, tile_coord) -> int:
+        if self.tile_mgr.meta_grid is None:
+            return 1
+        return sum(1 for tile in self.tile_mgr.meta_grid.meta_tile(tile_coord).tiles if tile is not None)
+
+    def work_loop(self):
+        gate: _Gate = self.task.gate
+        index = gate.join()
+        load_tile_coords = self.tile_mgr.load_tile_coords
+
+        def timed_load(tiles):
+            start_time = time.perf_counter()
+            try:
+                result = load_tile_coords(tiles)
+            except LockTimeout:
+                raise
+            except Exception:
+                gate.stats.record(time.perf_counter() - start_time, True)
+                raise
+            gate.stats.record(time.perf_counter() - start_time, False)
+            with gate.tiles.get_lock():
+                gate.tiles.value += sum(self._tile_count(tile) for tile in tiles)
+            return result
+
+        while True:
+            while index >= gate.allowed.value:
+                time.sleep(PAUSE_INTERVAL)
+            tiles = self.tiles_queue.get()
+            if tiles is None:
+                return
+            with self.tile_mgr.session():
+                exp_backoff(timed_load, args=(tiles,),
+                            max_repeat=100, max_backoff=600,
+                            exceptions=(SourceError, IOError, HTTPException), ignore_exceptions=(LockTimeout, ))
+
+
+class _GrowingWorkerPool(TileWorkerPool):
+    """
+    Seed pool that forks the workers its gate allows when it starts, and more as the gate
+    allows more of them, up to `ceiling`. Workers paused since stay forked until the end.
+    """
+    def __init__(self, task, worker_class, ceiling: int, progress_logger: ProgressLog | None = None):
+        self.worker_class = worker_class
+        self.ceiling = ceiling
+        self.conf = base_config()
+        super().__init__(task, worker_class, size=min(task.gate.allowed.value, ceiling), progress_logger=progress_logger)
+
+    def grow(self) -> None:
+        for _ in range(len(self.procs), min(self.task.gate.allowed.value, self.ceiling)):
+            worker = self.worker_class(self.task, self.tiles_queue, self.conf)
+            worker.start()
+            self.procs.append(worker)
+
+    def process(self, tiles, progress):
+        self.grow()
+        super().process(tiles, progress)
+
+
+class ConcurrencyController:
+    """
+    Number of concurrent source renders of a seed, adjusted while seeding (AIMD).
+
+    Every `ADJUST_INTERVAL` seconds the renders of the last interval are checked: any error
+    or timeout halves the concurrency, a mean latency above the target cuts it by a quarter,
+    and otherwise it grows by one, up to the `ceiling`. The target is `target_latency`, or
+    `LATENCY_FACTOR` times the fastest mean latency seen. Each change is logged.
+
+    Tileclusters seeded at once share the concurrency, each seed pool gets its part of it.
+    """
+    def __init__(self, name: str, ceiling: int, initial: int, target_latency: float | None = None):
+        self.name = name
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(initial, self.ceiling))
+        self.target_latency = target_latency
+        self.best_latency: float | None = None
+        self.stats = SourceStats()
+        self.totals = (0, 0, 0.0)
+        self.gates: list[_Gate] = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    @classmethod
+    def from_config(cls, config: dict, name: str) -> "ConcurrencyController":
+        ceiling = int(config.get("seed_max_concurrency", (os.cpu_count() or 1) * 2))
+        initial = int(config.get("seed_initial_concurrency", min(4, ceiling)))
+        target_latency = config.get("seed_target_latency")
+        return cls(name, ceiling, initial, float(target_latency) if target_latency is not None else None)
+
+    def _rebalance(self) -> None:
+        for gate in self.gates:
+            gate.allowed.value = max(1, self.limit // len(self.gates))
+
+    def open_gate(self) -> _Gate:
+        with self.lock:
+            gate = _Gate(self.stats, self.limit)
+            self.gates.append(gate)
+            self._rebalance()
+            return gate
+
+    def close_gate(self, gate: _Gate) -> None:
+        with self.lock:
+            # Paused workers have to take their stop sentinel too
+            gate.allowed.value = self.ceiling
+            self.gates.remove(gate)
+            self._rebalance()
+
+    def adjust(self) -> None:
+        totals = self.stats.totals()
+        requests, errors, seconds = (total - previous for total, previous in zip(totals, self.totals))
+        self.totals = totals
+        if requests == 0:
+            return
+
+        latency = seconds / requests
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        target = self.target_latency or self.best_latency * LATENCY_FACTOR
+
+        old_limit = self.limit
+        if errors:
+            new_limit, reason = max(1, old_limit // 2), "errors"
+        elif latency > target:
+            new_limit, reason = max(1, old_limit * 3 // 4), "slow renders"
+        elif requests >= old_limit and old_limit < self.ceiling:
+            new_limit, reason = old_limit + 1, "healthy"
+        else:
+            new_limit, reason = old_limit, None
+        self.best_latency *= LATENCY_DRIFT
+
+        if new_limit != old_limit:
+            print(
+                f"Seed concurrency of {self.name}: {old_limit} -> {new_limit} ({reason}: {requests} requests, "
+                f"{errors} errors, {latency:.2f}s mean latency, target {target:.2f}s)"
+            )
+            with self.lock:
+                self.limit = new_limit
+                self._rebalance()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(ADJUST_INTERVAL):
+            self.adjust()
+
+    def start(self) -> None:
+        print(f"Seed concurrency of {self.name}: starting at {self.limit}, at most {self.ceiling}")
+        self.thread = threading.Thread(target=self._run, name="seed-concurrency", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def seed_tasks(
+    tasks: list, controller: ConcurrencyController, progress_logger: ProgressLog, store_stats: StoreStats | None = None,
+) -> int:
+    """
+    MapProxy's `seed` for the tasks of a tilecluster, with a pool of as many workers as
+    the controller allows, forked as it allows more of them. Returns the number of tiles
+    seeded.
+
+    The tiles the workers store in file caches are counted in `store_stats`.
+    """
+    tiles = 0
+    for task in tasks:
+        print(format_seed_task(task))
+        if task.coverage is False:
+            continue
+
+        start_progress = None
+        if progress_logger.progress_store:
+            progress_logger.current_task_id = task.id
+            start_progress = progress_logger.progress_store.get(task.id)
+
+        if task.refresh_timestamp is not None:
+            task.tile_manager._expire_timestamp = task.refresh_timestamp
+        task.tile_manager.minimize_meta_requests = False
+
+        counting = nullcontext()
+        if store_stats is not None and isinstance(task.tile_manager.cache, FileCache):
+            counting = _counting_stores(task.tile_manager.cache, store_stats)
+
+        with counting:
+            task.gate = controller.open_gate()
+            tile_worker_pool = _GrowingWorkerPool(task, _AdaptiveSeedWorker, controller.ceiling, progress_logger=progress_logger)
+            tile_walker = TileWalker(
+                task, tile_worker_pool, handle_uncached=True, handle_all=task.refresh_all,
+                progress_logger=progress_logger, seed_progress=SeedProgress(old_progress_identifier=start_progress),
+                work_on_metatiles=not task.tile_manager.rescale_tiles,
+            )
+            try:
+                tile_walker.walk()
+            finally:
+                controller.close_gate(task.gate)
+                tile_worker_pool.stop()
+                tiles += task.gate.tiles.value
+    return tiles
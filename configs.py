@@ -0,0 +1,249 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import difflib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from numbers import Real
+from typing import Any, Callable
+
+import yaml
+from qwc_services_core.runtime_config import RuntimeConfig
+
+from make_conf import CACHE_TYPES
+from seeding import parse_levels, view_refresh_mode
+import yaml_io
+
+
+class ConfigError(ValueError):
+    def __init__(self, path: str, errors: list[str]):
+        self.errors = errors
+        super().__init__(f"Invalid config {path}: " + "; ".join(errors))
+
+
+@dataclass
+class Field:
+    types: tuple[type, ...]
+    required: bool = False
+    # Returns what is wrong with a value of the right type, None if nothing
+    check: Callable[[Any], str | None] | None = None
+    # Accepted but unused, the reason is printed when a config still has the key
+    deprecated: str | None = None
+
+
+def _list_of(*types: type) -> Callable[[list], str | None]:
+    def check(value: list) -> str | None:
+        if not all(isinstance(item, types) and not isinstance(item, bool) for item in value):
+            return f"items must be of type {' or '.join(t.__name__ for t in types)}"
+        return None
+    return check
+
+def _check_grid(grid: dict) -> str | None:
+    missing = [key for key in ("srs", "origin", "bbox") if key not in grid]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    bbox = grid["bbox"]
+    if not isinstance(bbox, list) or len(bbox) != 4 or not all(isinstance(v, Real) for v in bbox):
+        return "bbox must be a list of 4 numbers"
+    return None
+
+def _check_sources(sources: dict) -> str | None:
+    if not isinstance(sources.get("inventory_source"), dict):
+        return "inventory_source must be a mapping of WMS request options"
+    if "additional_source" in sources and not isinstance(sources["additional_source"], (dict, type(None))):
+        return "additional_source must be a mapping of WMS request options"
+    return None
+
+def _check_cache(cache: dict) -> str | None:
+    if cache.get("type", "file") not in CACHE_TYPES:
+        return f"type must be one of {', '.join(CACHE_TYPES)}"
+    return None
+
+def _check_seed_sessions(sessions: list) -> str | None:
+    # Sessions seed at the same time, sharing a role, a view or the WMS data would mix their tileclusters
+    for session in sessions:
+        if not isinstance(session, dict) or not isinstance(session.get("db_url"), str):
+            return "every session must be a mapping with a db_url"
+        views = session.get("materialized_views")
+        if not isinstance(views, list) or not views or _list_of(str)(views) is not None:
+            return "every session must have its own materialized_views, a list of view names"
+        if not isinstance(session.get("source"), dict) or not session["source"]:
+            return "every session must have a source mapping of WMS request overrides"
+
+    if len({session["db_url"] for session in sessions}) < len(sessions):
+        return "sessions must use different db_url"
+    views = [view for session in sessions for view in session["materialized_views"]]
+    if len(set(views)) < len(views):
+        return "sessions must not share materialized_views"
+    sources = [json.dumps(session["source"], sort_keys=True) for session in sessions]
+    if len(set(sources)) < len(sources):
+        return "sessions must have different source overrides"
+    return None
+
+def _check_levels(levels: str | int | list) -> str | None:
+    try:
+        parse_levels(levels)
+    except (TypeError, ValueError):
+        return "must be a level, a list of levels, or a 'from-to' range or comma separated string"
+    return None
+
+def _positive(value: Real) -> str | None:
+    return "must be positive" if value <= 0 else None
+
+
+# Keys of a user config (config/<name>.yaml)
+USER_CONFIG_FIELDS: dict[str, Field] = {
+    "db_url_remote": Field((str,), required=True),
+    "db_url": Field((str,), deprecated="feature boundaries are read from db_url_remote, with the pooled connections"),
+    "data_db_schema": Field((str,), required=True),
+    "tiling_db_schema": Field((str,), required=True),
+    "tileclusters_table": Field((str,), required=True),
+    "materialized_views": Field((list,), required=True, check=_list_of(str)),
+    "crs": Field((str,), required=True),
+    "grid": Field((dict,), required=True, check=_check_grid),
+    "res": Field((list,), required=True, check=_list_of(Real)),
+    "sources": Field((dict,), required=True, check=_check_sources),
+    "additional_schema": Field((str, type(None))),
+    "update_tables": Field((list,), check=_list_of(str)),
+    "additional_update_tables": Field((list,), check=_list_of(str)),
+    "selectors": Field((list,), check=_list_of(dict)),
+    "cache": Field((dict,), check=_check_cache),
+    "link_single_color_images": Field((bool, str)),
+    "db_pool_size": Field((int,), check=_positive),
+    "view_refresh": Field((str,)),
+    "view_refresh_concurrency": Field((int,), check=_positive),
+    "tilecluster_filter": Field((str,)),
+    "seed_concurrency": Field((int,), check=_positive),
+    "seed_sessions": Field((list,), check=_check_seed_sessions),
+    "seed_max_concurrency": Field((int,), check=_positive),
+    "seed_initial_concurrency": Field((int,), check=_positive),
+    "seed_target_latency": Field((Real,), check=_positive),
+    "feature_seed_levels": Field((str, int, list), check=_check_levels),
+    "feature_seed_buffer": Field((Real,)),
+    "tile_cache_levels": Field((str, int, list), check=_check_levels),
+    "tile_max_age": Field((int,)),
+}
+
+def validate_user_config(path: str, config: Any) -> None:
+    """Raise a `ConfigError` with everything wrong in a user config"""
+    if not isinstance(config, dict):
+        raise ConfigError(path, ["expected a mapping of settings"])
+
+    errors = []
+    deprecated = []
+    for key, value in config.items():
+        field = USER_CONFIG_FIELDS.get(key)
+        if field is None:
+            suggestion = difflib.get_close_matches(key, USER_CONFIG_FIELDS, 1)
+            errors.append(f"unknown key '{key}'" + (f", did you mean '{suggestion[0]}'?" if suggestion else ""))
+            continue
+        # YAML booleans are ints for Python
+        if not isinstance(value, field.types) or (isinstance(value, bool) and bool not in field.types):
+            errors.append(f"'{key}' must be of type {' or '.join('null' if t is type(None) else t.__name__ for t in field.types)}")
+            continue
+        if field.check is not None and (error := field.check(value)) is not None:
+            errors.append(f"'{key}' {error}")
+        elif field.deprecated is not None:
+            deprecated.append(f"'{key}' is no longer used, {field.deprecated}")
+
+    errors.extend(f"missing key '{key}'" for key, field in USER_CONFIG_FIELDS.items() if field.required and key not in config)
+
+    if not errors:
+        try:
+            view_refresh_mode(config)
+        except ValueError as e:
+            errors.append(str(e))
+        if bool(config["sources"].get("additional_source")) != bool(config.get("additional_schema")):
+            errors.append("both 'sources.additional_source' and 'additional_schema' must be provided or neither")
+
+    if errors:
+        raise ConfigError(path, errors)
+    for warning in deprecated:
+        print(f"Config {path}: {warning}")
+
+def _validate_tenant_config(path: str, config: RuntimeConfig) -> None:
+    themes = config.get("themes")
+    if themes is None:
+        return
+    if not isinstance(themes, dict):
+        raise ConfigError(path, ["'themes' must be a mapping of theme names"])
+    errors = [
+        f"theme '{theme}' must be a mapping with an optional 'tile_config' name"
+        for theme, theme_config in themes.items()
+        if not isinstance(theme_config, dict) or not isinstance(theme_config.get("tile_config", ""), str)
+    ]
+    if errors:
+        raise ConfigError(path, errors)
+
+
+class _FileCache:
+    """
+    Values loaded from files, kept until the modification time or size of their file
+    changes. A file that failed to load keeps failing with the same error until it changes.
+    """
+    def __init__(self):
+        self.entries: dict[str, tuple[tuple[int, int], Any, Exception | None]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str, load: Callable[[], Any]) -> Any:
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None or entry[0] != version:
+            # Loading twice when two threads miss at once is harmless
+            try:
+                entry = (version, load(), None)
+            except ValueError as e:
+                entry = (version, None, e)
+            with self.lock:
+                self.entries[path] = entry
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+
+_user_configs = _FileCache()
+_tenant_configs = _FileCache()
+
+def load_user_config(path: str) -> dict:
+    """
+    Parsed and validated user config at `path`, shared by the whole process and loaded
+    again once the file changes. Raises `FileNotFoundError` or `ConfigError`.
+
+    The same dict is returned to every caller, it must not be modified.
+    """
+    def load() -> dict:
+        with open(path, "r") as f:
+            try:
+                config = yaml_io.load(f)
+            except yaml.YAMLError as e:
+                raise ConfigError(path, [str(e)]) from None
+        validate_user_config(path, config)
+        return config
+    return _user_configs.get(path, load)
+
+def load_tenant_config(service: str, tenant: str, logger) -> RuntimeConfig:
+    """
+    Runtime config of `service` for `tenant` (`RuntimeConfig.tenant_config`), shared by
+    the whole process and read again once its file changes.
+    """
+    path = RuntimeConfig.config_file_path(service, tenant)
+
+    def load() -> RuntimeConfig:
+        config = RuntimeConfig(service, logger).read_config(tenant)
+        _validate_tenant_config(path, config)
+        return config
+
+    if path is not None:
+        try:
+            return _tenant_configs.get(path, load)
+        except FileNotFoundError:
+            pass
+    # Logged and read as an empty config, like RuntimeConfig does
+    return RuntimeConfig(service, logger).read_config(tenant)
@@ -0,0 +1,165 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import psycopg2
+import psycopg2.extensions
+
+from metrics import count_round_trip
+
+# Connections idle for longer than this are checked with a `SELECT 1` before being handed out
+HEALTH_CHECK_AFTER = float(os.environ.get("DB_HEALTH_CHECK_AFTER", 30))
+DEFAULT_POOL_SIZE = 4
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor counting the statements it sends, for the seeding metrics"""
+    def execute(self, query, vars=None):
+        count_round_trip()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        # One round trip per parameter set
+        count_round_trip(len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        count_round_trip()
+        return super().callproc(procname, parameters)
+
+
+class ConnectionPool:
+    """
+    Lazily opened pool of connections to one database url, at most `size` of them.
+
+    Returned connections stay open for the next borrower. `getconn` blocks while all
+    connections are in use instead of failing.
+    """
+    def __init__(self, db_url: str, size: int):
+        self.db_url = db_url
+        self.size = size
+        # Open connections not in use, the most recently returned last
+        self.idle: list[psycopg2.extensions.connection] = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+        self.last_used: dict[int, float] = {}
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(self.db_url, cursor_factory=CountingCursor)
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        self.available.acquire()
+        try:
+            # A connection may have been dropped by the server while idle, try a fresh one once
+            for _ in range(2):
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    # Just opened, nothing to check
+                    return self._connect()
+                if self._healthy(conn):
+                    return conn
+                self._close(conn)
+            raise ConnectionError("Could not get a working database connection")
+        except Exception as e:
+            self.available.release()
+            if isinstance(e, ConnectionError):
+                raise
+            raise ConnectionError(f"Could not connect to database: {e}")
+
+    def putconn(self, conn: psycopg2.extensions.connection, close: bool = False) -> None:
+        try:
+            if not close and not conn.closed:
+                # Never hand out a connection in the middle of a transaction
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self.last_used[id(conn)] = time.monotonic()
+        except psycopg2.Error:
+            close = True
+        finally:
+            if close or conn.closed:
+                self._close(conn)
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+            self.available.release()
+
+    def _close(self, conn: psycopg2.extensions.connection) -> None:
+        self.last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn: psycopg2.extensions.connection) -> bool:
+        if conn.closed:
+            return False
+
+        last_used = self.last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < HEALTH_CHECK_AFTER:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def closeall(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self._close(conn)
+
+
+# By url and size, callers asking for another size get a pool of their own
+_pools: dict[tuple[str, int], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_url: str, size: int = DEFAULT_POOL_SIZE) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get((db_url, size))
+        if pool is None:
+            pool = _pools[(db_url, size)] = ConnectionPool(db_url, size)
+        return pool
+
+@contextmanager
+def connection(db_url: str, size: int = DEFAULT_POOL_SIZE) -> Iterator[psycopg2.extensions.connection]:
+    """
+    Borrow a connection from the pool of `db_url`.
+
+    The connection always goes back to the pool, rolled back if the block raised,
+    and discarded if it was broken.
+    """
+    pool = get_pool(db_url, size)
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+def remote_connection(config: dict):
+    """Borrow a connection to the remote database (`db_url_remote`) of a user config"""
+    return connection(config["db_url_remote"], int(config.get("db_pool_size", DEFAULT_POOL_SIZE)))
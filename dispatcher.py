@@ -0,0 +1,30 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+from typing import Callable, Iterable
+
+WSGIApp = Callable[[dict, Callable], Iterable[bytes]]
+
+
+class PrefixDispatcher:
+    """
+    WSGI middleware sending the requests under `prefixes` to `app` and every
+    other request (tiles, WMTS, WMS) straight to the app returned by `get_default`.
+
+    The environ is passed on untouched and the response iterable is returned as is,
+    so the WSGI server streams it and calls its `close()`.
+    """
+    def __init__(self, app: WSGIApp, prefixes: list[str], get_default: Callable[[], WSGIApp]):
+        self.app = app
+        self.prefixes = tuple(prefix.rstrip("/") for prefix in prefixes)
+        self.get_default = get_default
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        path = environ.get("PATH_INFO", "")
+        for prefix in self.prefixes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.app(environ, start_response)
+        return self.get_default()(environ, start_response)
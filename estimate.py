@@ -0,0 +1,137 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import json
+import math
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import shapely
+from mapproxy.srs import SRS
+from shapely.geometry.base import BaseGeometry
+
+# MapProxy defaults, make_config does not override them
+TILE_SIZE = (256, 256)
+META_SIZE = (4, 4)
+
+# Folder (under the temp folder) with the statistics of the last seeds of each config
+SEED_STATS_FOLDER = "seed_stats"
+SEED_STATS_KEPT = 20
+
+# Meta tiles tested against a geometry at once
+CHUNK_SIZE = 1_000_000
+
+
+def to_grid_srs(geometry: BaseGeometry, srs: str, grid_srs: str) -> BaseGeometry:
+    """`geometry` in `srs` transformed to the srs of the grid"""
+    if srs == grid_srs:
+        return geometry
+    source, target = SRS(srs), SRS(grid_srs)
+    return shapely.transform(geometry, lambda coords: np.array(source.transform_to(target, [tuple(c) for c in coords])))
+
+def level_tile_counts(geometry: BaseGeometry, grid: dict, res: list[float], levels: list[int]) -> dict[int, int]:
+    """
+    Number of tiles MapProxy writes when seeding `geometry` at each of `levels`: every
+    tile of the meta tiles whose extent intersects the geometry, as the seeder walks them.
+    """
+    minx, miny, maxx, maxy = grid["bbox"]
+    top_origin = grid.get("origin") in ("ul", "nw")
+    gminx, gminy, gmaxx, gmaxy = geometry.bounds
+    shapely.prepare(geometry)
+
+    counts = {}
+    for level in levels:
+        tile_width, tile_height = res[level] * TILE_SIZE[0], res[level] * TILE_SIZE[1]
+        # Tiles fully inside the grid bbox, MapProxy drops a last column or row below rounding noise
+        cols = math.ceil((maxx - minx) / tile_width - 1e-9)
+        rows = math.ceil((maxy - miny) / tile_height - 1e-9)
+        meta_width, meta_height = tile_width * META_SIZE[0], tile_height * META_SIZE[1]
+        meta_cols, meta_rows = math.ceil(cols / META_SIZE[0]), math.ceil(rows / META_SIZE[1])
+
+        # Meta tiles within the bounds of the geometry
+        col_start = max(0, math.floor((gminx - minx) / meta_width))
+        col_end = min(meta_cols - 1, math.floor((gmaxx - minx) / meta_width))
+        if top_origin:
+            row_start = max(0, math.floor((maxy - gmaxy) / meta_height))
+            row_end = min(meta_rows - 1, math.floor((maxy - gminy) / meta_height))
+        else:
+            row_start = max(0, math.floor((gminy - miny) / meta_height))
+            row_end = min(meta_rows - 1, math.floor((gmaxy - miny) / meta_height))
+        if col_start > col_end or row_start > row_end:
+            counts[level] = 0
+            continue
+
+        meta_cols_range = np.arange(col_start, col_end + 1)
+        # Tiles of each meta tile column and row, smaller along the grid edges
+        tiles_x = np.minimum(META_SIZE[0], cols - meta_cols_range * META_SIZE[0])
+        box_minx = minx + meta_cols_range * meta_width
+        box_maxx = box_minx + tiles_x * tile_width
+
+        total = 0
+        rows_per_chunk = max(1, CHUNK_SIZE // len(meta_cols_range))
+        for chunk_start in range(row_start, row_end + 1, rows_per_chunk):
+            meta_rows_range = np.arange(chunk_start, min(row_end + 1, chunk_start + rows_per_chunk))
+            tiles_y = np.minimum(META_SIZE[1], rows - meta_rows_range * META_SIZE[1])
+            if top_origin:
+                box_maxy = maxy - meta_rows_range * meta_height
+                box_miny = box_maxy - tiles_y * tile_height
+            else:
+                box_miny = miny + meta_rows_range * meta_height
+                box_maxy = box_miny + tiles_y * tile_height
+
+            boxes = shapely.box(box_minx[None, :], box_miny[:, None], box_maxx[None, :], box_maxy[:, None])
+            hits = shapely.intersects(boxes, geometry)
+            total += int((hits * tiles_y[:, None] * tiles_x[None, :]).sum())
+        counts[level] = total
+    return counts
+
+
+def record_seed_stats(folder: str, config_name: str, stats: dict) -> None:
+    """Keep the statistics of a finished seed, the estimates are based on the last ones"""
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    history = read_seed_stats(folder, config_name)
+    history.append({"time": time.time(), **stats})
+
+    path = os.path.join(folder, f"{config_name}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(history[-SEED_STATS_KEPT:], f)
+    os.replace(tmp_path, path)
+
+def read_seed_stats(folder: str, config_name: str) -> list[dict]:
+    try:
+        with open(os.path.join(folder, f"{config_name}.json"), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def estimate_seed(tile_counts: dict[str, dict[int, int]], history: list[dict], workers: int) -> dict:
+    """
+    Totals of the tile counts of each tilecluster, with the disk use and duration expected
+    from the throughput of the seeds in `history` (None without any usable seed).
+    """
+    levels: dict[int, int] = {}
+    for counts in tile_counts.values():
+        for level, count in counts.items():
+            levels[level] = levels.get(level, 0) + count
+    tiles = sum(levels.values())
+
+    seeds = [stats for stats in history if stats.get("tiles") and stats.get("seconds")]
+    written = sum(stats["tiles"] for stats in seeds)
+    bytes_per_tile = sum(stats.get("bytes", 0) for stats in seeds) / written if written else None
+    # Tiles per second of a single seeding worker
+    tiles_per_second = written / sum(stats["seconds"] for stats in seeds) if written else None
+
+    return {
+        "tiles": tiles,
+        "levels": levels,
+        "tileclusters": tile_counts,
+        "disk_bytes": round(tiles * bytes_per_tile) if bytes_per_tile is not None else None,
+        "seconds": round(tiles / (tiles_per_second * max(1, workers)), 1) if tiles_per_second else None,
+        "based_on_seeds": len(seeds),
+    }
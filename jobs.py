@@ -0,0 +1,202 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import fcntl
+import json
+import os
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Callable
+
+import metrics
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# Finished jobs are reported for this many seconds, and only the most recent ones
+FINISHED_JOBS_MAX_AGE = 7 * 24 * 3600
+FINISHED_JOBS_KEPT = 200
+
+class JobCancelled(Exception):
+    pass
+
+@dataclass
+class Job:
+    """
+    State of a background seeding job.
+
+    The state is persisted as JSON in the jobs folder so that any uWSGI worker
+    can report it, not only the one running the job. Cancellation is requested
+    by dropping a `{id}.cancel` marker next to it.
+    """
+    id: str
+    kind: str
+    config: str
+    folder: str = field(repr=False)
+    pid: int = field(default_factory=os.getpid)
+    status: str = QUEUED
+    phase: str | None = None
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    total_tileclusters: int = 0
+    done_tileclusters: int = 0
+    current_tilecluster: str | None = None
+    result: str | None = None
+    error: str | None = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.folder, f"{self.id}.json")
+
+    @property
+    def cancel_path(self) -> str:
+        return os.path.join(self.folder, f"{self.id}.cancel")
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        del data["folder"]
+        end = self.finished or time.time()
+        data["elapsed"] = end - self.started if self.started else 0.0
+        data["progress"] = self.done_tileclusters / self.total_tileclusters if self.total_tileclusters else 0.0
+        return data
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.path)
+
+    def check_cancelled(self) -> None:
+        if os.path.exists(self.cancel_path):
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def set_phase(self, phase: str) -> None:
+        self.check_cancelled()
+        self.phase = phase
+        self.save()
+
+    def update_progress(self, done: int, total: int, tilecluster_id: str | None) -> None:
+        """Progress callback for `seeding.seed`, raises `JobCancelled` when a cancel was requested"""
+        self.check_cancelled()
+        self.done_tileclusters = done
+        self.total_tileclusters = total
+        self.current_tilecluster = tilecluster_id
+        self.save()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Runs seeding jobs on a small background thread pool, outside the request threads.
+    """
+    def __init__(self, jobs_folder: str, max_workers: int = 1):
+        self.jobs_folder = jobs_folder
+        Path(jobs_folder).mkdir(parents=True, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="seeding-job")
+
+    def submit(self, kind: str, config: str, func: Callable[[Job], str]) -> Job:
+        # Every uWSGI worker submits jobs, only one of them may find no active job of the config
+        with open(os.path.join(self.jobs_folder, "submit.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            active = self.active_job(config)
+            if active is not None:
+                raise RuntimeError(f"Job {active['id']} ({active['kind']}) is already {active['status']} for config {config}")
+
+            job = Job(id=uuid.uuid4().hex, kind=kind, config=config, folder=self.jobs_folder)
+            job.save()
+            self.prune()
+        self.executor.submit(self._run, job, func)
+        return job
+
+    def prune(self) -> None:
+        """Remove the finished jobs older than `FINISHED_JOBS_MAX_AGE` or past the `FINISHED_JOBS_KEPT` most recent ones"""
+        now = time.time()
+        finished = [job for job in self.list() if job["status"] not in ACTIVE_STATES]
+        for i, job in enumerate(finished):
+            if i >= FINISHED_JOBS_KEPT or now - (job["finished"] or job["created"]) > FINISHED_JOBS_MAX_AGE:
+                for path in (f"{job['id']}.json", f"{job['id']}.cancel"):
+                    Path(os.path.join(self.jobs_folder, path)).unlink(missing_ok=True)
+
+    def _run(self, job: Job, func: Callable[[Job], str]) -> None:
+        job.status = RUNNING
+        job.started = time.time()
+        job.save()
+        try:
+            job.check_cancelled()
+            job.result = func(job)
+            job.status = DONE
+        except JobCancelled as e:
+            print(e)
+            job.status = CANCELLED
+        except Exception as e:
+            print(traceback.format_exc())
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            job.current_tilecluster = None
+            job.save()
+            metrics.inc("seeding_jobs_total", {"config": job.config, "kind": job.kind, "status": job.status})
+            metrics.flush()
+
+    def get(self, job_id: str) -> dict | None:
+        # Job ids are uuid hex strings, reject anything that could escape the jobs folder
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.jobs_folder, f"{job_id}.json"), "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        # The worker that owned the job died (uWSGI reload, crash) before finishing it
+        if data["status"] in ACTIVE_STATES and not _pid_alive(data["pid"]):
+            data["status"] = FAILED
+            data["error"] = "Worker process exited before the job finished"
+        return data
+
+    def list(self, config: str | None = None) -> list[dict]:
+        jobs = []
+        for file in os.listdir(self.jobs_folder):
+            if not file.endswith(".json"):
+                continue
+            data = self.get(file[:-len(".json")])
+            if data is not None and (config is None or data["config"] == config):
+                jobs.append(data)
+        return sorted(jobs, key=lambda job: job["created"], reverse=True)
+
+    def active_job(self, config: str) -> dict | None:
+        for job in self.list(config):
+            if job["status"] in ACTIVE_STATES:
+                return job
+        return None
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job["status"] not in ACTIVE_STATES:
+            return False
+        Path(os.path.join(self.jobs_folder, f"{job_id}.cancel")).touch()
+        return True
@@ -5,45 +5,84 @@ General Public License as published by the Free Software Foundation, either vers
 or (at your option) any later version.
 """
 
-import yaml
 import os
+import textwrap
 from pathlib import Path
+from typing import Iterator
 
+from mapproxy.config.loader import ProxyConfiguration, load_configuration
 
-def make_config(config: dict, remote_conn, generated_config_path: str, geom_path: str, file_name: str):
+import metrics
+import yaml_io
+from seeding import VIEW_REFRESH_ONCE, seed_config_file, tilecluster_filter, view_refresh_mode
+
+# Tile storage backends of the tilecluster caches
+CACHE_TYPES = ("file", "sqlite", "mbtiles", "geopackage", "compact")
+# Tileclusters dumped to the config at once
+DUMP_CHUNK_SIZE = 500
+# Folder with the tiles of every config
+TILES_PATH = os.environ.get("MAPPROXY_TILES_PATH", "/srv/qwc_service/mapproxy/tiles")
+
+
+def cache_options(config: dict, tiles_dir: str, tilecluster_id: str, grid_name: str) -> dict:
+    """
+    MapProxy `cache` options of a tilecluster cache, from the `cache` settings of the user
+    config (`type` plus any MapProxy option of that type, file by default).
+
+    Every tilecluster gets its own storage and, but for mbtiles, one file or folder per level.
+    """
+    cache_config = dict(config.get("cache") or {})
+    cache_type = cache_config.pop("type", "file")
+    # Apart from the file caches (`{tiles_dir}/{cache}/{grid}`), so both can live side by side while migrating
+    cache_dir = os.path.join(tiles_dir, cache_type, f"{tilecluster_id}_cache")
+
+    if cache_type == "file":
+        options = {"use_grid_names": True}
+    elif cache_type == "sqlite":
+        # One sqlite file per level, MapProxy adds the grid name to the directory
+        options = {"directory": cache_dir, "sqlite_wal": True}
+    elif cache_type == "mbtiles":
+        options = {"filename": os.path.join(cache_dir, f"{grid_name}.mbtiles"), "sqlite_wal": True}
+    elif cache_type == "geopackage":
+        # One geopackage per level, in a grid folder as well
+        options = {"directory": cache_dir, "levels": True, "table_name": tilecluster_id}
+    elif cache_type == "compact":
+        # Bundles of 128x128 tiles in one folder per level
+        options = {"directory": os.path.join(cache_dir, grid_name), "version": 2}
+    else:
+        raise ValueError(f"Unknown cache type: {cache_type}, expected one of {', '.join(CACHE_TYPES)}")
+
+    return {"type": cache_type, **options, **cache_config}
+
+
+def _chunks(tilecluster_ids: list[str]) -> Iterator[list[str]]:
+    for start in range(0, len(tilecluster_ids), DUMP_CHUNK_SIZE):
+        yield tilecluster_ids[start:start + DUMP_CHUNK_SIZE]
+
+def _dump(data: dict | list) -> str:
+    # Anchors are only unique within one dump, the chunks of a config can't share any
+    return yaml_io.dump(data, aliases=False, default_flow_style=False, sort_keys=False)
+
+def _dump_indented(data: dict | list) -> str:
+    # Entries of a top level key of the config
+    return textwrap.indent(_dump(data), "  ")
+
+
+def make_config(config: dict, remote_conn, generated_config_path: str, geom_path: str, file_name: str) -> ProxyConfiguration:
+    """Write the MapProxy config of `file_name` and its seeding variant, returns the config as MapProxy loaded it"""
+    with metrics.phase(file_name, "make_config"):
+        return _make_config(config, remote_conn, generated_config_path, geom_path, file_name)
+
+def _make_config(config: dict, remote_conn, generated_config_path: str, geom_path: str, file_name: str) -> ProxyConfiguration:
     remote_cursor = remote_conn.cursor()
     generated_config_file = os.path.join(generated_config_path, f"{file_name}.yaml")
+    seed_config = seed_config_file(generated_config_path, file_name)
 
     grid_name = "main_grid"
-
-    output = {
-        "services": {
-            "demo": None,
-            "wmts": {
-                "restful_template": "/tiles/{Layer}/{TileMatrixSet}/{TileMatrix}/{TileCol}/{TileRow}.{Format}"
-            },
-        },
-        "layers": [],
-        "caches": {},
-        "sources": {},
-        "grids": {
-            grid_name: {
-                "name": grid_name,
-                "srs": config["grid"]["srs"],
-                "origin": config["grid"]["origin"],
-                "res": list(config["res"]), # Without the list it generats weird stuff
-                "bbox": config["grid"]["bbox"],
-            }
-        },
-        "globals": {
-            "cache": {
-                "base_dir": f'/srv/qwc_service/mapproxy/tiles/{file_name}'
-            }
-        }
-    }
+    tiles_dir = os.path.join(TILES_PATH, file_name)
 
     remote_cursor.execute(f'SELECT tilecluster_id FROM {config["tileclusters_table"]}')
-    tilecluster_data = remote_cursor.fetchall()
+    tilecluster_ids = [tilecluster_id for tilecluster_id, in remote_cursor.fetchall()]
 
     additional_source = config["sources"].get("additional_source", None)
     additional_schema = config.get("additional_schema", None)
@@ -51,9 +90,29 @@ def make_config(config: dict, remote_conn, generated_config_path: str, geom_path
     if bool(additional_source) != bool(additional_schema):
         raise ValueError("Both 'additional_sources' and 'additional_schema' must be provided or neither.")
 
-    for tilecluster_id, in tilecluster_data:
-        print(tilecluster_id)
+    # With a single view refresh for the whole config, each source only renders its tilecluster
+    filter_sources = view_refresh_mode(config) == VIEW_REFRESH_ONCE
+
+    def layer(tilecluster_id: str) -> dict:
+        return {
+            "name": tilecluster_id,
+            "title": tilecluster_id,
+            "tile_sources": [f"{tilecluster_id}_cache"],
+        }
+
+    def cache(tilecluster_id: str) -> dict:
+        cache = {
+            "cache": cache_options(config, tiles_dir, tilecluster_id, grid_name),
+            "disable_storage": False,
+            "sources": [f"{tilecluster_id}_source"],
+            "grids": [grid_name],
+        }
+        if cache["cache"]["type"] == "file":
+            # Blank and uniform tiles are stored once and symlinked to, `hardlink` saves their inodes too
+            cache["link_single_color_images"] = config.get("link_single_color_images", True)
+        return cache
 
+    def source(tilecluster_id: str) -> dict:
         source = config["sources"]["inventory_source"]
         if additional_source:
             is_additional_schema = False
@@ -68,13 +127,17 @@ def make_config(config: dict, remote_conn, generated_config_path: str, geom_path
             if is_additional_schema:
                 source = additional_source
 
-        output["sources"][f"{tilecluster_id}_source"] = {
+        req = {
+            "transparent": True,
+            **source,
+        }
+        if filter_sources:
+            req["filter"] = tilecluster_filter(config, tilecluster_id)
+
+        return {
             "type": "wms",
             "seed_only": True,
-            "req": {
-                "transparent": True,
-                **source,
-            },
+            "req": req,
             "coverage": {
                 "srs": config["crs"],
                 "datasource": os.path.join(geom_path, f'{tilecluster_id}.wkt'),
@@ -83,22 +146,76 @@ def make_config(config: dict, remote_conn, generated_config_path: str, geom_path
                 "featureinfo": True,
             }
         }
-        output["caches"][f"{tilecluster_id}_cache"] = {
-            "cache": {
-                "type": "file",
-                "use_grid_names": True,
-            },
-            "disable_storage": False,
-            "sources": [f"{tilecluster_id}_source"],
-            "grids": [grid_name],
-        }
-
-        output["layers"].append({
-            "name": tilecluster_id,
-            "title": tilecluster_id,
-            "tile_sources": [f"{tilecluster_id}_cache"],
-        })
 
     Path(generated_config_path).mkdir(parents=True, exist_ok=True)
-    with open(generated_config_file, "w") as f:
-        f.write(yaml.dump(output, default_flow_style=False, sort_keys=False))
+    Path(seed_config).parent.mkdir(parents=True, exist_ok=True)
+
+    # MapProxy reloads a config as soon as its file changes, only a complete and valid
+    # config may take the place of the one being served
+    tmp_config_file = f"{generated_config_file}.{os.getpid()}.tmp"
+    tmp_seed_config = f"{seed_config}.{os.getpid()}.tmp"
+    try:
+        # The serving config and its seeding variant are written side by side, a chunk of
+        # tileclusters at a time, instead of dumping (and reparsing) whole configs
+        with open(tmp_config_file, "w") as config_out, open(tmp_seed_config, "w") as seed_out:
+            def write(text: str) -> None:
+                config_out.write(text)
+                seed_out.write(text)
+
+            write(_dump({
+                "services": {
+                    "demo": None,
+                    "wmts": {
+                        "restful_template": "/tiles/{Layer}/{TileMatrixSet}/{TileMatrix}/{TileCol}/{TileRow}.{Format}"
+                    },
+                },
+            }))
+
+            write("layers:\n" if tilecluster_ids else "layers: []\n")
+            for chunk in _chunks(tilecluster_ids):
+                for tilecluster_id in chunk:
+                    print(tilecluster_id)
+                write(_dump_indented([layer(tilecluster_id) for tilecluster_id in chunk]))
+
+            write("caches:\n" if tilecluster_ids else "caches: {}\n")
+            for chunk in _chunks(tilecluster_ids):
+                write(_dump_indented({f"{tilecluster_id}_cache": cache(tilecluster_id) for tilecluster_id in chunk}))
+
+            write("sources:\n" if tilecluster_ids else "sources: {}\n")
+            for chunk in _chunks(tilecluster_ids):
+                sources = {f"{tilecluster_id}_source": source(tilecluster_id) for tilecluster_id in chunk}
+                config_out.write(_dump_indented(sources))
+                # Seeding covers the whole grid, the seed coverage restricts it to the tilecluster
+                for seed_source in sources.values():
+                    seed_source["coverage"] = {"bbox": list(config["grid"]["bbox"]), "srs": config["crs"]}
+                seed_out.write(_dump_indented(sources))
+
+            write(_dump({
+                "grids": {
+                    grid_name: {
+                        "name": grid_name,
+                        "srs": config["grid"]["srs"],
+                        "origin": config["grid"]["origin"],
+                        "res": list(config["res"]), # Without the list it generats weird stuff
+                        "bbox": config["grid"]["bbox"],
+                    }
+                },
+                "globals": {
+                    "cache": {
+                        "base_dir": tiles_dir
+                    }
+                }
+            }))
+
+        mapproxy_conf = load_configuration(tmp_config_file)
+        os.replace(tmp_config_file, generated_config_file)
+        # Loaded from the temporary file, it is outdated once the file it replaced changes
+        mapproxy_conf.configuration["__config_files__"] = {
+            os.path.abspath(generated_config_file): os.path.getmtime(generated_config_file)
+        }
+        # Replaced last, so it is never older than the config it was written with
+        os.replace(tmp_seed_config, seed_config)
+    finally:
+        Path(tmp_config_file).unlink(missing_ok=True)
+        Path(tmp_seed_config).unlink(missing_ok=True)
+    return mapproxy_conf
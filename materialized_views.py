@@ -0,0 +1,142 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import metrics
+from db import connection
+
+DEFAULT_REFRESH_CONCURRENCY = 4
+
+# Materialized views (among the given ones) each view reads from, directly or through plain views
+DEPENDENCIES_QUERY = """
+WITH RECURSIVE deps(view_oid, ref_oid) AS (
+    SELECT r.ev_class, d.refobjid
+    FROM pg_rewrite r
+    JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid AND d.refclassid = 'pg_class'::regclass
+    WHERE r.ev_class = ANY(%(views)s::oid[]) AND d.refobjid <> r.ev_class
+  UNION
+    SELECT deps.view_oid, d.refobjid
+    FROM deps
+    JOIN pg_rewrite r ON r.ev_class = deps.ref_oid
+    JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid AND d.refclassid = 'pg_class'::regclass
+    WHERE deps.ref_oid <> ALL(%(views)s::oid[]) AND d.refobjid <> r.ev_class
+)
+SELECT DISTINCT view_oid, ref_oid FROM deps WHERE ref_oid = ANY(%(views)s::oid[]) AND ref_oid <> view_oid
+"""
+
+# REFRESH ... CONCURRENTLY needs a populated view with a plain unique index
+VIEWS_QUERY = """
+SELECT v.name, c.oid, c.relispopulated AND EXISTS (
+    SELECT 1 FROM pg_index i
+    WHERE i.indrelid = c.oid AND i.indisunique AND i.indisvalid AND i.indpred IS NULL AND i.indexprs IS NULL
+)
+FROM unnest(%s::text[]) WITH ORDINALITY AS v(name, n)
+JOIN pg_class c ON c.oid = v.name::regclass
+ORDER BY v.n
+"""
+
+
+@dataclass
+class RefreshPlan:
+    """
+    Materialized views to refresh, with the views each one has to wait for.
+    """
+    views: list[str]
+    dependencies: dict[str, set[str]]
+    concurrently: dict[str, bool]
+
+    @classmethod
+    def load(cls, cursor, views: list[str]) -> "RefreshPlan":
+        cursor.execute(VIEWS_QUERY, (views,))
+        rows = cursor.fetchall()
+        names = {oid: name for name, oid, _ in rows}
+        concurrently = {name: bool(can_concurrently) for name, _, can_concurrently in rows}
+
+        dependencies: dict[str, set[str]] = {view: set() for view in views}
+        cursor.execute(DEPENDENCIES_QUERY, {"views": list(names)})
+        for view_oid, ref_oid in cursor.fetchall():
+            dependencies[names[view_oid]].add(names[ref_oid])
+
+        return cls(views, dependencies, concurrently)
+
+    def refresh(self, conn, db_url: str, concurrency: int = DEFAULT_REFRESH_CONCURRENCY) -> dict[str, float]:
+        """
+        Refresh every view once all the views it depends on are refreshed, independent
+        views in parallel on their own connections from the pool of `db_url`.
+        Returns the time spent on each view.
+
+        With a concurrency of 1 the views are refreshed in order on `conn` instead.
+        The caller must have committed its selectors, other connections only see committed data.
+        """
+        if concurrency <= 1:
+            return {view: self._refresh_view(conn, view) for view in self._ordered()}
+
+        timings: dict[str, float] = {}
+        pending = {view: set(deps) for view, deps in self.dependencies.items()}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="refresh-view") as executor:
+            while pending or running:
+                for view in [view for view, deps in pending.items() if not deps]:
+                    del pending[view]
+                    running[executor.submit(self._refresh_view_pooled, db_url, view, metrics.current_phase())] = view
+
+                if not running:
+                    raise ValueError(f"Circular dependency between materialized views: {', '.join(pending)}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    view = running.pop(future)
+                    timings[view] = future.result()
+                    for deps in pending.values():
+                        deps.discard(view)
+
+        return timings
+
+    def _ordered(self) -> list[str]:
+        ordered: list[str] = []
+        pending = {view: set(deps) for view, deps in self.dependencies.items()}
+        while pending:
+            ready = [view for view, deps in pending.items() if not deps]
+            if not ready:
+                raise ValueError(f"Circular dependency between materialized views: {', '.join(pending)}")
+            for view in ready:
+                del pending[view]
+                ordered.append(view)
+            for deps in pending.values():
+                deps.difference_update(ready)
+        return ordered
+
+    def _refresh_view_pooled(self, db_url: str, view: str, phase: tuple[str, str] | None = None) -> float:
+        with metrics.in_phase(phase), connection(db_url) as conn:
+            return self._refresh_view(conn, view)
+
+    def _refresh_view(self, conn, view: str) -> float:
+        start_time = time.perf_counter()
+        concurrently = "CONCURRENTLY " if self.concurrently.get(view) else ""
+        with conn.cursor() as cursor:
+            cursor.execute(f"REFRESH MATERIALIZED VIEW {concurrently}{view}")
+        conn.commit()
+
+        seconds = time.perf_counter() - start_time
+        print(f"Refreshed materialized view {view} {concurrently.lower()}in {seconds:.2f}s")
+        return seconds
+
+
+def refresh_concurrency(config: dict) -> int:
+    return int(config.get("view_refresh_concurrency", DEFAULT_REFRESH_CONCURRENCY))
+
+def refresh_materialized_views(conn, db_url: str, views: list[str], concurrency: int = DEFAULT_REFRESH_CONCURRENCY) -> dict[str, float]:
+    """Work out the dependencies between `views` and refresh them, see `RefreshPlan.refresh`"""
+    if not views:
+        return {}
+    with conn.cursor() as cursor:
+        plan = RefreshPlan.load(cursor, views)
+    conn.commit()
+    return plan.refresh(conn, db_url, concurrency)
@@ -0,0 +1,265 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+# Name: (type, help) of every metric, rendered in this order
+METRICS = {
+    "seeding_phase_seconds": ("summary", "Time spent in each seeding phase"),
+    "seeding_db_round_trips_total": ("counter", "Statements sent to the database, by seeding phase"),
+    "seeding_tiles_total": ("counter", "Tiles seeded"),
+    "seeding_tilecluster_tiles_per_second": ("gauge", "Tiles per second of the last seed of each tilecluster"),
+    "seeding_tilecluster_failures_total": ("counter", "Tileclusters whose seed failed"),
+    "seeding_source_requests_total": ("counter", "WMS renders requested while seeding"),
+    "seeding_source_errors_total": ("counter", "WMS renders that failed or timed out while seeding"),
+    "seeding_jobs_total": ("counter", "Finished seeding jobs, by kind and status"),
+    "tile_request_seconds": ("histogram", "Time to serve a WMTS tile, by config, layer and zoom level"),
+    "tile_response_bytes": ("summary", "Size of the served WMTS tiles"),
+    "tile_responses_total": ("counter", "Served WMTS tiles, by status"),
+    "tile_cache_total": ("counter", "Served WMTS tiles, by origin (memory cache, tile file, rendered, unknown)"),
+    "tile_empty_total": ("counter", "Served WMTS tiles that are empty or fully transparent"),
+}
+
+# Seconds between two writes of the metrics of a process, see `flush`
+FLUSH_INTERVAL = 1.0
+# Metrics of the processes that exited, their counters keep adding up
+RETIRED_FILE = "retired.json"
+
+Labels = tuple[tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, Labels], float] = {}
+# Value and time it was set, the most recent one wins across processes
+_gauges: dict[tuple[str, Labels], tuple[float, float]] = {}
+_folder: str | None = None
+_started = time.time()
+_current = threading.local()
+# Functions returning (name, labels, value) counter samples kept by other modules
+_collectors: list[Callable[[], Iterable[tuple[str, dict[str, str], float]]]] = []
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+_flush_timer: threading.Timer | None = None
+
+
+def configure(folder: str) -> None:
+    """
+    Share the metrics of every process (uWSGI workers) through `folder`: each process
+    writes its own file, the metrics endpoint adds them up.
+    """
+    global _folder
+    os.makedirs(folder, exist_ok=True)
+    _folder = folder
+
+def register_collector(collector: Callable[[], Iterable[tuple[str, dict[str, str], float]]]) -> None:
+    """Add the counter samples of `collector` to the metrics, for modules keeping their own"""
+    _collectors.append(collector)
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name: str, labels: dict[str, str], value: float = 1) -> None:
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name: str, labels: dict[str, str], value: float) -> None:
+    with _lock:
+        _gauges[(name, _labels(labels))] = (value, time.time())
+
+def observe(name: str, labels: dict[str, str], value: float) -> None:
+    """Add `value` to a summary"""
+    inc(f"{name}_sum", labels, value)
+    inc(f"{name}_count", labels)
+
+def count_round_trip(statements: int = 1) -> None:
+    """Count statements sent to the database in the phase running on this thread"""
+    config, phase = getattr(_current, "phase", ("", "other"))
+    inc("seeding_db_round_trips_total", {"config": config, "phase": phase}, statements)
+
+def current_phase() -> tuple[str, str] | None:
+    return getattr(_current, "phase", None)
+
+@contextmanager
+def in_phase(current: tuple[str, str] | None) -> Iterator[None]:
+    """Run a block on another thread as part of the phase of the thread that started it"""
+    previous = getattr(_current, "phase", None)
+    if current is not None:
+        _current.phase = current
+    try:
+        yield
+    finally:
+        if previous is None:
+            _current.__dict__.pop("phase", None)
+        else:
+            _current.phase = previous
+
+@contextmanager
+def phase(config: str, name: str) -> Iterator[None]:
+    """Time a seeding phase of a config, with the database statements sent during it"""
+    start_time = time.perf_counter()
+    try:
+        with in_phase((config, name)):
+            yield
+    finally:
+        observe("seeding_phase_seconds", {"config": config, "phase": name}, time.perf_counter() - start_time)
+        flush()
+
+
+def _file_name() -> str:
+    return f"{os.getpid()}-{int(_started)}.json"
+
+def _snapshot() -> dict:
+    with _lock:
+        snapshot = {
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            "gauges": [[name, dict(labels), value, set_time] for (name, labels), (value, set_time) in _gauges.items()],
+        }
+    for collector in _collectors:
+        snapshot["counters"].extend([name, labels, value] for name, labels, value in collector())
+    return snapshot
+
+def _write(path: str, snapshot: dict) -> None:
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write metrics to {path}: {e}")
+
+def flush(force: bool = False) -> None:
+    """
+    Write the metrics of this process for the other ones, at most once every
+    `FLUSH_INTERVAL` seconds unless `force`. A skipped write is done at the end of the interval.
+    """
+    global _last_flush, _flush_timer
+    if _folder is None:
+        return
+    with _flush_lock:
+        wait = _last_flush + FLUSH_INTERVAL - time.monotonic()
+        if wait > 0 and not force:
+            # Threads do not survive a fork, neither does the timer of the parent process
+            if _flush_timer is None or not _flush_timer.is_alive():
+                _flush_timer = threading.Timer(wait, flush, kwargs={"force": True})
+                _flush_timer.daemon = True
+                _flush_timer.start()
+            return
+        _last_flush = time.monotonic()
+        _write(os.path.join(_folder, _file_name()), _snapshot())
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels) + "}"
+    return f"{name} {value:g}" if value != int(value) else f"{name} {int(value)}"
+
+def _metric_name(name: str) -> str:
+    return name.removesuffix("_bucket").removesuffix("_sum").removesuffix("_count")
+
+def _sort_key(item: tuple[tuple[str, Labels], float]) -> tuple:
+    # Histogram buckets go in increasing order of their bound, after the other labels
+    (name, labels), _ = item
+    bound = dict(labels).get("le")
+    return (
+        _metric_name(name), tuple(label for label in labels if label[0] != "le"), name,
+        float(bound) if bound is not None else 0.0,
+    )
+
+def _read(file_name: str) -> dict | None:
+    try:
+        with open(os.path.join(_folder, file_name), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _merge(snapshots: Iterable[dict]) -> tuple[dict[tuple[str, Labels], float], dict[tuple[str, Labels], tuple[float, float]]]:
+    counters: dict[tuple[str, Labels], float] = {}
+    gauges: dict[tuple[str, Labels], tuple[float, float]] = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, _labels(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value, set_time in snapshot["gauges"]:
+            key = (name, _labels(labels))
+            if key not in gauges or gauges[key][1] < set_time:
+                gauges[key] = (value, set_time)
+    return counters, gauges
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _retire_exited() -> None:
+    """Merge the files of the processes that exited into `RETIRED_FILE`"""
+    with open(os.path.join(_folder, "retire.lock"), "w") as lock_file:
+        # Released when the file is closed
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        files: list[tuple[str, int, int]] = []
+        newest: dict[int, int] = {}
+        for file_name in os.listdir(_folder):
+            pid, _, started = file_name.removesuffix(".json").partition("-")
+            if not file_name.endswith(".json") or not pid.isdigit() or not started.isdigit():
+                continue
+            files.append((file_name, int(pid), int(started)))
+            newest[int(pid)] = max(newest.get(int(pid), 0), int(started))
+        # A pid can be reused, only the process that started last may still be running
+        exited = [file_name for file_name, pid, started in files if started < newest[pid] or not _process_alive(pid)]
+        if not exited:
+            return
+
+        counters, gauges = _merge(snapshot for file_name in [RETIRED_FILE, *exited] if (snapshot := _read(file_name)) is not None)
+        _write(os.path.join(_folder, RETIRED_FILE), {
+            "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+            "gauges": [[name, dict(labels), value, set_time] for (name, labels), (value, set_time) in gauges.items()],
+        })
+        for file_name in exited:
+            try:
+                os.unlink(os.path.join(_folder, file_name))
+            except FileNotFoundError:
+                pass
+
+def render() -> str:
+    """Metrics of every process, in the Prometheus text format"""
+    snapshots = [_snapshot()]
+    if _folder is not None:
+        _retire_exited()
+        own_file = _file_name()
+        for file_name in os.listdir(_folder):
+            if not file_name.endswith(".json") or file_name == own_file:
+                continue
+            if (snapshot := _read(file_name)) is not None:
+                snapshots.append(snapshot)
+
+    counters, gauges = _merge(snapshots)
+
+    samples: dict[str, list[str]] = {}
+    for (name, labels), value in sorted(counters.items(), key=_sort_key):
+        samples.setdefault(_metric_name(name), []).append(_format(name, labels, value))
+    for (name, labels), (value, _) in sorted(gauges.items()):
+        samples.setdefault(name, []).append(_format(name, labels, value))
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        if name not in samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
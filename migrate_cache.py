@@ -0,0 +1,121 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# Copy the tiles of the file caches of a config into the cache backend its generated
+# config now uses (see `cache` in the user config and `make_conf.cache_options`).
+# Run it after generating the config with the new `cache` type, e.g.
+#
+#     python migrate_cache.py my_config --workers 8
+#
+# The file caches are left untouched, remove them once the new caches are checked.
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mapproxy.cache.file import FileCache
+from mapproxy.cache.tile import Tile
+from mapproxy.config.loader import load_configuration
+
+DEFAULT_GENERATED_CONFIG_PATH = "/srv/qwc_service/mapproxy/config/config-out"
+BATCH_SIZE = 256
+
+
+def file_cache_tiles(cache_dir: str):
+    """Internal coordinates and extension of every tile of a file cache with the `tc` layout"""
+    for dir_path, _, file_names in os.walk(cache_dir):
+        parts = os.path.relpath(dir_path, cache_dir).split(os.sep)
+        # zz/xxx/xxx/xxx/yyy/yyy
+        if len(parts) != 6:
+            continue
+        for file_name in file_names:
+            y_part, _, ext = file_name.partition(".")
+            if not y_part.isdigit():
+                continue
+            z = int(parts[0])
+            x = int(parts[1]) * 1000000 + int(parts[2]) * 1000 + int(parts[3])
+            y = int(parts[4]) * 1000000 + int(parts[5]) * 1000 + int(y_part)
+            yield (x, y, z), ext
+
+
+def migrate_cache(source_dir: str, dest_cache) -> int:
+    """Store every tile of the file cache in `source_dir` into `dest_cache`, returns the number of tiles"""
+    sources: dict[str, FileCache] = {}
+    batch: list[Tile] = []
+    count = 0
+
+    def flush():
+        nonlocal count
+        if not batch:
+            return
+        if not dest_cache.store_tiles(batch):
+            # The level caches of MapProxy (sqlite, geopackage with levels) report success as
+            # False, check every tile was written instead of trusting the result
+            missing = [tile.coord for tile in batch if not dest_cache.is_cached(Tile(tile.coord))]
+            if missing:
+                raise RuntimeError(
+                    f"Could not store {len(missing)} tiles of {source_dir} in {type(dest_cache).__name__}, "
+                    f"e.g. {missing[0]}"
+                )
+        count += len(batch)
+        batch.clear()
+
+    for coord, ext in file_cache_tiles(source_dir):
+        source = sources.get(ext)
+        if source is None:
+            source = sources[ext] = FileCache(source_dir, ext)
+        tile = Tile(coord)
+        if source.load_tile(tile):
+            batch.append(tile)
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    flush()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the file caches of a config to its configured cache backend")
+    parser.add_argument("config", help="Config name")
+    parser.add_argument("--generated-config-path", default=DEFAULT_GENERATED_CONFIG_PATH)
+    parser.add_argument("--workers", type=int, default=4, help="Caches migrated at once")
+    args = parser.parse_args()
+
+    config_file = os.path.join(args.generated_config_path, f"{args.config}.yaml")
+    mapproxy_conf = load_configuration(config_file)
+    base_dir = mapproxy_conf.globals.get_path("cache.base_dir", {})
+
+    migrations = []
+    for cache_name, cache_conf in mapproxy_conf.caches.items():
+        cache_type = cache_conf.conf.get("cache", {}).get("type", "file")
+        if cache_type == "file":
+            continue
+        for tile_grid, _, tile_manager in cache_conf.caches():
+            # Where `use_grid_names` file caches keep their tiles
+            source_dir = os.path.join(base_dir, cache_name, tile_grid.name)
+            if os.path.isdir(source_dir):
+                migrations.append((cache_name, cache_type, source_dir, tile_manager.cache))
+
+    if not migrations:
+        print(f"No file cache to migrate for {args.config}")
+        return
+
+    start_time = time.perf_counter()
+
+    def run(migration) -> int:
+        cache_name, cache_type, source_dir, dest_cache = migration
+        count = migrate_cache(source_dir, dest_cache)
+        print(f"{cache_name}: {count} tiles copied from {source_dir} to {cache_type}")
+        return count
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        total = sum(executor.map(run, migrations))
+
+    print(f"Migrated {total} tiles of {len(migrations)} caches in {time.perf_counter() - start_time:.2f}s")
+    print(f"The file caches under {base_dir} can be removed once the new caches are checked")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,35 @@ or (at your option) any later version.
 """
 import json
 from typing import Any, Callable
-import yaml
 import psycopg2
 import os
+import hashlib
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from dataclasses import dataclass
+from pathlib import Path
+
+from shapely import wkt
+from shapely.geometry.base import BaseGeometry
+from mapproxy.cache.file import FileCache
+from mapproxy.config.loader import ProxyConfiguration, load_configuration
+from mapproxy.seed.config import EmptyCoverageError, SeedingConfiguration
+from mapproxy.seed.util import ProgressLog
+from mapproxy.srs import SRS
+from mapproxy.util.coverage import Coverage, coverage as mapproxy_coverage
+
+from checkpoints import CheckpointLog, SeedCheckpoints
+from concurrency import ConcurrencyController, StoreStats, seed_tasks
+import metrics
+from db import connection
+from materialized_views import RefreshPlan, refresh_concurrency
+from estimate import SEED_STATS_FOLDER, record_seed_stats
+from tile_cache import TILE_CACHE_FOLDER, invalidate_tiles
+import yaml_io
 
 @dataclass
 class MapZone:
@@ -45,6 +70,123 @@ MAP_ZONES: dict[str, MapZone] = {
     ),
 }
 
+# Folder (under the generated config folder) with the seeding variant of each generated config
+SEED_CONFIG_FOLDER = "seed"
+
+# Folder of MapProxy's seeding log of each tilecluster
+SEED_LOG_PATH = os.environ.get("SEED_LOG_PATH", "/logs")
+
+# Scheduling priority of the seed worker threads and the tile workers they fork
+SEED_NICENESS = int(os.environ.get("SEED_NICENESS", 10))
+
+_thread_state = threading.local()
+
+def _lower_thread_priority():
+    # On Linux the nice value is per thread, inherited by forked processes and can't be
+    # raised back, only the worker threads of `seed` (gone once it returns) may call this
+    if not getattr(_thread_state, "niced", False):
+        os.nice(SEED_NICENESS)
+        _thread_state.niced = True
+
+# How the data of each tilecluster is produced for the WMS
+VIEW_REFRESH_PER_TILECLUSTER = "per_tilecluster"  # set its selectors and refresh every view
+VIEW_REFRESH_ONCE = "once"  # views refreshed once for the whole config, filtered by `tilecluster_filter`
+
+def view_refresh_mode(config: dict) -> str:
+    mode = config.get("view_refresh", VIEW_REFRESH_PER_TILECLUSTER)
+    if mode not in (VIEW_REFRESH_PER_TILECLUSTER, VIEW_REFRESH_ONCE):
+        raise ValueError(f"Unknown view_refresh mode: {mode}")
+    if mode == VIEW_REFRESH_ONCE and not config.get("tilecluster_filter"):
+        raise ValueError(f"view_refresh '{VIEW_REFRESH_ONCE}' needs a 'tilecluster_filter' to tell tileclusters apart")
+    return mode
+
+def tilecluster_filter(config: dict, tilecluster_id: str) -> str:
+    """
+    WMS `FILTER` restricting the rendered layers to one tilecluster, from the
+    `tilecluster_filter` template of the config, e.g.
+    `v_edit_arc,v_edit_node:"expl_id" = {expl_id} AND "sector_id" = {sector_id}`
+    """
+    values = {"tilecluster_id": tilecluster_id}
+    for mapzone, mapzone_id in parse_tilecluster(tilecluster_id).values():
+        values[mapzone.column] = mapzone_id
+    return config["tilecluster_filter"].format(**values)
+
+class SeedError(Exception):
+    def __init__(self, results: list["SeedResult"]):
+        self.results = results
+        failed = [result for result in results if result.error is not None]
+        super().__init__(
+            f"Seeding failed for {len(failed)} of {len(results)} tileclusters: "
+            + ", ".join(f"{result.tilecluster_id} ({result.error})" for result in failed)
+        )
+
+@dataclass
+class TileStats:
+    """Tiles written by a seed, `linked` ones only reference a single colour image"""
+    written: int = 0
+    linked: int = 0
+    bytes_written: int = 0
+    bytes_saved: int = 0
+
+    def add(self, other: "TileStats") -> None:
+        self.written += other.written
+        self.linked += other.linked
+        self.bytes_written += other.bytes_written
+        self.bytes_saved += other.bytes_saved
+
+@dataclass
+class SeedResult:
+    tilecluster_id: str
+    seconds: float
+    error: str | None = None
+    tiles: TileStats | None = None
+
+class InMemorySeedingConfiguration(SeedingConfiguration):
+    """
+    Seeding configuration whose coverages are already built `Coverage` objects
+    instead of coverage definitions to be loaded from files.
+    """
+    def __init__(self, seed_conf: dict, mapproxy_conf: ProxyConfiguration, coverages: dict[str, Coverage]):
+        super().__init__(seed_conf, mapproxy_conf)
+        self.coverages = coverages
+
+    def coverage(self, name):
+        if name not in self.coverages:
+            return super().coverage(name)
+
+        coverage = self.coverages[name]
+        if not coverage.extent.llbbox:
+            raise EmptyCoverageError(f"coverage '{name}' contains no geometries.")
+        return coverage
+
+def make_coverage(coverage_dict: dict) -> Coverage | None:
+    """
+    Build the MapProxy coverage of a seed.
+
+    Besides the MapProxy coverage options (`bbox`, `datasource`...), accepts a
+    `geometry` (shapely geometry or WKT) in `srs` so no temp file is needed.
+    """
+    if "geometry" not in coverage_dict:
+        return None
+
+    geometry = coverage_dict["geometry"]
+    if not isinstance(geometry, BaseGeometry):
+        geometry = wkt.loads(geometry)
+    return mapproxy_coverage(geometry, SRS(coverage_dict["srs"]), clip=coverage_dict.get("clip", False))
+
+def parse_levels(levels: str | int | list | None) -> list[int] | None:
+    """Zoom levels from a single level, a list, or a `from-to` range or comma separated string"""
+    if levels is None or levels == "":
+        return None
+    if isinstance(levels, int):
+        return [levels]
+    if isinstance(levels, list):
+        return [int(level) for level in levels]
+    if "-" in levels:
+        start, end = (int(level) for level in levels.split("-", 1))
+        return list(range(start, end + 1))
+    return [int(level) for level in levels.split(",")]
+
 def parse_tilecluster(tilecluster_id: str) -> dict[str, tuple[MapZone, str]]:
     mapzones: dict[str, tuple[MapZone, str]] = {}
     for part in tilecluster_id.split("-"):
@@ -59,140 +201,463 @@ def parse_tilecluster(tilecluster_id: str) -> dict[str, tuple[MapZone, str]]:
 
     return mapzones
 
-def seed(
-    config: dict,
-    remote_conn: psycopg2.extensions.connection,
-    generated_config_path: str,
-    temp_folder: str,
-    file_name: str,
-    coverage: dict | Callable[[str, dict[str, tuple[MapZone, str]]], dict | None]
-):
-    remote_cursor = remote_conn.cursor()
+def set_selectors(cursor, schema: str, clear_schemas: list[str], inputs: list[dict]) -> list[dict | None]:
+    """
+    Clear the current user's selectors in `clear_schemas` and call `gw_fct_setselectors`
+    with each of `inputs`, in order, all in a single round trip.
 
-    # Temp files (seed yaml and last seed time)
-    seed_yaml_file = os.path.join(temp_folder, f"{file_name}_seed.yaml")
+    Returns the result of every `gw_fct_setselectors` call.
+    """
+    statements = [
+        f"DELETE FROM {clear_schema}.{mapzone.table} WHERE cur_user = current_user"
+        for clear_schema in clear_schemas
+        for mapzone in MAP_ZONES.values()
+    ]
+    statements.append(
+        f"SELECT n, {schema}.gw_fct_setselectors(input::json) "
+        f"FROM unnest(%s::text[]) WITH ORDINALITY AS t(input, n)"
+    )
+    cursor.execute(";\n".join(statements), ([json.dumps(input) for input in inputs],))
+    results = [result for _, result in sorted(cursor.fetchall())]
 
-    # Generated seed config file
-    base_config_file = os.path.join(generated_config_path, f"{file_name}.yaml")
+    round_trips = len(statements) - 1 + len(inputs)
+    print(f"Selectors: {round_trips} statements sent in 1 round trip ({round_trips - 1} round trips saved)")
+    return results
+
+@dataclass
+class SeedSession:
+    """
+    Database session (and WMS request overrides) used to seed one tilecluster at a time.
+
+    Selector tables are scoped by `cur_user = current_user` and materialized views are
+    refreshed as their owner, so two tileclusters can only be prepared at the same time
+    from different login roles, each one refreshing its own views.
+    """
+    conn: psycopg2.extensions.connection | None
+    db_url: str | None
+    materialized_views: list[str]
+    mapproxy_conf: ProxyConfiguration
+    refresh_plan: RefreshPlan | None = None
+
+_mapproxy_confs: dict[str, tuple[float, ProxyConfiguration]] = {}
+_mapproxy_confs_lock = threading.Lock()
+
+def load_mapproxy_conf(config_file: str) -> ProxyConfiguration:
+    """MapProxy seeding configuration of `config_file`, only parsed again when the file changed"""
+    mtime = os.path.getmtime(config_file)
+    with _mapproxy_confs_lock:
+        cached = _mapproxy_confs.get(config_file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    mapproxy_conf = load_configuration(config_file, seed=True)
+    with _mapproxy_confs_lock:
+        _mapproxy_confs[config_file] = (mtime, mapproxy_conf)
+    return mapproxy_conf
 
-    db_schema = config["data_db_schema"]
-    additional_schema = config.get("additional_schema")
+def seed_config_file(generated_config_path: str, file_name: str) -> str:
+    """
+    Seeding variant of a generated config, with the coverage of every source extended to
+    the whole grid. Written by make_config along with the config, in a folder of its own
+    so MapProxy does not serve it.
+    """
+    return os.path.join(generated_config_path, SEED_CONFIG_FOLDER, f"{file_name}.yaml")
 
-    remote_cursor.execute(f'SELECT tilecluster_id FROM {config["tileclusters_table"]}')
-    tilecluster_ids = remote_cursor.fetchall()
+def _outdated(file_path: str, source_path: str) -> bool:
+    # Written right after its source, both may have the same modification time
+    try:
+        return os.path.getmtime(file_path) < os.path.getmtime(source_path)
+    except FileNotFoundError:
+        return True
 
-    grid_name = "main_grid"
+def _write_yaml_atomic(file_path: str, data: dict) -> None:
+    # Several seeds of the same config may run at once, never let them read a half written file
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        yaml_io.dump(data, f)
+    os.replace(tmp_path, file_path)
 
-    # Modify the base_config to extent the coverage
+def _write_seed_config(config: dict, base_config_file: str, seed_config: str) -> None:
+    """
+    Write the seeding variant of a generated config that has none yet, e.g. one generated
+    before make_config wrote them or edited by hand. Kept until the generated config changes.
+    """
+    if not _outdated(seed_config, base_config_file):
+        return
+
+    print(f"Seeding config {seed_config} is missing or outdated, writing it from {base_config_file}")
+    Path(seed_config).parent.mkdir(parents=True, exist_ok=True)
     with open(base_config_file, "r") as f:
-        base_config = yaml.safe_load(f)
+        base_config = yaml_io.load(f)
 
-    for tilecluster_id, in tilecluster_ids:
-        bbox = base_config["grids"][grid_name]["bbox"]
-        base_config["sources"][f"{tilecluster_id}_source"]["coverage"] = {
+    bbox = base_config["grids"]["main_grid"]["bbox"]
+    for source in base_config["sources"].values():
+        source["coverage"] = {
             "bbox": list(bbox),
             "srs": config["crs"]
         }
 
-    temp_config_file = os.path.join(temp_folder, f"{file_name}_temp.yaml")
-    with open(temp_config_file, "w") as f:
-        yaml.dump(base_config, f)
+    _write_yaml_atomic(seed_config, base_config)
 
-    for tilecluster_id, in tilecluster_ids:
-        mapzones: dict[str, tuple[MapZone, str]] = parse_tilecluster(tilecluster_id)
+def _make_sessions(
+    config: dict,
+    remote_conn: psycopg2.extensions.connection,
+    temp_config_file: str,
+    temp_folder: str,
+    file_name: str,
+    stack: ExitStack,
+) -> list[SeedSession]:
+    workers = int(config.get("seed_concurrency", 1))
+    if workers <= 1:
+        return [SeedSession(remote_conn, config["db_url_remote"], config["materialized_views"], load_mapproxy_conf(temp_config_file))]
 
-        coverage_dict = {}
-        if isinstance(coverage, dict):
-            coverage_dict = coverage
-        elif callable(coverage):
-            result = coverage(tilecluster_id, mapzones)
-            if result is None:
-                print(f"No coverage found for tilecluster {tilecluster_id}, skipping seeding")
-                continue
+    if view_refresh_mode(config) == VIEW_REFRESH_ONCE:
+        # Tileclusters are told apart by the WMS filter, workers need no database session
+        mapproxy_conf = load_mapproxy_conf(temp_config_file)
+        return [SeedSession(None, None, [], mapproxy_conf) for _ in range(workers)]
 
-            coverage_dict = result
-        else:
-            raise ValueError("Coverage must be a dict or a callable function that returns a dict")
-
-        tilecluster_schema = db_schema
-        data = mapzones.get('N')
-        if data and int(data[1]) == 2:
-            tilecluster_schema = additional_schema
-
-        for mapzone in MAP_ZONES.values():
-            remote_cursor.execute(f"DELETE FROM {tilecluster_schema}.{mapzone.table} WHERE cur_user = current_user;")
-
-        for mapzone, mapzone_id in mapzones.values():
-            # IMPORTANT: Set `value` to `True`
-            input = {
-                "client": {
-                    "device": 5,
-                    "lang": "es_ES",
-                    "tiled": "False",
-                    "infoType": 1,
-                    # "epsg": 25831
-                },
-                "form": {},
-                "feature": {},
-                "data": {
-                    "filterFields": {},
-                    "pageInfo": {},
-                    "selectorType": "selector_basic",
-                    "tabName": mapzone.tab,
-                    "addSchema": "NULL",
-                    # "addSchema": additional_schema if additional_schema else "NULL",
-                    "id": mapzone_id,
-                    "isAlone": "False",
-                    "disableParent": "False",
-                    "value": "True"
-                }
-            }
-            remote_cursor.execute(
-                f'SELECT {tilecluster_schema}.gw_fct_setselectors($${json.dumps(input)}$$);'
-            )
-            result = remote_cursor.fetchone()
-            if (
-                result is None or
-                result[0] is None or
-                result[0]["status"] != "Accepted"
-            ):
-                raise ValueError(f"Error setting selector for {mapzone.tab} with id {mapzone_id}: {result}")
-
-        remote_conn.commit()
-
-        print(f"Seeding {tilecluster_id}...")
-        # grid_name = f"{tilecluster_id}_grid"
-
-        # Refresh materialized views in remote database after selector updates
-        materialized_views = config["materialized_views"]
-        for view in materialized_views:
-            print("Refreshing materialized view: ", view)
-            remote_cursor.execute(f"REFRESH MATERIALIZED VIEW {view}")
-
-        remote_conn.commit()
-
-        output = {
-            "seeds": {
-                "seed_prog": {
-                    "caches": [f"{tilecluster_id}_cache"],
-                    "refresh_before": {
-                        "minutes": 0
-                    },
-                    "grids": [grid_name],
-                }
+    session_configs = config.get("seed_sessions") or []
+    if len(session_configs) < workers:
+        raise ValueError(
+            f"'seed_concurrency' is {workers} but only {len(session_configs)} 'seed_sessions' are configured. "
+            f"Each parallel worker needs its own database role so selectors do not collide."
+        )
+
+    sessions: list[SeedSession] = []
+    for i, session_config in enumerate(session_configs[:workers]):
+        # Point the WMS sources of this worker to the data of its own role (validated to differ
+        # between sessions). The overrides are part of the file name so a changed override is
+        # never served from an old file.
+        overrides = hashlib.sha1(json.dumps(session_config["source"], sort_keys=True).encode()).hexdigest()[:8]
+        session_temp_config_file = os.path.join(temp_folder, f"{file_name}_temp_{i}_{overrides}.yaml")
+        if _outdated(session_temp_config_file, temp_config_file):
+            with open(temp_config_file, "r") as f:
+                session_base_config = yaml_io.load(f)
+            for source in session_base_config["sources"].values():
+                source["req"].update(session_config["source"])
+            _write_yaml_atomic(session_temp_config_file, session_base_config)
+
+        sessions.append(SeedSession(
+            stack.enter_context(connection(session_config["db_url"])),
+            session_config["db_url"],
+            session_config["materialized_views"],
+            load_mapproxy_conf(session_temp_config_file),
+        ))
+
+    return sessions
+
+def _prepare_tilecluster_data(
+    config: dict,
+    config_name: str,
+    session: SeedSession,
+    tilecluster_id: str,
+    mapzones: dict[str, tuple[MapZone, str]],
+) -> float:
+    """
+    Select the mapzones of the tilecluster and refresh the materialized views so the
+    WMS renders only its data. Returns the time spent refreshing views.
+    """
+    remote_cursor = session.conn.cursor()
+
+    tilecluster_schema = config["data_db_schema"]
+    data = mapzones.get('N')
+    if data and int(data[1]) == 2:
+        tilecluster_schema = config.get("additional_schema")
+
+    inputs = []
+    for mapzone, mapzone_id in mapzones.values():
+        # IMPORTANT: Set `value` to `True`
+        inputs.append({
+            "client": {
+                "device": 5,
+                "lang": "es_ES",
+                "tiled": "False",
+                "infoType": 1,
+                # "epsg": 25831
             },
-            "coverages": {
-                "main_coverage": coverage_dict
+            "form": {},
+            "feature": {},
+            "data": {
+                "filterFields": {},
+                "pageInfo": {},
+                "selectorType": "selector_basic",
+                "tabName": mapzone.tab,
+                "addSchema": "NULL",
+                # "addSchema": additional_schema if additional_schema else "NULL",
+                "id": mapzone_id,
+                "isAlone": "False",
+                "disableParent": "False",
+                "value": "True"
+            }
+        })
+
+    with metrics.phase(config_name, "selectors"):
+        results = set_selectors(remote_cursor, tilecluster_schema, [tilecluster_schema], inputs)
+        for input, result in zip(inputs, results):
+            if result is None or result["status"] != "Accepted":
+                raise ValueError(f"Error setting selector for {input['data']['tabName']} with id {input['data']['id']}: {result}")
+
+        session.conn.commit()
+
+    # Refresh materialized views in remote database after selector updates
+    start_time = time.perf_counter()
+    if session.materialized_views:
+        with metrics.phase(config_name, "view_refresh"):
+            if session.refresh_plan is None:
+                # The dependencies between views do not change during a seed, work them out once
+                session.refresh_plan = RefreshPlan.load(remote_cursor, session.materialized_views)
+                session.conn.commit()
+            session.refresh_plan.refresh(session.conn, session.db_url, refresh_concurrency(config))
+
+    return time.perf_counter() - start_time
+
+def _seed_tilecluster(
+    session: SeedSession,
+    tilecluster_id: str,
+    coverage_dict: dict,
+    controller: ConcurrencyController,
+    levels: list[int] | None = None,
+    checkpoints: SeedCheckpoints | None = None,
+) -> tuple[int, TileStats | None]:
+    """Seed a tilecluster, returns the number of tiles seeded with the tiles stored in its file caches"""
+    print(f"Seeding {tilecluster_id}...")
+    # grid_name = f"{tilecluster_id}_grid"
+
+    seed_conf = {
+        "seeds": {
+            "seed_prog": {
+                "caches": [f"{tilecluster_id}_cache"],
+                "refresh_before": {
+                    "minutes": 0
+                },
+                "grids": ["main_grid"],
+                "coverages": ["main_coverage"],
             }
+        },
+        "coverages": {
+            "main_coverage": coverage_dict
         }
+    }
+
+    if levels is not None:
+        seed_conf["seeds"]["seed_prog"]["levels"] = levels
+
+    coverages = {}
+    if (main_coverage := make_coverage(coverage_dict)) is not None:
+        coverages["main_coverage"] = main_coverage
+
+    seeding_conf = InMemorySeedingConfiguration(seed_conf, session.mapproxy_conf, coverages)
+    tasks = seeding_conf.seeds(["seed_prog"])
+
+    _lower_thread_priority()
+    store_stats = StoreStats()
+    with open(os.path.join(SEED_LOG_PATH, f"mapproxy_seed_{tilecluster_id}.log"), "a" if checkpoints is not None and checkpoints.resumed else "w") as log_file:
+        if checkpoints is not None:
+            # The walker skips what a previous attempt of this run already seeded
+            progress_logger = CheckpointLog(out=log_file, verbose=False, progress_store=checkpoints.progress_store(tilecluster_id))
+        else:
+            progress_logger = ProgressLog(out=log_file, verbose=False)
+        seeded = seed_tasks(tasks, controller, progress_logger, store_stats)
+
+    # Only the stores of file caches are counted
+    if not any(
+        isinstance(tile_manager.cache, FileCache)
+        for _, _, tile_manager in session.mapproxy_conf.caches[f"{tilecluster_id}_cache"].caches()
+    ):
+        return seeded, None
+    return seeded, TileStats(*store_stats.totals())
+
+def seed(
+    config: dict,
+    remote_conn: psycopg2.extensions.connection,
+    generated_config_path: str,
+    temp_folder: str,
+    file_name: str,
+    coverage: dict | Callable[[str, dict[str, tuple[MapZone, str]]], dict | None],
+    progress: Callable[[int, int, str | None], None] | None = None,
+    tilecluster_ids: list[str] | None = None,
+    levels: list[int] | None = None,
+    checkpoints: SeedCheckpoints | None = None,
+) -> list[SeedResult]:
+    """
+    Seed every tilecluster of `config` with MapProxy's seeder, in this process.
+
+    The coverage is either a dict or a callable returning one per tilecluster (or None
+    to skip it), see `make_coverage` for the accepted keys. `tilecluster_ids` and `levels`
+    restrict the seed to those tileclusters and zoom levels, otherwise all are seeded.
+
+    With `view_refresh: per_tilecluster` (default) the selectors of each tilecluster are set
+    and every materialized view refreshed before seeding it. With `view_refresh: once` the
+    views refreshed by `refresh_tileclusters` are used as they are, and each source only
+    renders its tilecluster through the `tilecluster_filter` WMS filter.
+
+    With `seed_concurrency` > 1 in the user config, that many tileclusters are seeded at
+    once. In `per_tilecluster` mode each worker uses one of the `seed_sessions` (`db_url`
+    with its own login role, its own `materialized_views` and WMS `source` overrides).
+
+    `progress` is called before each tilecluster with the number of tileclusters
+    already processed, the total and the current tilecluster_id. It may raise to
+    abort the seeding (e.g. when the job has been cancelled).
+
+    A failing tilecluster does not stop the others, a `SeedError` with the result
+    of every tilecluster is raised at the end instead.
+
+    The concurrent WMS renders of each tilecluster are adjusted while seeding from the
+    latency and errors of the source, up to `seed_max_concurrency` (see `ConcurrencyController`).
+
+    With `checkpoints` the state of each tilecluster is stored as it goes, the tileclusters
+    a resumed run already finished are skipped and the others continue where they stopped.
+    """
+    if tilecluster_ids is None:
+        with remote_conn.cursor() as remote_cursor:
+            remote_cursor.execute(f'SELECT tilecluster_id FROM {config["tileclusters_table"]}')
+            tilecluster_ids = [tilecluster_id for tilecluster_id, in remote_cursor.fetchall()]
+    if checkpoints is not None:
+        tilecluster_ids = checkpoints.begin(tilecluster_ids)
+
+    # Seeding variant of the generated config, written by make_config
+    base_config_file = os.path.join(generated_config_path, f"{file_name}.yaml")
+    seed_config = seed_config_file(generated_config_path, file_name)
+    _write_seed_config(config, base_config_file, seed_config)
+
+    # Connections of the parallel sessions go back to their pools when seeding ends
+    stack = ExitStack()
+    try:
+        sessions = _make_sessions(config, remote_conn, seed_config, temp_folder, file_name, stack)
+    except BaseException:
+        stack.close()
+        raise
+
+    free_sessions: queue.Queue[SeedSession] = queue.Queue()
+    for session in sessions:
+        free_sessions.put(session)
+
+    progress_lock = threading.Lock()
+    done = 0
+
+    def report_progress(tilecluster_id: str | None):
+        if progress is not None:
+            with progress_lock:
+                progress(done, len(tilecluster_ids), tilecluster_id)
+
+    results: list[SeedResult] = []
+    prepare_per_tilecluster = view_refresh_mode(config) == VIEW_REFRESH_PER_TILECLUSTER
+    refresh_count = 0
+    refresh_seconds = 0.0
+
+    def run(tilecluster_id: str, mapzones: dict[str, tuple[MapZone, str]], coverage_dict: dict):
+        nonlocal done, refresh_count, refresh_seconds
+        session = free_sessions.get()
+        try:
+            report_progress(tilecluster_id)
+            start_time = time.perf_counter()
+            error = None
+            tiles = None
+            try:
+                if prepare_per_tilecluster:
+                    seconds = _prepare_tilecluster_data(config, file_name, session, tilecluster_id, mapzones)
+                    with progress_lock:
+                        refresh_count += len(session.materialized_views)
+                        refresh_seconds += seconds
+                seed_start_time = time.perf_counter()
+                with metrics.phase(file_name, "mapproxy_seed"):
+                    seeded, tiles = _seed_tilecluster(session, tilecluster_id, coverage_dict, controller, levels, checkpoints)
+                metrics.inc("seeding_tiles_total", {"config": file_name}, seeded)
+                metrics.set_gauge(
+                    "seeding_tilecluster_tiles_per_second", {"config": file_name, "tilecluster": tilecluster_id},
+                    seeded / max(time.perf_counter() - seed_start_time, 1e-6),
+                )
+                if checkpoints is not None:
+                    checkpoints.done(tilecluster_id)
+            except Exception as e:
+                print(traceback.format_exc())
+                if session.conn is not None:
+                    session.conn.rollback()
+                error = str(e) or type(e).__name__
+                metrics.inc("seeding_tilecluster_failures_total", {"config": file_name})
+                if checkpoints is not None:
+                    checkpoints.failed(tilecluster_id, error)
+        finally:
+            free_sessions.put(session)
+
+        with progress_lock:
+            results.append(SeedResult(tilecluster_id, time.perf_counter() - start_time, error, tiles))
+            done += 1
+
+    # Shared by the tileclusters seeded at once, they render from the same WMS
+    controller = ConcurrencyController.from_config(config, file_name)
+    controller.start()
+
+    executor = ThreadPoolExecutor(max_workers=len(sessions), thread_name_prefix="seed-worker")
+    futures = []
+    try:
+        for tilecluster_id in tilecluster_ids:
+            mapzones: dict[str, tuple[MapZone, str]] = parse_tilecluster(tilecluster_id)
+
+            coverage_dict = {}
+            if isinstance(coverage, dict):
+                coverage_dict = coverage
+            elif callable(coverage):
+                result = coverage(tilecluster_id, mapzones)
+                if result is None:
+                    print(f"No coverage found for tilecluster {tilecluster_id}, skipping seeding")
+                    if checkpoints is not None:
+                        checkpoints.done(tilecluster_id)
+                    with progress_lock:
+                        done += 1
+                    continue
+
+                coverage_dict = result
+            else:
+                raise ValueError("Coverage must be a dict or a callable function that returns a dict")
+
+            if len(sessions) == 1:
+                # Sequential seeding shares `remote_conn` with the coverage callback, one at a time.
+                # Still on a worker thread, the priority of the caller (maybe a request thread) is kept
+                executor.submit(run, tilecluster_id, mapzones, coverage_dict).result()
+            else:
+                futures.append(executor.submit(run, tilecluster_id, mapzones, coverage_dict))
+
+        # Stop at the first cancellation instead of seeding the rest
+        for future in as_completed(futures):
+            future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        controller.stop()
+        stack.close()
+        requests, errors, _ = controller.stats.totals()
+        metrics.inc("seeding_source_requests_total", {"config": file_name}, requests)
+        metrics.inc("seeding_source_errors_total", {"config": file_name}, errors)
+        metrics.flush()
+        # The tiles of these tileclusters changed on disk, drop them from the servers' memory
+        if results:
+            invalidate_tiles(os.path.join(temp_folder, TILE_CACHE_FOLDER), file_name, [result.tilecluster_id for result in results])
 
-        # If callback return None, we skip the seeding so this is not harmfull
-        output["seeds"]["seed_prog"]["coverages"] = ["main_coverage"]
+    report_progress(None)
 
-        with open(seed_yaml_file, "w") as f:
-            yaml.dump(output, f)
+    if prepare_per_tilecluster:
+        print(f"Materialized views: {refresh_count} refreshes for {len(results)} tileclusters, {refresh_seconds:.2f}s")
+    else:
+        print(f"Materialized views: no per-tilecluster refresh for {len(results)} tileclusters (view_refresh: {VIEW_REFRESH_ONCE})")
 
-        print("base_config_file:  ", temp_config_file)
-        print("seed_yaml_file:  ", seed_yaml_file)
-        os.system(f"mapproxy-seed -f {temp_config_file} -s {seed_yaml_file} -c {os.cpu_count() * 2} --seed seed_prog > /logs/mapproxy_seed_{tilecluster_id}.log 2>&1")
+    tiles = TileStats()
+    measured_seconds = 0.0
+    for result in results:
+        if result.tiles is not None:
+            tiles.add(result.tiles)
+            if result.error is None:
+                measured_seconds += result.seconds
+    if tiles.written:
+        print(
+            f"Tiles: {tiles.written} written, {tiles.linked} single colour tiles linked instead of stored "
+            f"({tiles.linked} files and {tiles.bytes_saved / 1024 ** 2:.1f} MiB saved, "
+            f"{tiles.bytes_written / 1024 ** 2:.1f} MiB written)"
+        )
+        # Throughput of a single worker, the seed estimates are based on it
+        record_seed_stats(os.path.join(temp_folder, SEED_STATS_FOLDER), file_name, {
+            "tiles": tiles.written, "bytes": tiles.bytes_written, "seconds": measured_seconds,
+        })
 
+    if any(result.error is not None for result in results):
+        raise SeedError(results)
+    return results
@@ -8,25 +8,45 @@ or (at your option) any later version.
 from flask import Flask, request, Response
 from flask_jwt_extended import jwt_required
 from qwc_services_core.auth import auth_manager
-from qwc_services_core.runtime_config import RuntimeConfig
 from qwc_services_core.tenant_handler import TenantHandler
 
+from mapproxy.config.loader import ProxyConfiguration
 from mapproxy.multiapp import make_wsgi_app
+from mapproxy.wsgiapp import MapProxyApp
 
 import traceback
-import yaml
 import json
 import time
 import os
 import shutil
-import psycopg2
 import datetime
+import fcntl
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-
+from typing import Callable, Iterator
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
+from psycopg2.extras import execute_values
+
+from checkpoints import SeedCheckpoints, UnfinishedSeedError
+from configs import load_tenant_config, load_user_config
+from dispatcher import PrefixDispatcher
+from estimate import SEED_STATS_FOLDER, estimate_seed, level_tile_counts, read_seed_stats, to_grid_srs
+from tile_cache import TILE_CACHE_FOLDER, TileCache, TileConfigs, TileSettings
+from tile_metrics import TileMetrics
+from tile_validators import TileValidators
 from make_conf import make_config
-from seeding import seed, MapZone, MAP_ZONES
+import metrics
+from seeding import (
+    VIEW_REFRESH_PER_TILECLUSTER, seed, set_selectors, parse_levels, parse_tilecluster, view_refresh_mode, MapZone, MAP_ZONES
+)
+from jobs import Job, JobQueue
+from db import remote_connection
+from materialized_views import refresh_concurrency, refresh_materialized_views
+from tileclusters import fetch_geometry_digests, geojson_geometry, get_index, parse_geometry, read_manifest, sync_geometries
 
-user_config_path = '/srv/qwc_service/mapproxy/config/'
+user_config_path = os.environ.get("MAPPROXY_CONFIG_PATH", '/srv/qwc_service/mapproxy/config/')
 generated_config_path = os.path.join(user_config_path, 'config-out')
 
 temp_folder = os.path.join(user_config_path, "temp")
@@ -38,32 +58,44 @@ def get_mapproxy_app():
 
 mapproxy_app = get_mapproxy_app()
 
+def reload_mapproxy_config(config_name: str, mapproxy_conf: ProxyConfiguration) -> None:
+    """
+    Swap in the generated config of `config_name`, as `make_config` loaded it (and so
+    without parsing it again), the other configs keep serving.
+
+    The other worker processes reload it on their next request for it, MapProxy checks
+    the modification time of the config file.
+    """
+    start_time = time.perf_counter()
+    # What `MultiMapProxy.create_app` does, but from the loaded config
+    proj_app = MapProxyApp(mapproxy_conf.configured_services(), mapproxy_conf.base_config)
+    proj_app.config_files = timestamps = mapproxy_conf.config_files()
+    with mapproxy_app._app_init_lock:
+        mapproxy_app.apps[config_name] = proj_app, timestamps
+    print(f"MapProxy config {config_name} reloaded in {time.perf_counter() - start_time:.2f}s")
+
 app = Flask(__name__)
 tenant_handler = TenantHandler(app.logger)
 
-touch_reload_path = '/srv/touch_reload'
+# Seeding work runs in background threads, one job at a time per worker by default
+job_queue = JobQueue(os.path.join(temp_folder, "jobs"), int(os.environ.get("SEEDING_JOB_WORKERS", 1)))
+
+# Every worker process adds its metrics to this folder, /seeding/metrics reports them all
+metrics.configure(os.path.join(temp_folder, "metrics"))
 
 # jwt = auth_manager(app)
 
 def get_user_config(config_name: str) -> dict:
+    """Validated user config, cached until its file changes (see `load_user_config`), not to be modified"""
     user_config_file = os.path.join(user_config_path, f"{config_name}.yaml")
-    if not os.path.exists(user_config_file):
-        raise FileNotFoundError(f"User config file {user_config_file} does not exist")
-
-    with open(user_config_file, "r") as f:
-        return yaml.safe_load(f)
+    try:
+        return load_user_config(user_config_file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"User config file {user_config_file} does not exist") from None
 
 def get_geom_folder(config_name: str) -> str:
     return os.path.join(generated_config_path, f"{config_name}_geom")
 
-def create_db_connections(config: dict) -> tuple:
-    try:
-        local_conn = psycopg2.connect(config["db_url"])
-        remote_conn = psycopg2.connect(config["db_url_remote"])
-        return local_conn, remote_conn
-    except Exception as e:
-        raise ConnectionError(f"Could not connect to local database: {e}")
-
 MAP_ZONES_EXT = MAP_ZONES.copy()
 MAP_ZONES_EXT["A"] = MapZone(
     table="",
@@ -77,12 +109,11 @@ def _set_selectors(config: dict, remote_conn) -> None:
     additional_schema = config.get("additional_schema")
 
     # Unselect all selectors
-    for mapzone in MAP_ZONES.values():
-        remote_cursor.execute(f"DELETE FROM {config['data_db_schema']}.{mapzone.table} WHERE cur_user = current_user;")
-        if additional_schema:
-            remote_cursor.execute(f"DELETE FROM {additional_schema}.{mapzone.table} WHERE cur_user = current_user;")
-
+    clear_schemas = [config['data_db_schema']]
+    if additional_schema:
+        clear_schemas.append(additional_schema)
 
+    inputs = []
     for selector in config.get("selectors", []):
         key, value = next(iter(selector.items()))
         mapzone = MAP_ZONES_EXT.get(key)
@@ -92,7 +123,7 @@ def _set_selectors(config: dict, remote_conn) -> None:
         print(f"Processing mapzone: {mapzone.tab}, value: {value}")
 
         if value == True:
-            query = {
+            inputs.append({
                 "client":{"device": 5, "lang": "es_ES", "tiled": "False", "infoType": 1},
                 "form":{}, "feature":{},
                 "data":{
@@ -102,55 +133,47 @@ def _set_selectors(config: dict, remote_conn) -> None:
                     "addSchema": additional_schema if additional_schema else "NULL",
                     "checkAll": "True"
                 }
-            }
-            query_str = f"SELECT {config['data_db_schema']}.gw_fct_setselectors($${json.dumps(query)}$$)"
-            print("Executing query:", query_str)
-            remote_cursor.execute(query_str)
-
-            result = remote_cursor.fetchone()
-            if result and result[0]['status'] != 'Accepted':
-                print("Result of setselectors:", result)
+            })
 
         elif isinstance(value, list):
             for item in value:
-                query = {
+                inputs.append({
                     "client":{"device": 5, "lang": "es_ES", "tiled": "False", "infoType": 1},
                     "form":{}, "feature":{},
                     "data":{
                         "filterFields":{}, "pageInfo":{}, "selectorType": "selector_basic", "tabName": mapzone.tab, "addSchema": additional_schema, "id": str(item), "isAlone": "False", "disableParent": "False", "value": "True"
                     }
-                }
-                query_str = f"SELECT {config['data_db_schema']}.gw_fct_setselectors($${json.dumps(query)}$$)"
-                print("Executing query:", query_str)
-                remote_cursor.execute(query_str)
-                result = remote_cursor.fetchone()
-                if result and result[0]['status'] != 'Accepted':
-                    print("Result of setselectors:", result)
+                })
+
+    results = set_selectors(remote_cursor, config['data_db_schema'], clear_schemas, inputs)
+    for result in results:
+        if result and result['status'] != 'Accepted':
+            print("Result of setselectors:", result)
 
     remote_conn.commit()
 
 # Refresh the tileclusters materialized view, and check if it has been updated (aka, diferent rows)
-def refresh_tileclusters(config: dict, geom_folder: str, remote_conn) -> None:
+# Returns the ids of the tileclusters whose geometry changed, and of the removed ones
+def refresh_tileclusters(config: dict, geom_folder: str, remote_conn, config_name: str) -> tuple[list[str], list[str]]:
     remote_cursor = remote_conn.cursor()
 
-    # Get current tilecluster_id list before refreshing
-    remote_cursor.execute(f"SELECT tilecluster_id FROM {config['tileclusters_table']} ORDER BY tilecluster_id")
-    current_tilecluster_ids = set(row[0] for row in remote_cursor.fetchall())
+    with metrics.phase(config_name, "selectors"):
+        # Get current tilecluster_id list before refreshing
+        remote_cursor.execute(f"SELECT tilecluster_id FROM {config['tileclusters_table']} ORDER BY tilecluster_id")
+        current_tilecluster_ids = set(row[0] for row in remote_cursor.fetchall())
 
-    _set_selectors(config, remote_conn)
+        _set_selectors(config, remote_conn)
 
-    # Refresh parent materialized view
-    materialized_views = config["materialized_views"]
-    for view in materialized_views:
-        print("Refreshing materialized view: ", view)
-        remote_cursor.execute(f"REFRESH MATERIALIZED VIEW {view}")
+    # Refresh parent materialized views and the tileclusters view, following their dependencies
+    start_time = time.perf_counter()
+    materialized_views = config["materialized_views"] + [config['tileclusters_table']]
+    with metrics.phase(config_name, "view_refresh"):
+        refresh_materialized_views(remote_conn, config["db_url_remote"], materialized_views, refresh_concurrency(config))
+    print(f"Materialized views: {len(materialized_views)} refreshes for the whole config, {time.perf_counter() - start_time:.2f}s")
 
-    remote_cursor.execute(f"REFRESH MATERIALIZED VIEW {config['tileclusters_table']}")
-    remote_conn.commit()
-
-    # Get new tilecluster_id list after refreshing
-    remote_cursor.execute(f"SELECT tilecluster_id FROM {config['tileclusters_table']} ORDER BY tilecluster_id")
-    new_tilecluster_ids = set(row[0] for row in remote_cursor.fetchall())
+    # Get new tilecluster_id list (with a digest of each geometry) after refreshing
+    digests = fetch_geometry_digests(config, remote_cursor)
+    new_tilecluster_ids = set(digests)
 
     # Compare with previous list
     if current_tilecluster_ids != new_tilecluster_ids:
@@ -162,16 +185,17 @@ def refresh_tileclusters(config: dict, geom_folder: str, remote_conn) -> None:
         print(error_msg)
         raise ValueError(error_msg)
 
-    remote_cursor.execute(f"SELECT tilecluster_id, ST_ASTEXT(geom) FROM {config['tileclusters_table']}")
-    new_tileclusters = remote_cursor.fetchall()
-
-    print(f"Creating geometry folder: {geom_folder}")
-    Path(geom_folder).mkdir(parents=True, exist_ok=True)
-    for tilecluster_id, geom in new_tileclusters:
+    with metrics.phase(config_name, "wkt_write"):
+        return sync_geometries(config, geom_folder, remote_cursor, digests)
 
-        file_path = os.path.join(geom_folder, f"{tilecluster_id}.wkt")
-        with open(file_path, 'w') as f:
-            f.write(geom)
+def config_outdated(config_name: str) -> bool:
+    """Whether the generated MapProxy config is missing or older than its user config"""
+    generated_config_file = os.path.join(generated_config_path, f"{config_name}.yaml")
+    user_config_file = os.path.join(user_config_path, f"{config_name}.yaml")
+    return (
+        not os.path.exists(generated_config_file)
+        or os.path.getmtime(generated_config_file) < os.path.getmtime(user_config_file)
+    )
 
 
 @app.route('/seeding/refresh_tileclusters')
@@ -183,82 +207,76 @@ def refresh_tileclusters_():
 
     try:
         user_config = get_user_config(config)
-        local_conn, remote_conn = create_db_connections(user_config)
-
-        geom_folder = get_geom_folder(config)
-        refresh_tileclusters(user_config, geom_folder, remote_conn)
+        with remote_connection(user_config) as remote_conn:
+            geom_folder = get_geom_folder(config)
+            changed, removed = refresh_tileclusters(user_config, geom_folder, remote_conn, config)
 
-        return Response(f"Refreshed {config} tileclusters", 200)
+            return Response(f"Refreshed {config} tileclusters, {len(changed)} geometries changed, {len(removed)} removed", 200)
     except Exception as e:
         return Response(f"Error refreshing tileclusters: {e}", 500)
 
 @app.route('/seeding/set_selectors')
 # @jwt_required()
-def set_selectors():
+def set_selectors_():
     config = request.args.get("config")
     if config is None:
         return Response("Config not provided", 400)
 
     try:
         user_config = get_user_config(config)
-        local_conn, remote_conn = create_db_connections(user_config)
+        with remote_connection(user_config) as remote_conn:
+            _set_selectors(user_config, remote_conn)
 
-        _set_selectors(user_config, remote_conn)
-
-        return Response(f"Selectors set for {config}", 200)
+            return Response(f"Selectors set for {config}", 200)
     except Exception as e:
         print(traceback.format_exc())
         return Response(f"Error setting selectors: {e}", 500)
 
-@app.route('/seeding/generate_config')
-# @jwt_required()
-def generate_config():
-    global mapproxy_app
-
-    file_name = request.args.get("config")
-    if file_name is None:
-        return Response("Config not provided", 400)
-
-    try:
-        start_time = time.perf_counter()
-
-        config = get_user_config(file_name)
-        local_conn, remote_conn = create_db_connections(config)
+def _run_generate_config(job: Job) -> str:
+    file_name = job.config
+    start_time = time.perf_counter()
 
+    config = get_user_config(file_name)
+    with remote_connection(config) as remote_conn:
         geom_folder = get_geom_folder(file_name)
-        refresh_tileclusters(config, geom_folder, remote_conn)
-        make_config(config, remote_conn, generated_config_path, geom_folder, file_name)
-
-        # Touch reload file to trigger MapProxy reload
-        Path(touch_reload_path).touch()
-        # mapproxy_app = get_mapproxy_app()
-
-        return Response(f"Config {file_name} generated. Time taken: {time.perf_counter() - start_time}", 200)
-    except Exception as e:
-        print(traceback.format_exc())
-        return Response(f"Error generating config: {e}", 500)
-
-@app.route('/seeding/seed/all')
-# @jwt_required()
-def seed_all():
-    global mapproxy_app
+        job.set_phase("refresh_tileclusters")
+        # The sources of removed tileclusters point to coverage files that no longer exist
+        changed, removed = refresh_tileclusters(config, geom_folder, remote_conn, file_name)
+        if not changed and not removed and not config_outdated(file_name):
+            return f"Config {file_name} up to date, no tilecluster geometry changed. Time taken: {time.perf_counter() - start_time}"
 
-    file_name = request.args.get("config")
-    if file_name is None:
-        return Response("Config not provided", 400)
+        job.set_phase("make_config")
+        reload_mapproxy_config(file_name, make_config(config, remote_conn, generated_config_path, geom_folder, file_name))
 
-    try:
-        start_time = time.perf_counter()
+        return f"Config {file_name} generated, {len(changed)} tilecluster geometries changed, {len(removed)} removed. Time taken: {time.perf_counter() - start_time}"
 
-        config = get_user_config(file_name)
-        local_conn, remote_conn = create_db_connections(config)
-        remote_cursor = remote_conn.cursor()
+# Kinds of seed runs that can be resumed, see `SeedCheckpoints`
+SEED_ALL = "seed_all"
+SEED_ALL_CHANGED = "seed_all_changed"
+SEED_UPDATE = "seed_update"
 
-        # Insert initial seed time into database
+def _set_last_seed(config: dict, remote_conn, file_name: str, last_seed: datetime.datetime) -> None:
+    with remote_conn.cursor() as remote_cursor:
         remote_cursor.execute(f"""INSERT INTO {config['tiling_db_schema']}.last_seed_time (id, last_seed)
-                                  VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET last_seed = %s""",
-                              (file_name, datetime.datetime.now(), datetime.datetime.now()))
-        remote_conn.commit()
+                                  VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET last_seed = EXCLUDED.last_seed""",
+                              (file_name, last_seed))
+    remote_conn.commit()
+
+def _run_seed_all(job: Job, only_changed: bool = False, resume: bool = False, discard: bool = False) -> str:
+    file_name = job.config
+    start_time = time.perf_counter()
+
+    config = get_user_config(file_name)
+    with remote_connection(config) as remote_conn:
+        # The seed time is taken now but only stored once every tilecluster is seeded,
+        # a resumed run keeps the time the run started
+        if resume:
+            checkpoints = SeedCheckpoints.load(config, file_name, remote_conn)
+            if checkpoints is None:
+                return f"No unfinished seed of {file_name} to resume"
+        else:
+            checkpoints = SeedCheckpoints(config, file_name, SEED_ALL_CHANGED if only_changed else SEED_ALL, remote_conn, discard)
+            checkpoints.check_unfinished()
 
         geom_folder = get_geom_folder(file_name)
 
@@ -268,33 +286,96 @@ def seed_all():
                 "datasource": os.path.join(geom_folder, f'{tilecluster_id}.wkt'),
             }
 
-        refresh_tileclusters(config, geom_folder, remote_conn)
-        make_config(config, remote_conn, generated_config_path, geom_folder, file_name)
-        seed(config, remote_conn, generated_config_path, temp_folder, file_name, make_coverage)
-
-        Path(touch_reload_path).touch()
-
-        return Response(f"Config {file_name} seeded. Time taken: {time.perf_counter() - start_time}", 200)
-    except Exception as e:
-        print(traceback.format_exc())
-        return Response(f"Error seeding config: {e}", 500)
-
-
-@app.route('/seeding/seed/update')
-# @jwt_required()
-def seed_update_time():
-    global mapproxy_app
+        job.set_phase("refresh_tileclusters")
+        changed, removed = refresh_tileclusters(config, geom_folder, remote_conn, file_name)
+        if changed or removed or config_outdated(file_name):
+            job.set_phase("make_config")
+            reload_mapproxy_config(file_name, make_config(config, remote_conn, generated_config_path, geom_folder, file_name))
+        if resume:
+            tilecluster_ids = checkpoints.pending
+        else:
+            # Unchanged tileclusters get no checkpoint rows when only the changed ones are seeded
+            tilecluster_ids = changed if only_changed else None
+        job.set_phase("seed")
+        seed(
+            config, remote_conn, generated_config_path, temp_folder, file_name, make_coverage, job.update_progress,
+            tilecluster_ids=tilecluster_ids, checkpoints=checkpoints,
+        )
 
-    file_name = request.args.get("config")
-    if file_name is None:
-        return Response("Config not provided", 400)
+        # Reseeding only the changed geometries leaves the other tileclusters as they were
+        if checkpoints.kind == SEED_ALL:
+            _set_last_seed(config, remote_conn, file_name, checkpoints.started)
+
+        return f"Config {file_name} seeded. Time taken: {time.perf_counter() - start_time}"
+
+def fetch_changed_boundaries(config: dict, remote_cursor, tilecluster_ids: list[str], last_seed_time) -> dict[str, dict]:
+    """
+    Boundary (GeoJSON) of the features changed since `last_seed_time` in each tilecluster,
+    with a single query for all of them. Tileclusters without changes are left out.
+    """
+    # Select the from where to get the updated geometry depending on the network_id
+    inputs: dict[str, tuple[list[str], list[str]]] = {}
+    for tilecluster_id in tilecluster_ids:
+        mapzones = parse_tilecluster(tilecluster_id)
+
+        schema = config["data_db_schema"]
+        update_tables = config["update_tables"]
+        if mz_data := mapzones.get("N"):
+            _, id = mz_data
+            if id == "2":
+                schema = config["additional_schema"]
+                update_tables = config["additional_update_tables"]
+
+        extra = {
+            mz.column: id for key, (mz, id) in mapzones.items() if key != "N"
+        }
 
-    try:
-        start_time = time.perf_counter()
-        seed_update_start_time = datetime.datetime.now()
+        feature_json = {
+            "client": {"device": 4, "infoType": 1, "lang": "ES", "epsg": int(config["crs"].split(":")[-1]) },
+            "form": {},
+            "feature": {"update_tables": update_tables},
+            "data": {"type": "time", "lastSeed": f"{str(last_seed_time)}", "extra": extra}
+        }
+        ids, feature_inputs = inputs.setdefault(schema, ([], []))
+        ids.append(tilecluster_id)
+        feature_inputs.append(json.dumps(feature_json))
+
+    if not inputs:
+        return {}
+
+    queries = []
+    params = []
+    for schema, (ids, feature_inputs) in inputs.items():
+        queries.append(
+            f"SELECT t.tilecluster_id, {schema}.gw_fct_getfeatureboundary(t.input::json) "
+            f"FROM unnest(%s::text[], %s::text[]) AS t(tilecluster_id, input)"
+        )
+        params.extend([ids, feature_inputs])
+    remote_cursor.execute(" UNION ALL ".join(queries), params)
+
+    boundaries = {}
+    for tilecluster_id, geojson in remote_cursor.fetchall():
+        if geojson is None:
+            raise ValueError(f"No geometry found for the tilecluster {tilecluster_id}")
+        if geojson['coordinates']:
+            boundaries[tilecluster_id] = geojson
+    return boundaries
+
+def _run_seed_update(job: Job, resume: bool = False, discard: bool = False) -> str:
+    file_name = job.config
+    start_time = time.perf_counter()
+
+    config = get_user_config(file_name)
+    with remote_connection(config) as remote_conn:
+        if resume:
+            checkpoints = SeedCheckpoints.load(config, file_name, remote_conn)
+            if checkpoints is None:
+                return f"No unfinished seed of {file_name} to resume"
+        else:
+            checkpoints = SeedCheckpoints(config, file_name, SEED_UPDATE, remote_conn, discard)
+            checkpoints.check_unfinished()
+        seed_update_start_time = checkpoints.started
 
-        config = get_user_config(file_name)
-        local_conn, remote_conn = create_db_connections(config)
         remote_cursor = remote_conn.cursor()
 
         # Get last seed time from database
@@ -308,180 +389,393 @@ def seed_update_time():
         last_seed_time = result[0]
         print(f"Last seed time:", last_seed_time)
 
-        def make_coverage(tilecluster_id: str, mapzones: dict[str, tuple[MapZone, str]]) -> dict | None:
-            geojson_file_path = os.path.join(temp_folder, f"{file_name}_geom_{tilecluster_id}.geojson")
-
-            # Select the from where to get the updated geometry depending on the network_id
-            schema = config["data_db_schema"]
-            update_tables = config["update_tables"]
-            if mz_data := mapzones.get("N"):
-                _, id = mz_data
-                if id == "2":
-                    schema = config["additional_schema"]
-                    update_tables = config["additional_update_tables"]
-
-            extra = {
-                mz.column: id for key, (mz, id) in mapzones.items() if key != "N"
-            }
-            print("Extra for SQL:", extra)
+        geom_folder = get_geom_folder(file_name)
 
-            feature_json = {
-                "client": {"device": 4, "infoType": 1, "lang": "ES", "epsg": int(config["crs"].split(":")[-1]) },
-                "form": {},
-                "feature": {"update_tables": update_tables},
-                "data": {"type": "time", "lastSeed": f"{str(last_seed_time)}", "extra": extra}
-            }
-            query = f'SELECT {schema}.gw_fct_getfeatureboundary($${json.dumps(feature_json)}$$)'
-            print(query)
-            remote_cursor.execute(query)
-            result = remote_cursor.fetchone()
-            if result is None:
-                return None
-            print("Result of gw_fct_getfeatureboundary:", result)
-            geojson = result[0]
+        job.set_phase("refresh_tileclusters")
+        changed, removed = refresh_tileclusters(config, geom_folder, remote_conn, file_name)
+        if changed or removed or config_outdated(file_name):
+            job.set_phase("make_config")
+            reload_mapproxy_config(file_name, make_config(config, remote_conn, generated_config_path, geom_folder, file_name))
+
+        # Boundaries of the features changed since the last seed, for every tilecluster at once
+        job.set_phase("change_detection")
+        boundaries = fetch_changed_boundaries(config, remote_cursor, list(read_manifest(geom_folder)), last_seed_time)
+        print(f"Changes since last seed in {len(boundaries)} tileclusters")
+
+        # A resumed run was logged when it started, only its unfinished tileclusters are left
+        tilecluster_ids = checkpoints.pending if resume else sorted(boundaries)
+        if boundaries and not resume:
+            # Log the start of the re-tiling process in remote database
+            process_id = f"seed_update_{seed_update_start_time}"
+            log_start_time = datetime.datetime.now()
+            execute_values(
+                remote_cursor,
+                f"INSERT INTO {config['tiling_db_schema']}.logs (process_id, tilecluster_id, project_id, start_time, geometry) VALUES %s",
+                [
+                    (process_id, tilecluster_id, file_name, log_start_time, json.dumps(geojson))
+                    for tilecluster_id, geojson in boundaries.items()
+                ],
+                template="(%s, %s, %s, %s, ST_GeomFromGeoJSON(%s))",
+                page_size=len(boundaries),
+            )
+            remote_conn.commit()
+
+        def make_coverage(tilecluster_id: str, mapzones: dict[str, tuple[MapZone, str]]) -> dict | None:
+            geojson = boundaries.get(tilecluster_id)
             if geojson is None:
-                raise ValueError("No geometry found for the given tilecluster_id")
-
-            if geojson['coordinates']:
-                with open(geojson_file_path, 'w') as f:
-                    json.dump(geojson, f, ensure_ascii=False)
-
-                # Log the start of the re-tiling process in remote database
-                start_time = datetime.datetime.now()
-                process_id = f"seed_update_{seed_update_start_time}"
-                remote_cursor.execute(
-                    f"INSERT INTO {config['tiling_db_schema']}.logs (process_id, tilecluster_id, project_id, start_time, geometry) "
-                    f"VALUES (%s, %s, %s, %s, ST_GeomFromGeoJSON(%s))",
-                    (process_id, tilecluster_id, file_name, start_time, json.dumps(geojson))
-                )
-                remote_conn.commit()
-            else:
                 return None
 
             return {
                 # "clip": True,
                 "srs": config["crs"],
-                "datasource": geojson_file_path,
+                "geometry": shape(geojson),
             }
 
-        geom_folder = get_geom_folder(file_name)
+        if tilecluster_ids:
+            job.set_phase("seed")
+            seed(
+                config,
+                remote_conn,
+                generated_config_path,
+                temp_folder,
+                file_name,
+                make_coverage,
+                job.update_progress,
+                tilecluster_ids=tilecluster_ids,
+                checkpoints=checkpoints,
+            )
+        else:
+            # Nothing left to seed, the run supersedes any unfinished one
+            checkpoints.begin([])
+
+        # Changes made while seeding are picked up by the next update
+        _set_last_seed(config, remote_conn, file_name, seed_update_start_time)
+
+        return f"Config {file_name} seeded. Time taken: {time.perf_counter() - start_time}"
+
+def _run_seed_geometry(job: Job, geometry: BaseGeometry) -> str:
+    file_name = job.config
+    start_time = time.perf_counter()
+
+    config = get_user_config(file_name)
+    geom_folder = get_geom_folder(file_name)
+
+    # Only the tileclusters touched by the geometry, each one clipped to it
+    job.set_phase("tilecluster_lookup")
+    coverages = get_index(geom_folder).intersecting(geometry)
+    print(f"Geometry intersects {len(coverages)} tileclusters")
+    if not coverages:
+        return f"Geometry does not intersect any tilecluster of {file_name}"
+
+    def make_coverage(tilecluster_id: str, mapzones: dict[str, tuple[MapZone, str]]) -> dict:
+        return {
+            "srs": config["crs"],
+            "geometry": coverages[tilecluster_id],
+        }
+
+    with remote_connection(config) as remote_conn:
+        if view_refresh_mode(config) != VIEW_REFRESH_PER_TILECLUSTER:
+            # The views are otherwise only refreshed by refresh_tileclusters, pick up the edits
+            job.set_phase("view_refresh")
+            with metrics.phase(file_name, "view_refresh"):
+                refresh_materialized_views(remote_conn, config["db_url_remote"], config["materialized_views"], refresh_concurrency(config))
 
-        refresh_tileclusters(config, geom_folder, remote_conn)
-        make_config(config, remote_conn, generated_config_path, geom_folder, file_name)
+        job.set_phase("seed")
         seed(
-            config,
-            remote_conn,
-            generated_config_path,
-            temp_folder,
-            file_name,
-            make_coverage
+            config, remote_conn, generated_config_path, temp_folder, file_name, make_coverage, job.update_progress,
+            tilecluster_ids=sorted(coverages),
         )
 
-        Path(touch_reload_path).touch()
+    return f"Geometry seeded in {len(coverages)} tileclusters of {file_name}. Time taken: {time.perf_counter() - start_time}"
 
-        remote_cursor.execute(
-            f"UPDATE {config['tiling_db_schema']}.last_seed_time "
-            f"SET last_seed = %s WHERE id = %s",
-            (datetime.datetime.now(), file_name)
-        )
-        remote_conn.commit()
+def _json_response(data, status: int = 200) -> Response:
+    return Response(json.dumps(data, default=str), status, mimetype="application/json")
+
+def _submit_job(kind: str, func: Callable[[Job], str], check: Callable[[str], None] | None = None) -> Response:
+    file_name = request.values.get("config")
+    if file_name is None:
+        return Response("Config not provided", 400)
+
+    try:
+        # Fail fast on unknown configs (and whatever `check` rejects) instead of inside the job
+        get_user_config(file_name)
+        if check is not None:
+            check(file_name)
+        job = job_queue.submit(kind, file_name, func)
+    except FileNotFoundError as e:
+        return Response(str(e), 404)
+    except ValueError as e:
+        return Response(str(e), 400)
+    except RuntimeError as e:
+        return Response(str(e), 409)
+
+    return _json_response({"job_id": job.id, "status": job.status}, 202)
+
+@app.route('/seeding/generate_config')
+# @jwt_required()
+def generate_config():
+    return _submit_job("generate_config", _run_generate_config)
 
-        return Response(f"Config {file_name} seeded. Time taken: {time.perf_counter() - start_time}", 200)
+def _check_unfinished_seed(config_name: str, kind: str) -> None:
+    # A new run replaces the checkpoints of the last one, only when it is of the same kind
+    config = get_user_config(config_name)
+    with remote_connection(config) as remote_conn:
+        checkpoints = SeedCheckpoints.load(config, config_name, remote_conn)
+    if checkpoints is not None and checkpoints.kind != kind:
+        raise UnfinishedSeedError(config_name, checkpoints.run_id, checkpoints.kind, len(checkpoints.pending))
+
+def _seed_check(kind: str, discard: bool) -> Callable[[str], None] | None:
+    return None if discard else partial(_check_unfinished_seed, kind=kind)
+
+@app.route('/seeding/seed/all')
+# @jwt_required()
+def seed_all():
+    # only_changed: reseed only the tileclusters whose geometry changed
+    only_changed = request.args.get("only_changed", "").lower() in ("1", "true")
+    # discard: start over even if an unfinished seed of another kind could be resumed
+    discard = request.args.get("discard", "").lower() in ("1", "true")
+    return _submit_job(
+        "seed_all", partial(_run_seed_all, only_changed=only_changed, discard=discard),
+        _seed_check(SEED_ALL_CHANGED if only_changed else SEED_ALL, discard),
+    )
+
+@app.route('/seeding/seed/update')
+# @jwt_required()
+def seed_update_time():
+    discard = request.args.get("discard", "").lower() in ("1", "true")
+    return _submit_job("seed_update", partial(_run_seed_update, discard=discard), _seed_check(SEED_UPDATE, discard))
+
+@app.route('/seeding/seed/resume')
+# @jwt_required()
+def seed_resume():
+    # Continue the last seed_all or seed_update of a config that did not finish every tilecluster
+    config_name = request.args.get("config")
+    if config_name is None:
+        return Response("Config not provided", 400)
+
+    try:
+        config = get_user_config(config_name)
+        with remote_connection(config) as remote_conn:
+            checkpoints = SeedCheckpoints.load(config, config_name, remote_conn)
+    except FileNotFoundError as e:
+        return Response(str(e), 404)
+    if checkpoints is None:
+        return Response(f"No unfinished seed of {config_name} to resume", 404)
+
+    if checkpoints.kind == SEED_UPDATE:
+        return _submit_job("seed_update", partial(_run_seed_update, resume=True))
+    return _submit_job("seed_all", partial(_run_seed_all, only_changed=checkpoints.kind == SEED_ALL_CHANGED, resume=True))
+
+@app.route('/seeding/seed/geometry', methods=['GET', 'POST'])
+# @jwt_required()
+def seed_geometry():
+    # GeoJSON or WKT geometry, or a minx,miny,maxx,maxy bbox, in the crs of the config
+    try:
+        geometry = parse_geometry(request.values.get("geometry"), request.values.get("bbox"))
     except Exception as e:
-        print(traceback.format_exc())
-        return Response(f"Error seeding config: {e}", 500)
+        return Response(f"Invalid geometry: {e}", 400)
 
+    return _submit_job("seed_geometry", partial(_run_seed_geometry, geometry=geometry))
 
-@app.route('/seeding/seed/feature')
+@app.route('/seeding/seed/estimate')
 # @jwt_required()
-def seed_feature():
-    theme = request.args.get("theme")
-    valve_id = request.args.get("valveId")
-    if theme is None:
-        return Response("Theme is not provided", 400)
+def seed_estimate():
+    # Tiles a seed_all would write, with its disk use and duration, without touching the DB or the WMS
+    config_name = request.args.get("config")
+    if config_name is None:
+        return Response("Config not provided", 400)
 
-    if valve_id is None:
-        return Response("Element not provided", 400)
+    try:
+        config = get_user_config(config_name)
+        levels = parse_levels(request.args.get("levels")) or list(range(len(config["res"])))
+    except FileNotFoundError as e:
+        return Response(str(e), 404)
+    except ValueError as e:
+        return Response(str(e), 400)
+
+    geometries = get_index(get_geom_folder(config_name)).all()
+    if not geometries:
+        return Response(f"No tilecluster geometries for {config_name}, generate the config first", 404)
+
+    start_time = time.perf_counter()
+    tile_counts = {}
+    for tilecluster_id, geometry in sorted(geometries.items()):
+        geometry = to_grid_srs(geometry, config["crs"], config["grid"]["srs"])
+        tile_counts[tilecluster_id] = level_tile_counts(geometry, config["grid"], config["res"], levels)
+
+    history = read_seed_stats(os.path.join(temp_folder, SEED_STATS_FOLDER), config_name)
+    result = estimate_seed(tile_counts, history, int(config.get("seed_concurrency", 1)))
+    print(f"Seed estimate of {config_name}: {result['tiles']} tiles in {len(tile_counts)} tileclusters, {time.perf_counter() - start_time:.2f}s")
+    return _json_response({"config": config_name, **result})
+
+@app.route('/seeding/metrics')
+# @jwt_required()
+def seeding_metrics():
+    return Response(metrics.render(), 200, mimetype="text/plain; version=0.0.4")
 
-    tenant = tenant_handler.tenant()
-    print("tenant ->", tenant)
-    config_handler = RuntimeConfig("giswater", app.logger)
-    giswater_config = config_handler.tenant_config(tenant)
-    config_name: str = giswater_config.get("themes").get(theme).get("tile_config") # type: ignore
+@app.route('/seeding/jobs')
+# @jwt_required()
+def list_jobs():
+    return _json_response(job_queue.list(request.args.get("config")))
 
-    user_config_file = os.path.join(user_config_path, f"{config_name}.yaml")
-    with open(user_config_file, "r") as f:
-        config: dict = yaml.safe_load(f)
+@app.route('/seeding/job')
+# @jwt_required()
+def job_status():
+    job_id = request.args.get("id")
+    if job_id is None:
+        return Response("Job id not provided", 400)
+
+    job = job_queue.get(job_id)
+    if job is None:
+        return Response(f"Job {job_id} not found", 404)
+    return _json_response(job)
+
+@app.route('/seeding/job/cancel')
+# @jwt_required()
+def cancel_job():
+    job_id = request.args.get("id")
+    if job_id is None:
+        return Response("Job id not provided", 400)
+
+    if not job_queue.cancel(job_id):
+        return Response(f"Job {job_id} not found or already finished", 404)
+    return Response(f"Cancellation of job {job_id} requested", 202)
 
-    db_url = config["db_url"]
-    db_schema = config["data_db_schema"]
 
-    conn = psycopg2.connect(db_url)
-    cursor = conn.cursor()
-    print("Materialized views refreshed----------")
+def _feature_boundary(config: dict, remote_conn, node_id: int) -> BaseGeometry | None:
     feature_json = {
-        "client": {"device": 4, "infoType": 1, "lang": "ES"},
+        "client": {"device": 4, "infoType": 1, "lang": "ES", "epsg": int(config["crs"].split(":")[1])},
         "form": {},
         "feature": {
-            "node": [int(valve_id)],
+            "node": [node_id],
         },
         "data": {"type": "feature"}
     }
-    feature_argument = json.dumps(feature_json)
-    sql_query = f'SELECT {db_schema}.gw_fct_getfeatureboundary($${feature_argument}$$)'
+    with remote_conn.cursor() as cursor:
+        cursor.execute(f'SELECT {config["data_db_schema"]}.gw_fct_getfeatureboundary(%s)', (json.dumps(feature_json),))
+        result = cursor.fetchone()
+    remote_conn.commit()
+
+    if result is None or not result[0]:
+        return None
+    return geojson_geometry(result[0])
 
-    print("SQL:", sql_query)
+@app.route('/seeding/seed/feature')
+# @jwt_required()
+def seed_feature():
+    theme = request.args.get("theme")
+    valve_id = request.args.get("valveId")
+    if theme is None:
+        return Response("Theme is not provided", 400)
 
-    cursor.execute(sql_query)
-    result = cursor.fetchone()
-    if result is None:
-        return Response("Element not found", 404)
+    if valve_id is None:
+        return Response("Element not provided", 400)
 
-    print("RESULT 0", result)
-    geo_json = result[0]
+    tenant = tenant_handler.tenant()
+    try:
+        giswater_config = load_tenant_config("giswater", tenant, app.logger)
+    except ValueError as e:
+        return Response(str(e), 500)
+    theme_config = (giswater_config.get("themes") or {}).get(theme)
+    if not theme_config or not theme_config.get("tile_config"):
+        return Response(f"Theme {theme} has no tile config", 404)
+    config_name: str = theme_config["tile_config"]
 
-    geojson_file_path = os.path.join(user_config_path, f"{config_name}_feature.geojson")
-    with open(geojson_file_path, 'w') as f:
-        json.dump(geo_json, f, ensure_ascii=False)
+    try:
+        config = get_user_config(config_name)
+        levels = parse_levels(request.args.get("levels") or config.get("feature_seed_levels"))
+        node_id = int(valve_id)
+    except FileNotFoundError as e:
+        return Response(str(e), 404)
+    except ValueError as e:
+        return Response(str(e), 400)
+
+    # Per tilecluster seeding moves the selectors of the config role, which a running job relies on
+    prepare_per_tilecluster = view_refresh_mode(config) == VIEW_REFRESH_PER_TILECLUSTER
+    if prepare_per_tilecluster and (active := job_queue.active_job(config_name)) is not None:
+        return Response(f"Job {active['id']} ({active['kind']}) is {active['status']} for config {config_name}, retry later", 409)
 
     try:
         start_time = time.perf_counter()
+        with remote_connection(config) as remote_conn:
+            boundary = _feature_boundary(config, remote_conn, node_id)
+            if boundary is None or boundary.is_empty:
+                return Response("Element not found", 404)
+
+            # Symbols drawn around the feature spill over its boundary
+            if buffer := float(config.get("feature_seed_buffer", 0)):
+                boundary = boundary.buffer(buffer)
+
+            coverages = get_index(get_geom_folder(config_name)).intersecting(boundary)
+            if not coverages:
+                return Response(f"Element {node_id} is outside of every tilecluster of {config_name}", 200)
+
+            if not prepare_per_tilecluster:
+                # The views are otherwise only refreshed by refresh_tileclusters, pick up the edit
+                refresh_materialized_views(remote_conn, config["db_url_remote"], config["materialized_views"], refresh_concurrency(config))
+
+            def make_coverage(tilecluster_id: str, mapzones: dict[str, tuple[MapZone, str]]) -> dict:
+                return {
+                    "srs": config["crs"],
+                    "geometry": coverages[tilecluster_id],
+                }
 
-        feature = {
-            "srs": "EPSG:31982",
-            "datasource": geojson_file_path
-        }
-        seed(user_config_path, generated_config_path, config_name, feature)
+            # Selectors are per role, serialize the feature seeds of a config across workers
+            with _feature_seed_lock(config_name, prepare_per_tilecluster):
+                seed(
+                    config, remote_conn, generated_config_path, temp_folder, config_name, make_coverage,
+                    tilecluster_ids=sorted(coverages), levels=levels,
+                )
 
-        return Response(f"Element {feature} seeded. Time taken: {time.perf_counter() - start_time}", 200)
+        return Response(
+            f"Element {node_id} seeded in tileclusters {', '.join(sorted(coverages))}"
+            f"{f' at levels {levels}' if levels is not None else ''}. Time taken: {time.perf_counter() - start_time}",
+            200
+        )
     except Exception as e:
-        print(e)
+        print(traceback.format_exc())
         return Response(f"Error seeding element: {e}", 500)
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-# @jwt_required()
-def call_wsgi(path):
-    # Convert Flask's request to WSGI environ
-    environ = request.environ
-    response_body = []
-
-    # Call the WSGI app and collect the response
-    def start_response(status, headers, exc_info=None):
-        nonlocal response_body
-        response_body.append((status, headers))
-
-    result = mapproxy_app(environ, start_response)
-
-    # Extract the status and headers
-    status, headers = response_body[0]
-    response = Response(result, status=status)
-
-    for header in headers:
-        response.headers.add_header(*header)
-
-    return response
-
-# app = DispatcherMiddleware(mapproxy_app, {"/seeding": flask_app})
-# app = mapproxy_app
-
+@contextmanager
+def _feature_seed_lock(config_name: str, exclusive: bool) -> Iterator[None]:
+    if not exclusive:
+        yield
+        return
+    with open(os.path.join(temp_folder, f"{config_name}_feature.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _tile_settings(config_name: str) -> TileSettings:
+    config = get_user_config(config_name)
+    max_age = config.get("tile_max_age")
+    return TileSettings(parse_levels(config.get("tile_cache_levels")), int(max_age) if max_age is not None else None)
+
+tile_configs = TileConfigs(os.path.join(temp_folder, TILE_CACHE_FOLDER), _tile_settings)
+
+# Hot tiles are kept in memory by each worker process, TILE_CACHE_BYTES=0 disables it
+tile_cache_bytes = int(os.environ.get("TILE_CACHE_BYTES", 64 * 1024 * 1024))
+tile_app = lambda: mapproxy_app
+if tile_cache_bytes > 0:
+    tile_cache = TileCache(
+        lambda: mapproxy_app,
+        tile_configs,
+        tile_cache_bytes,
+        int(os.environ.get("TILE_CACHE_MAX_TILE_BYTES", 512 * 1024)),
+    )
+    tile_app = lambda: tile_cache
+
+# Conditional requests are answered from the tile files before reaching the cache or MapProxy
+tile_validators = TileValidators(tile_app, lambda: mapproxy_app, tile_configs)
+tiles_app = lambda: tile_validators
+
+# Latency, size, status and origin of the served tiles, reported by /seeding/metrics. TILE_METRICS=0 disables it
+if os.environ.get("TILE_METRICS", "1") != "0":
+    tile_metrics = TileMetrics(lambda: tile_validators)
+    tiles_app = lambda: tile_metrics
+
+# Tiles skip Flask entirely, only the seeding API is routed by it.
+# `app` stays the uWSGI callable, Flask calls its `wsgi_app` for every request.
+app.wsgi_app = PrefixDispatcher(app.wsgi_app, ["/seeding"], tiles_app)
@@ -0,0 +1,199 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import datetime
+import json
+import re
+
+import pytest
+
+import checkpoints
+from checkpoints import DONE, FAILED, PENDING, RUNNING, SeedCheckpoints, UnfinishedSeedError
+
+CONFIG = {"db_url_remote": "postgresql://tiling@remote/giswater", "tiling_db_schema": "tiling"}
+COLUMNS = ("tilecluster_id", "run_id", "kind", "started", "status", "levels", "progress")
+
+
+class Cursor:
+    """Runs the statements of `SeedCheckpoints` against the rows of its connection"""
+    def __init__(self, conn: "Connection"):
+        self.conn = conn
+        self.connection = conn
+        self.result: list[tuple] = []
+        self.values: list[tuple] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def mogrify(self, template, args):
+        # Rows of an execute_values INSERT, taken by the next execute
+        self.values.append(args)
+        return b"(%s)"
+
+    def execute(self, sql, params=()):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        sql = " ".join(sql.split())
+        rows = self.conn.rows
+        if sql.startswith("INSERT INTO tiling.seed_progress"):
+            for config, tilecluster_id, run_id, kind, started, status in self.values:
+                assert (config, tilecluster_id) not in rows
+                rows[(config, tilecluster_id)] = {
+                    "run_id": run_id, "kind": kind, "started": started, "status": status, "levels": None, "progress": None,
+                }
+            self.values = []
+        elif sql.startswith("DELETE FROM tiling.seed_progress"):
+            for key in [key for key in rows if key[0] == params[0]]:
+                del rows[key]
+        elif sql.startswith("SELECT run_id, kind, count(*)"):
+            config, done, kind = params
+            unfinished: dict[tuple, int] = {}
+            for (row_config, _), row in rows.items():
+                if row_config == config and row["status"] != done and row["kind"] != kind:
+                    unfinished[(row["run_id"], row["kind"])] = unfinished.get((row["run_id"], row["kind"]), 0) + 1
+            self.result = [(*key, count) for key, count in unfinished.items()]
+        elif sql.startswith("SELECT tilecluster_id"):
+            self.result = sorted(
+                ((tilecluster_id, *(row[column] for column in COLUMNS[1:])) for (config, tilecluster_id), row in rows.items() if config == params[0]),
+                key=lambda row: row[3], reverse=True,
+            )
+        elif sql.startswith("UPDATE tiling.seed_progress SET"):
+            *values, config, tilecluster_id = params
+            values = iter(values)
+            row = rows[(config, tilecluster_id)]
+            for column, value in re.findall(r"(\w+) = (%s|NULL|now\(\))", sql.split(" WHERE ")[0]):
+                row[column] = next(values) if value == "%s" else None
+            # psycopg2 decodes jsonb
+            if isinstance(row["progress"], str):
+                row["progress"] = json.loads(row["progress"])
+        else:
+            assert sql.startswith("CREATE TABLE"), sql
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+class Connection:
+    encoding = "UTF8"
+
+    def __init__(self):
+        # Columns of each (config, tilecluster_id)
+        self.rows: dict[tuple[str, str], dict] = {}
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    monkeypatch.setattr(checkpoints, "_created_tables", set())
+    return Connection()
+
+
+def test_run_records_the_state_of_each_tilecluster(conn):
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    assert run.begin(["c1", "c2", "c3"]) == ["c1", "c2", "c3"]
+    assert {key: row["status"] for key, row in conn.rows.items()} == {("ws", "c1"): PENDING, ("ws", "c2"): PENDING, ("ws", "c3"): PENDING}
+
+    store = run.progress_store("c1")
+    assert conn.rows[("ws", "c1")]["status"] == RUNNING
+    store.add(("c1", "cache", "grid", (3, 4)), [(0, 4), (2, 4)])
+    store.level = 4
+    store.write()
+    assert conn.rows[("ws", "c1")]["levels"] == [3, 4]
+
+    run.done("c2")
+    run.failed("c3", "WMS down")
+    assert (conn.rows[("ws", "c2")]["status"], conn.rows[("ws", "c3")]["status"]) == (DONE, FAILED)
+    assert run.pending == ["c1", "c3"]
+
+
+def test_resumed_run_skips_the_done_tileclusters_and_continues_the_others(conn, capsys):
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    run.begin(["c1", "c2", "c3"])
+    run.done("c1")
+    store = run.progress_store("c2")
+    store.add(("c2", "cache", "grid", (3, 4)), [(0, 4), (2, 4)])
+    store.write()
+
+    resumed = SeedCheckpoints.load(CONFIG, "ws", conn)
+    assert (resumed.run_id, resumed.kind, resumed.started, resumed.resumed) == (run.run_id, "all", run.started, True)
+    assert resumed.pending == ["c2", "c3"]
+    assert resumed.begin(resumed.pending) == ["c2", "c3"]
+    assert "1 of 3 tileclusters already done" in capsys.readouterr().out
+
+    # The walker of c2 continues from the subtrees it processed, as tuples like MapProxy's
+    assert resumed.progress_store("c2").get(("c2", "cache", "grid", (3, 4))) == [(0, 4), (2, 4)]
+    assert resumed.progress_store("c3").get(("c3", "cache", "grid", (3, 4))) is None
+
+
+def test_finished_run_is_not_resumed(conn):
+    assert SeedCheckpoints.load(CONFIG, "ws", conn) is None
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    run.begin(["c1"])
+    run.done("c1")
+    assert SeedCheckpoints.load(CONFIG, "ws", conn) is None
+
+
+def test_progress_of_other_levels_is_ignored(conn):
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    run.begin(["c1"])
+    store = run.progress_store("c1")
+    store.add(("c1", "cache", "grid", (3, 4)), [(0, 4)])
+    store.write()
+
+    store = SeedCheckpoints.load(CONFIG, "ws", conn).progress_store("c1")
+    assert store.get(("c1", "cache", "grid", (3, 4, 5))) is None
+    assert store.get(("c1", "cache", "grid", (3, 4))) == [(0, 4)]
+
+
+def test_unfinished_run_of_another_kind_is_not_replaced(conn):
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    run.begin(["c1", "c2"])
+    run.done("c1")
+
+    update = SeedCheckpoints(CONFIG, "ws", "update", conn)
+    with pytest.raises(UnfinishedSeedError) as e:
+        update.check_unfinished()
+    assert (e.value.run_id, e.value.kind) == (run.run_id, "all")
+    with pytest.raises(UnfinishedSeedError):
+        update.begin(["c3"])
+    assert {key[1] for key in conn.rows} == {"c1", "c2"}
+
+    # The same kind, or an explicit discard, starts over
+    SeedCheckpoints(CONFIG, "ws", "all", conn).check_unfinished()
+    discarding = SeedCheckpoints(CONFIG, "ws", "update", conn, discard=True)
+    discarding.check_unfinished()
+    assert discarding.begin(["c3"]) == ["c3"]
+    assert {key[1]: row["run_id"] for key, row in conn.rows.items()} == {"c3": discarding.run_id}
+
+
+def test_only_the_last_run_is_loaded(conn, capsys):
+    old = SeedCheckpoints(CONFIG, "ws", "update", conn)
+    old.begin(["c1", "c2"])
+    run = SeedCheckpoints(CONFIG, "ws", "all", conn)
+    run.started = old.started + datetime.timedelta(seconds=1)
+    # Left by runs started at the same time, the later DELETE ran before the other INSERT
+    run.rows = {"c1": (PENDING, None, None), "c2": (PENDING, None, None)}
+    run.resumed = True
+    conn.rows[("ws", "c3")] = {"run_id": run.run_id, "kind": "all", "started": run.started, "status": PENDING, "levels": None, "progress": None}
+
+    loaded = SeedCheckpoints.load(CONFIG, "ws", conn)
+    assert (loaded.run_id, loaded.kind) == (run.run_id, "all")
+    assert loaded.pending == ["c3"]
+    assert f"Ignoring the checkpoints of older seed runs {old.run_id}" in capsys.readouterr().out
@@ -0,0 +1,122 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+from types import SimpleNamespace
+
+from mapproxy.config import local_base_config
+from mapproxy.config.config import load_default_config
+
+from concurrency import ConcurrencyController, _GrowingWorkerPool
+
+
+def renders(controller: ConcurrencyController, count: int, seconds: float, errors: int = 0) -> None:
+    for i in range(count):
+        controller.stats.record(seconds, i < errors)
+
+
+def test_initial_concurrency_is_clamped_to_the_ceiling():
+    assert ConcurrencyController("test", ceiling=4, initial=10).limit == 4
+    assert ConcurrencyController("test", ceiling=0, initial=0).limit == 1
+
+
+def test_healthy_renders_grow_the_concurrency_by_one():
+    controller = ConcurrencyController("test", ceiling=8, initial=4)
+    renders(controller, 4, 1.0)
+    controller.adjust()
+    assert controller.limit == 5
+
+
+def test_errors_halve_the_concurrency():
+    controller = ConcurrencyController("test", ceiling=8, initial=6)
+    renders(controller, 10, 1.0, errors=1)
+    controller.adjust()
+    assert controller.limit == 3
+
+    renders(controller, 10, 1.0, errors=10)
+    controller.adjust()
+    renders(controller, 10, 1.0, errors=10)
+    controller.adjust()
+    assert controller.limit == 1
+
+
+def test_slow_renders_cut_the_concurrency_by_a_quarter():
+    controller = ConcurrencyController("test", ceiling=16, initial=8)
+    renders(controller, 8, 1.0)
+    controller.adjust()
+    assert controller.limit == 9
+
+    # Slower than twice the fastest mean latency seen
+    renders(controller, 9, 3.0)
+    controller.adjust()
+    assert controller.limit == 9 * 3 // 4
+
+
+def test_target_latency_replaces_the_fastest_one_seen():
+    controller = ConcurrencyController("test", ceiling=16, initial=8, target_latency=0.5)
+    renders(controller, 8, 0.8)
+    controller.adjust()
+    assert controller.limit == 6
+
+
+def test_concurrency_does_not_grow_past_the_ceiling_or_when_idle():
+    controller = ConcurrencyController("test", ceiling=4, initial=4)
+    renders(controller, 10, 1.0)
+    controller.adjust()
+    assert controller.limit == 4
+
+    # Fewer renders than allowed, more workers would not have helped
+    controller = ConcurrencyController("test", ceiling=8, initial=4)
+    renders(controller, 3, 1.0)
+    controller.adjust()
+    assert controller.limit == 4
+
+    # Nothing rendered since the last adjustment
+    controller.adjust()
+    assert controller.limit == 4
+
+
+def test_gates_share_the_concurrency():
+    controller = ConcurrencyController("test", ceiling=8, initial=5)
+    first = controller.open_gate()
+    assert first.allowed.value == 5
+    second = controller.open_gate()
+    assert (first.allowed.value, second.allowed.value) == (2, 2)
+
+    renders(controller, 5, 1.0, errors=1)
+    controller.adjust()
+    assert (first.allowed.value, second.allowed.value) == (1, 1)
+
+    # The closed gate lets its paused workers take their stop sentinel
+    controller.close_gate(second)
+    assert second.allowed.value == 8
+    assert first.allowed.value == 2
+
+
+class Worker:
+    def __init__(self, task, tiles_queue, conf):
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+
+def test_worker_pool_forks_workers_as_the_gate_allows_them():
+    controller = ConcurrencyController("test", ceiling=4, initial=2)
+    task = SimpleNamespace(gate=controller.open_gate())
+    with local_base_config(load_default_config()):
+        pool = _GrowingWorkerPool(task, Worker, controller.ceiling)
+    assert len(pool.procs) == 2
+
+    task.gate.allowed.value = 3
+    pool.grow()
+    assert len(pool.procs) == 3 and all(worker.started for worker in pool.procs)
+
+    # Paused workers are kept, and never more than the ceiling are forked
+    task.gate.allowed.value = 1
+    pool.grow()
+    task.gate.allowed.value = 8
+    pool.grow()
+    assert len(pool.procs) == 4
@@ -0,0 +1,101 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import pytest
+
+from configs import ConfigError, validate_user_config
+from seeding import parse_levels
+
+
+def baseline_config() -> dict:
+    """A user config as written for the service before the configs were validated"""
+    return {
+        "db_url": "postgresql://tiling@local/giswater",
+        "db_url_remote": "postgresql://tiling@remote/giswater",
+        "data_db_schema": "ws",
+        "tiling_db_schema": "tiling",
+        "tileclusters_table": "tileclusters",
+        "materialized_views": ["ws.v_edit_arc", "ws.v_edit_node"],
+        "crs": "EPSG:25831",
+        "grid": {"srs": "EPSG:25831", "origin": "nw", "bbox": [0, 0, 131072, 131072]},
+        "res": [512, 256, 128, 64, 32, 16, 8, 4, 2, 1],
+        "sources": {
+            "inventory_source": {"url": "http://qgis/ows", "layers": "inventory", "transparent": True},
+            "additional_source": None,
+        },
+        "additional_schema": None,
+        "update_tables": ["arc", "node"],
+        "additional_update_tables": [],
+        "selectors": [{"N": True}],
+    }
+
+
+def test_baseline_config_is_valid(capsys):
+    validate_user_config("baseline.yaml", baseline_config())
+    assert "'db_url' is no longer used" in capsys.readouterr().out
+
+
+def test_unknown_key_suggests_the_closest_one():
+    config = baseline_config()
+    config["materialised_views"] = config.pop("materialized_views")
+    with pytest.raises(ConfigError) as e:
+        validate_user_config("typo.yaml", config)
+    assert "unknown key 'materialised_views', did you mean 'materialized_views'?" in e.value.errors
+    assert "missing key 'materialized_views'" in e.value.errors
+
+
+@pytest.mark.parametrize("levels, expected", [
+    (5, [5]),
+    ([3, 4], [3, 4]),
+    ("2-4", [2, 3, 4]),
+    ("1,3", [1, 3]),
+])
+def test_levels_are_accepted_and_parsed(levels, expected):
+    config = baseline_config()
+    config["feature_seed_levels"] = levels
+    config["tile_cache_levels"] = levels
+    validate_user_config("levels.yaml", config)
+    assert parse_levels(levels) == expected
+
+
+def test_unparsable_levels_are_rejected():
+    config = baseline_config()
+    config["feature_seed_levels"] = "high"
+    with pytest.raises(ConfigError, match="'feature_seed_levels' must be a level"):
+        validate_user_config("levels.yaml", config)
+
+
+def seed_sessions() -> list[dict]:
+    return [
+        {
+            "db_url": f"postgresql://tiling_{i}@remote/giswater",
+            "materialized_views": [f"ws_{i}.v_edit_arc", f"ws_{i}.v_edit_node"],
+            "source": {"map": f"/projects/ws_{i}.qgs"},
+        }
+        for i in range(2)
+    ]
+
+
+def test_seed_sessions_with_their_own_views_and_sources_are_valid():
+    config = baseline_config()
+    config["seed_sessions"] = seed_sessions()
+    validate_user_config("sessions.yaml", config)
+
+
+@pytest.mark.parametrize("change, error", [
+    (lambda sessions: sessions[1].pop("materialized_views"), "own materialized_views"),
+    (lambda sessions: sessions[1].pop("source"), "source mapping"),
+    (lambda sessions: sessions[1].update(materialized_views=["ws_0.v_edit_arc"]), "must not share materialized_views"),
+    (lambda sessions: sessions[1].update(source=dict(sessions[0]["source"])), "different source overrides"),
+    (lambda sessions: sessions[1].update(db_url=sessions[0]["db_url"]), "different db_url"),
+])
+def test_seed_sessions_must_not_share_views_or_sources(change, error):
+    config = baseline_config()
+    config["seed_sessions"] = seed_sessions()
+    change(config["seed_sessions"])
+    with pytest.raises(ConfigError) as e:
+        validate_user_config("sessions.yaml", config)
+    assert len(e.value.errors) == 1 and error in e.value.errors[0]
@@ -0,0 +1,81 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import db
+
+
+class Info:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class Connection:
+    def __init__(self):
+        self.closed = 0
+        self.info = Info()
+
+    def close(self):
+        self.closed = 1
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def opened(monkeypatch) -> list[Connection]:
+    opened: list[Connection] = []
+    def connect(db_url, cursor_factory=None):
+        conn = Connection()
+        opened.append(conn)
+        return conn
+    monkeypatch.setattr(psycopg2, "connect", connect)
+    monkeypatch.setattr(db, "_pools", {})
+    return opened
+
+
+def test_returned_connections_are_handed_out_again(opened):
+    borrowed = []
+    for _ in range(5):
+        with db.connection("postgresql://test") as conn:
+            borrowed.append(conn)
+    assert len(opened) == 1
+    assert all(conn is opened[0] for conn in borrowed)
+    assert not opened[0].closed
+
+
+def test_pool_opens_at_most_size_connections(opened):
+    pool = db.get_pool("postgresql://test", 2)
+    first, second = pool.getconn(), pool.getconn()
+    third = []
+    waiting = threading.Thread(target=lambda: third.append(pool.getconn()))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive() and len(opened) == 2
+
+    pool.putconn(first)
+    waiting.join(1)
+    assert third == [first]
+    assert len(opened) == 2
+
+
+def test_broken_connections_are_replaced(opened):
+    with pytest.raises(psycopg2.OperationalError):
+        with db.connection("postgresql://test"):
+            raise psycopg2.OperationalError("server closed the connection")
+    assert opened[0].closed
+
+    with db.connection("postgresql://test") as conn:
+        assert conn is opened[1]
+
+
+def test_pools_are_kept_by_size(opened):
+    assert db.get_pool("postgresql://test", 2) is db.get_pool("postgresql://test", 2)
+    assert db.get_pool("postgresql://test", 8).size == 8
@@ -0,0 +1,52 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import pytest
+import shapely
+from mapproxy.config import local_base_config
+from mapproxy.config.config import load_default_config
+from mapproxy.grid.meta_grid import MetaGrid
+from mapproxy.grid.tile_grid import tile_grid
+from shapely.geometry import Polygon
+
+from estimate import META_SIZE, level_tile_counts
+
+# Not a multiple of the meta tile size, the meta tiles along the edges are smaller
+BBOX = [0, 0, 5000, 3000]
+RES = [8, 4, 2, 1]
+
+
+def mapproxy_tile_counts(geometry, origin: str) -> dict[int, int]:
+    """Tiles of every MapProxy meta tile of the grid whose extent intersects `geometry`"""
+    with local_base_config(load_default_config()):
+        grid = tile_grid(srs="EPSG:25831", bbox=BBOX, res=RES, origin=origin)
+    meta_grid = MetaGrid(grid, meta_size=META_SIZE, meta_buffer=0)
+    counts = {}
+    for level in range(len(RES)):
+        cols, rows = grid.grid_sizes[level]
+        counts[level] = sum(
+            sum(1 for tile in meta_tile.tiles if tile is not None)
+            for x in range(0, cols, META_SIZE[0])
+            for y in range(0, rows, META_SIZE[1])
+            if shapely.box(*(meta_tile := meta_grid.meta_tile((x, y, level))).bbox).intersects(geometry)
+        )
+    return counts
+
+
+@pytest.mark.parametrize("origin", ["nw", "sw"])
+@pytest.mark.parametrize("geometry", [
+    Polygon([(1200, 700), (3100, 900), (2500, 2600), (1300, 1900)]),
+    # Along the top right edge of the grid
+    shapely.box(4700, 2800, 5000, 3000),
+    shapely.MultiPolygon([shapely.box(100, 100, 300, 200), shapely.box(4000, 2000, 4100, 2100)]),
+])
+def test_level_tile_counts_match_the_meta_tiles_of_mapproxy(origin, geometry):
+    counts = level_tile_counts(geometry, {"bbox": BBOX, "origin": origin}, RES, list(range(len(RES))))
+    assert counts == mapproxy_tile_counts(geometry, origin)
+
+
+def test_geometry_outside_the_grid_has_no_tiles():
+    assert level_tile_counts(shapely.box(6000, 4000, 7000, 5000), {"bbox": BBOX, "origin": "nw"}, RES, [0, 3]) == {0: 0, 3: 0}
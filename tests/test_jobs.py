@@ -0,0 +1,91 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import DONE, JobQueue
+
+
+def finished_job(folder: str, job_id: str, finished: float) -> None:
+    with open(os.path.join(folder, f"{job_id}.json"), "w") as f:
+        json.dump({"id": job_id, "kind": "seed_all", "config": "ws", "pid": os.getpid(), "status": DONE,
+                   "created": finished - 10, "finished": finished}, f)
+
+
+def test_one_active_job_per_config(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    release = threading.Event()
+    job = queue.submit("seed_all", "ws", lambda job: release.wait(5) and "seeded")
+    try:
+        with pytest.raises(RuntimeError, match=job.id):
+            queue.submit("seed_update", "ws", lambda job: "seeded")
+        # Other configs are not held back
+        queue.submit("seed_all", "other", lambda job: "seeded")
+    finally:
+        release.set()
+        queue.executor.shutdown()
+    assert queue.get(job.id)["status"] == DONE
+
+
+def _submit_in_process(folder: str, barrier, submitted) -> None:
+    queue = JobQueue(folder)
+    barrier.wait()
+    try:
+        queue.submit("seed_all", "ws", lambda job: time.sleep(5))
+        with submitted.get_lock():
+            submitted.value += 1
+    except RuntimeError:
+        pass
+    # Alive until every process tried, the job of a dead process would not count as active
+    barrier.wait()
+    os._exit(0)
+
+
+def test_processes_submitting_at_once_start_one_job(tmp_path, monkeypatch):
+    active_job = JobQueue.active_job
+    def slow_active_job(self, config):
+        # Every process would find no active job without the lock
+        job = active_job(self, config)
+        time.sleep(0.2)
+        return job
+    monkeypatch.setattr(JobQueue, "active_job", slow_active_job)
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(6)
+    submitted = context.Value("i", 0)
+    processes = [context.Process(target=_submit_in_process, args=(str(tmp_path), barrier, submitted)) for _ in range(6)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+    assert submitted.value == 1
+    assert len([file for file in os.listdir(tmp_path) if file.endswith(".json")]) == 1
+
+
+def test_finished_jobs_are_pruned_by_age_and_count(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "FINISHED_JOBS_KEPT", 3)
+    folder = str(tmp_path)
+    now = time.time()
+    for i in range(5):
+        finished_job(folder, f"recent{i}", now - i)
+    finished_job(folder, "old", now - jobs.FINISHED_JOBS_MAX_AGE - 1)
+    (tmp_path / "recent4.cancel").touch()
+
+    queue = JobQueue(folder)
+    job = queue.submit("seed_all", "ws", lambda job: "seeded")
+    queue.executor.shutdown()
+
+    # The new job is active while pruning, the 3 most recent finished ones are kept
+    assert sorted(file for file in os.listdir(folder) if file != "submit.lock") == sorted(
+        [f"{job.id}.json", "recent0.json", "recent1.json", "recent2.json"]
+    )
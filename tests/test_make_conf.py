@@ -0,0 +1,70 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import make_conf
+import yaml_io
+from seeding import seed_config_file
+
+
+class Cursor:
+    def __init__(self, tilecluster_ids: list[str]):
+        self.tilecluster_ids = tilecluster_ids
+
+    def execute(self, query: str, vars=None) -> None:
+        assert query.startswith("SELECT tilecluster_id FROM")
+
+    def fetchall(self) -> list[tuple]:
+        return [(tilecluster_id,) for tilecluster_id in self.tilecluster_ids]
+
+
+class Connection:
+    def __init__(self, tilecluster_ids: list[str]):
+        self.tilecluster_ids = tilecluster_ids
+
+    def cursor(self) -> Cursor:
+        return Cursor(self.tilecluster_ids)
+
+
+def user_config() -> dict:
+    return {
+        "db_url_remote": "postgresql://tiling@remote/giswater",
+        "data_db_schema": "ws",
+        "tiling_db_schema": "tiling",
+        "tileclusters_table": "tiling.v_tileclusters",
+        "materialized_views": [],
+        "crs": "EPSG:25831",
+        "grid": {"srs": "EPSG:25831", "origin": "nw", "bbox": [0, 0, 131072, 131072]},
+        "res": [512, 256, 128],
+        # Shared by every source, dumped in every chunk
+        "sources": {"inventory_source": {"url": "http://qgis/ows", "layers": ["arc", "node"]}},
+    }
+
+
+def test_configs_with_several_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(make_conf, "DUMP_CHUNK_SIZE", 2)
+    tilecluster_ids = [f"N1-E{i}" for i in range(1, 6)]
+    geom_path = tmp_path / "geom"
+    geom_path.mkdir()
+    for tilecluster_id in tilecluster_ids:
+        (geom_path / f"{tilecluster_id}.wkt").write_text("POLYGON((0 0, 600 0, 600 600, 0 600, 0 0))")
+    out = tmp_path / "config-out"
+
+    make_conf.make_config(user_config(), Connection(tilecluster_ids), str(out), str(geom_path), "test")
+
+    with open(out / "test.yaml") as f:
+        config = yaml_io.load(f)
+    with open(seed_config_file(str(out), "test")) as f:
+        seed_config = yaml_io.load(f)
+
+    assert [layer["name"] for layer in config["layers"]] == tilecluster_ids
+    assert list(config["caches"]) == [f"{tilecluster_id}_cache" for tilecluster_id in tilecluster_ids]
+    assert list(config["sources"]) == [f"{tilecluster_id}_source" for tilecluster_id in tilecluster_ids]
+    for tilecluster_id in tilecluster_ids:
+        source = config["sources"][f"{tilecluster_id}_source"]
+        assert source["req"]["layers"] == ["arc", "node"]
+        assert source["coverage"]["datasource"] == str(geom_path / f"{tilecluster_id}.wkt")
+        seed_source = seed_config["sources"][f"{tilecluster_id}_source"]
+        assert seed_source["coverage"] == {"bbox": [0, 0, 131072, 131072], "srs": "EPSG:25831"}
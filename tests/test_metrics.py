@@ -0,0 +1,57 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_gauges", {})
+    monkeypatch.setattr(metrics, "_last_flush", 0.0)
+    metrics.configure(str(tmp_path))
+    yield tmp_path
+    monkeypatch.setattr(metrics, "_folder", None)
+
+
+def _worker(folder: str) -> None:
+    # A uWSGI worker that exited: its metrics file stays behind
+    metrics._started = time.time()
+    metrics.configure(folder)
+    metrics.inc("seeding_tiles_total", {"config": "c"}, 5)
+    metrics.flush(force=True)
+
+
+def test_flushes_are_throttled(folder):
+    metrics.inc("seeding_tiles_total", {"config": "c"}, 1)
+    metrics.flush()
+    metrics.inc("seeding_tiles_total", {"config": "c"}, 1)
+    metrics.flush()
+
+    path = folder / metrics._file_name()
+    assert json.loads(path.read_text())["counters"] == [["seeding_tiles_total", {"config": "c"}, 1]]
+    # The skipped write happens at the end of the interval
+    time.sleep(metrics.FLUSH_INTERVAL + 0.5)
+    assert json.loads(path.read_text())["counters"] == [["seeding_tiles_total", {"config": "c"}, 2]]
+
+
+def test_files_of_exited_processes_are_merged(folder):
+    for _ in range(2):
+        process = multiprocessing.get_context("fork").Process(target=_worker, args=(str(folder),))
+        process.start()
+        process.join()
+    metrics.inc("seeding_tiles_total", {"config": "c"}, 1)
+
+    for _ in range(2):
+        assert 'seeding_tiles_total{config="c"} 11' in metrics.render()
+    assert sorted(os.listdir(folder)) == ["retire.lock", metrics.RETIRED_FILE]
@@ -0,0 +1,58 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import pytest
+from mapproxy.cache.file import FileCache
+from mapproxy.cache.tile import Tile
+from mapproxy.config import local_base_config
+from mapproxy.config.config import load_default_config
+from mapproxy.image import ImageResult
+from mapproxy.image.opts import ImageOptions
+from PIL import Image
+
+import migrate_cache
+from migrate_cache import file_cache_tiles, migrate_cache as migrate
+
+COORDS = [(x, y, 3) for x in range(4) for y in range(3)]
+
+
+class LevelCache:
+    """Like the sqlite level caches of MapProxy, reports every store as failed"""
+    def __init__(self, dropped: set[tuple] = frozenset()):
+        self.dropped = dropped
+        self.coords: set[tuple] = set()
+
+    def store_tiles(self, tiles):
+        self.coords.update(tile.coord for tile in tiles if tile.coord not in self.dropped)
+        return False
+
+    def is_cached(self, tile):
+        return tile.coord in self.coords
+
+
+@pytest.fixture
+def source_dir(tmp_path, monkeypatch):
+    # Several batches, the last one smaller
+    monkeypatch.setattr(migrate_cache, "BATCH_SIZE", 5)
+    cache = FileCache(str(tmp_path), "png")
+    image = Image.new("RGBA", (256, 256), (255, 0, 0, 255))
+    with local_base_config(load_default_config()):
+        for coord in COORDS:
+            cache.store_tile(Tile(coord, ImageResult(image, image_opts=ImageOptions(format="image/png"))))
+    return str(tmp_path)
+
+
+def test_tiles_are_copied_when_the_cache_reports_failure(source_dir):
+    dest = LevelCache()
+    assert migrate(source_dir, dest) == len(COORDS)
+    assert dest.coords == set(COORDS)
+
+
+def test_any_tile_not_stored_fails_the_migration(source_dir):
+    # Neither the first nor the last tile of its batch
+    dropped = [coord for coord, _ in file_cache_tiles(source_dir)][6]
+    with pytest.raises(RuntimeError, match=r"Could not store 1 tiles"):
+        migrate(source_dir, LevelCache({dropped}))
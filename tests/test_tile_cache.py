@@ -0,0 +1,111 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import pytest
+
+from tile_cache import ENTRY_OVERHEAD, TileCache, TileConfigs, TileSettings, invalidate_tiles
+
+TILE_BYTES = 1000
+
+
+class TileApp:
+    """MapProxy stand-in rendering every tile with a body of `TILE_BYTES`"""
+    def __init__(self):
+        self.requests: list[str] = []
+
+    def __call__(self, environ, start_response):
+        self.requests.append(environ["PATH_INFO"])
+        start_response("200 OK", [("Content-Type", "image/png")])
+        return [b"x" * TILE_BYTES]
+
+
+def get(cache: TileCache, path: str) -> bytes:
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": ""}
+    return b"".join(cache(environ, lambda status, headers, exc_info=None: None))
+
+def tile(x: int, layer: str = "c1", z: int = 5) -> str:
+    return f"/ws/wmts/tiles/{layer}/main_grid/{z}/{x}/0.png"
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path / "tile_cache")
+
+@pytest.fixture
+def app():
+    return TileApp()
+
+def make_cache(app: TileApp, folder: str, tiles: int, levels: list[int] | None = None) -> TileCache:
+    configs = TileConfigs(folder, lambda config_name: TileSettings(levels), check_interval=0)
+    return TileCache(lambda: app, configs, tiles * (TILE_BYTES + ENTRY_OVERHEAD), 10 * TILE_BYTES)
+
+
+def test_served_tiles_are_answered_from_memory(app, folder):
+    cache = make_cache(app, folder, tiles=3)
+    assert get(cache, tile(1)) == get(cache, tile(1))
+    assert app.requests == [tile(1)]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_tiles_are_evicted_past_the_byte_budget(app, folder):
+    cache = make_cache(app, folder, tiles=3)
+    for x in (1, 2, 3):
+        get(cache, tile(x))
+    # Tile 1 is used again, tile 2 becomes the least recently used one
+    get(cache, tile(1))
+    get(cache, tile(4))
+
+    assert len(cache.tiles) == 3
+    assert cache.size == 3 * (TILE_BYTES + ENTRY_OVERHEAD)
+    app.requests.clear()
+    for x in (1, 3, 4, 2):
+        get(cache, tile(x))
+    assert app.requests == [tile(2)]
+
+
+def test_tiles_larger_than_the_limit_are_not_kept(app, folder):
+    configs = TileConfigs(folder, lambda config_name: TileSettings(), check_interval=0)
+    cache = TileCache(lambda: app, configs, 100 * TILE_BYTES, TILE_BYTES // 2)
+    get(cache, tile(1))
+    get(cache, tile(1))
+    assert len(app.requests) == 2 and cache.size == 0
+
+
+def test_only_the_admitted_levels_are_kept(app, folder):
+    cache = make_cache(app, folder, tiles=3, levels=[5])
+    get(cache, tile(1, z=6))
+    get(cache, tile(1, z=6))
+    get(cache, tile(1, z=5))
+    get(cache, tile(1, z=5))
+    assert app.requests == [tile(1, z=6), tile(1, z=6), tile(1, z=5)]
+
+
+def test_reseeding_a_layer_invalidates_its_tiles(app, folder):
+    cache = make_cache(app, folder, tiles=3)
+    get(cache, tile(1, layer="c1"))
+    get(cache, tile(1, layer="c2"))
+
+    # A seed of tilecluster c1 finished
+    invalidate_tiles(folder, "ws", ["c1"])
+    app.requests.clear()
+    get(cache, tile(1, layer="c1"))
+    get(cache, tile(1, layer="c2"))
+    assert app.requests == [tile(1, layer="c1")]
+
+
+def test_a_generation_bump_of_the_config_invalidates_every_layer(app, folder):
+    cache = make_cache(app, folder, tiles=3)
+    get(cache, tile(1, layer="c1"))
+    get(cache, tile(1, layer="c2"))
+
+    invalidate_tiles(folder, "ws")
+    assert cache.size == 2 * (TILE_BYTES + ENTRY_OVERHEAD)
+    app.requests.clear()
+    get(cache, tile(1, layer="c1"))
+    get(cache, tile(1, layer="c2"))
+    assert app.requests == [tile(1, layer="c1"), tile(1, layer="c2")]
+    # The stale tiles were replaced, not kept next to the new ones
+    assert cache.size == 2 * (TILE_BYTES + ENTRY_OVERHEAD)
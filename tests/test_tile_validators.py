@@ -0,0 +1,129 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import os
+from email.utils import formatdate
+
+import pytest
+
+from tile_cache import TileConfigs, TileSettings, invalidate_tiles
+from tile_validators import TileValidators
+
+TILE = "/ws/wmts/tiles/c1/main_grid/5/1/0.png"
+
+
+class TileApp:
+    """MapProxy stand-in, with headers of its own the validators replace"""
+    def __init__(self):
+        self.environs: list[dict] = []
+
+    def __call__(self, environ, start_response):
+        self.environs.append(environ)
+        start_response("200 OK", [("Content-Type", "image/png"), ("ETag", '"mapproxy"')])
+        return [b"tile"]
+
+
+class Response:
+    def __init__(self, validators: TileValidators, **headers: str):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": TILE, "QUERY_STRING": ""}
+        environ.update({f"HTTP_{name.upper()}": value for name, value in headers.items()})
+        self.body = b"".join(validators(environ, self.start_response))
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = dict(headers)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path / "tile_cache")
+
+@pytest.fixture
+def tile_file(tmp_path):
+    path = tmp_path / "tiles" / "05" / "000" / "000" / "001.png"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"tile")
+    return str(path)
+
+@pytest.fixture
+def app():
+    return TileApp()
+
+@pytest.fixture
+def validators(app, folder, tile_file):
+    configs = TileConfigs(folder, lambda config_name: TileSettings(max_age=3600), check_interval=0)
+    validators = TileValidators(lambda: app, lambda: None, configs)
+    validators.tile_location = lambda *args: tile_file
+    return validators
+
+
+def test_etag_combines_mtime_size_and_generation(validators, folder, tile_file):
+    invalidate_tiles(folder, "ws", ["c1"])
+    generation = validators.configs.get("ws").generation("c1")
+    stat = os.stat(tile_file)
+
+    response = Response(validators)
+    assert response.status == "200 OK"
+    assert response.headers["ETag"] == f'"{stat.st_mtime_ns:x}-{stat.st_size:x}-{int(generation * 1000):x}"'
+    assert response.headers["Last-Modified"] == formatdate(int(max(stat.st_mtime, generation)), usegmt=True)
+    assert response.headers["Cache-Control"] == "public, max-age=3600"
+
+
+def test_matching_etag_is_answered_with_304(validators, app):
+    etag = Response(validators).headers["ETag"]
+    app.environs.clear()
+
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        response = Response(validators, if_none_match=if_none_match)
+        assert response.status == "304 Not Modified"
+        assert response.body == b""
+        assert response.headers["ETag"] == etag
+    assert app.environs == []
+
+
+def test_other_etag_is_served_without_the_conditional_headers(validators, app):
+    response = Response(validators, if_none_match='"other"', if_modified_since=formatdate(usegmt=True))
+    # If-None-Match takes precedence over If-Modified-Since
+    assert response.status == "200 OK"
+    assert response.body == b"tile"
+    assert "HTTP_IF_NONE_MATCH" not in app.environs[0] and "HTTP_IF_MODIFIED_SINCE" not in app.environs[0]
+
+
+def test_if_modified_since_is_answered_with_304(validators, tile_file):
+    mtime = int(os.stat(tile_file).st_mtime)
+    assert Response(validators, if_modified_since=formatdate(mtime, usegmt=True)).status == "304 Not Modified"
+    assert Response(validators, if_modified_since=formatdate(mtime - 60, usegmt=True)).status == "200 OK"
+    assert Response(validators, if_modified_since="not a date").status == "200 OK"
+
+
+def test_changed_file_changes_the_etag(validators, tile_file):
+    etag = Response(validators).headers["ETag"]
+    with open(tile_file, "ab") as f:
+        f.write(b"more")
+    response = Response(validators, if_none_match=etag)
+    assert response.status == "200 OK"
+    assert response.headers["ETag"] != etag
+
+
+def test_reseed_changes_the_etag(validators, folder, tile_file):
+    # Seeded an hour ago, the next seed leaves the file as it was
+    hour_ago = os.stat(tile_file).st_mtime - 3600
+    os.utime(tile_file, (hour_ago, hour_ago))
+    response = Response(validators)
+    etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+
+    invalidate_tiles(folder, "ws", ["c1"])
+    assert Response(validators, if_none_match=etag).status == "200 OK"
+    response = Response(validators, if_modified_since=last_modified)
+    assert response.status == "200 OK"
+    assert response.headers["Last-Modified"] != last_modified
+
+
+def test_uncached_tiles_are_left_to_mapproxy(validators, app, tile_file):
+    os.remove(tile_file)
+    response = Response(validators, if_none_match="*")
+    assert response.status == "200 OK"
+    assert response.headers["ETag"] == '"mapproxy"'
@@ -0,0 +1,46 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import hashlib
+
+from tileclusters import fetch_geometry_digests, sync_geometries
+
+CONFIG = {"tileclusters_table": "tiling.v_tileclusters"}
+
+
+class Cursor:
+    """Answers the tilecluster queries of `sync_geometries` from `geometries`"""
+    def __init__(self, geometries: dict[str, str]):
+        self.geometries = geometries
+        self.rows: list[tuple] = []
+
+    def execute(self, query: str, vars=None) -> None:
+        if "md5(ST_AsBinary(geom))" in query:
+            self.rows = [(tilecluster_id, hashlib.md5(geometry.encode()).hexdigest()) for tilecluster_id, geometry in sorted(self.geometries.items())]
+        else:
+            self.rows = [(tilecluster_id, self.geometries[tilecluster_id]) for tilecluster_id in vars[0]]
+
+    def fetchall(self) -> list[tuple]:
+        return self.rows
+
+
+def sync(geometries: dict[str, str], geom_folder: str) -> tuple[list[str], list[str]]:
+    cursor = Cursor(geometries)
+    return sync_geometries(CONFIG, geom_folder, cursor, fetch_geometry_digests(CONFIG, cursor))
+
+
+def test_sync_reports_changed_and_removed_tileclusters(tmp_path):
+    geometries = {
+        "N1-E1": "POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))",
+        "N1-E2": "POLYGON((2 0, 3 0, 3 1, 2 1, 2 0))",
+    }
+    assert sync(geometries, str(tmp_path)) == (["N1-E1", "N1-E2"], [])
+    assert sync(geometries, str(tmp_path)) == ([], [])
+
+    del geometries["N1-E2"]
+    geometries["N1-E1"] = "POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))"
+    assert sync(geometries, str(tmp_path)) == (["N1-E1"], ["N1-E2"])
+    assert not (tmp_path / "N1-E2.wkt").exists()
@@ -0,0 +1,254 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable
+
+# Folder (under the temp folder) with the invalidation times of the cached tiles of each config
+TILE_CACHE_FOLDER = "tile_cache"
+# Invalidation key standing for every layer of a config
+ALL_LAYERS = "*"
+
+# WMTS RESTful tiles of the MapProxy multiapp, see the `restful_template` written by make_config
+TILE_PATH = re.compile(
+    r"^/(?P<config>[^/]+)/wmts/tiles/(?P<layer>[^/]+)/(?P<matrix_set>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<format>\w+)$"
+)
+# Environ key of the dict the tile middlewares fill in for `TileMetrics` (`cache`, `empty`)
+TILE_INFO = "mapproxy_service.tile_info"
+# Where a tile came from
+CACHE_MEMORY = "memory"
+CACHE_FILE = "file"
+CACHE_RENDER = "render"
+CACHE_UNKNOWN = "unknown"
+
+# Entries are counted with this overhead on top of their body
+ENTRY_OVERHEAD = 512
+
+
+def _read_invalidations(path: str) -> dict[str, float]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def invalidate_tiles(folder: str, config_name: str, layers: list[str] | None = None) -> None:
+    """
+    Mark the tiles of `layers` of a config (all of them if None) cached before now as stale,
+    in the tile caches of every server process.
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(folder, f"{config_name}.json")
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        invalidated = _read_invalidations(path)
+        now = time.time()
+        for layer in layers if layers is not None else [ALL_LAYERS]:
+            invalidated[layer] = now
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(invalidated, f)
+        os.replace(tmp_path, path)
+
+
+def tile_info(environ: dict) -> dict | None:
+    """Metrics of a tile request, None when they are not recorded"""
+    return environ.get(TILE_INFO)
+
+
+@dataclass
+class CachedTile:
+    status: str
+    headers: list[tuple[str, str]]
+    body: bytes
+    created: float
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + ENTRY_OVERHEAD
+
+
+@dataclass
+class TileSettings:
+    """Tile serving options of a user config"""
+    # Zoom levels kept in memory, None for all of them
+    levels: list[int] | None = None
+    # Cache-Control max-age of the tiles, in seconds
+    max_age: int | None = None
+
+
+@dataclass
+class ConfigState:
+    checked: float = 0.0
+    mtime: float | None = None
+    invalidated: dict[str, float] = field(default_factory=dict)
+    settings: TileSettings | None = None
+
+    def admits(self, z: int) -> bool:
+        if self.settings is None:
+            return False
+        return self.settings.levels is None or z in self.settings.levels
+
+    def generation(self, layer: str) -> float:
+        """Time the tiles of `layer` were last seeded (or invalidated), 0 if never"""
+        return max(self.invalidated.get(layer, 0.0), self.invalidated.get(ALL_LAYERS, 0.0))
+
+    def stale(self, layer: str, created: float) -> bool:
+        return created < self.generation(layer)
+
+
+class TileConfigs:
+    """
+    Invalidations and settings of each config, shared by the tile middlewares and
+    reloaded at most every `check_interval` seconds.
+    """
+    def __init__(self, folder: str, get_settings: Callable[[str], TileSettings], check_interval: float = 1.0):
+        self.folder = folder
+        self.get_settings = get_settings
+        self.check_interval = check_interval
+        self.states: dict[str, ConfigState] = {}
+
+    def get(self, config_name: str) -> ConfigState:
+        now = time.monotonic()
+        state = self.states.get(config_name)
+        if state is not None and now - state.checked < self.check_interval:
+            return state
+
+        new_state = ConfigState(checked=now)
+        path = os.path.join(self.folder, f"{config_name}.json")
+        try:
+            new_state.mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            pass
+        if state is not None and state.mtime == new_state.mtime:
+            new_state.invalidated = state.invalidated
+        else:
+            new_state.invalidated = _read_invalidations(path)
+
+        try:
+            new_state.settings = self.get_settings(config_name)
+        except Exception as e:
+            # Not a config (or a broken one), no tile handling for it
+            if state is None or state.settings is not None:
+                print(f"Tile settings unavailable for {config_name}: {e}")
+
+        self.states[config_name] = new_state
+        return new_state
+
+
+class TileCache:
+    """
+    WSGI middleware keeping the most recently served tiles in memory, up to `max_bytes`.
+
+    Only WMTS RESTful GET requests answered with a 200 are cached, for the zoom levels
+    the settings of their config admit. Tiles larger than `max_tile_bytes` are never
+    cached. Invalidations written by `invalidate_tiles` are picked up as `configs` reloads.
+    """
+    def __init__(self, get_app: Callable[[], Callable], configs: TileConfigs, max_bytes: int, max_tile_bytes: int):
+        self.get_app = get_app
+        self.configs = configs
+        self.max_bytes = max_bytes
+        self.max_tile_bytes = max_tile_bytes
+
+        self.tiles: OrderedDict[tuple, CachedTile] = OrderedDict()
+        self.size = 0
+        # Config state the entries of each config were last checked against
+        self.states: dict[str, ConfigState] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _config_state(self, config_name: str) -> ConfigState:
+        state = self.configs.get(config_name)
+        previous = self.states.get(config_name)
+        if previous is not state:
+            with self.lock:
+                self.states[config_name] = state
+                if previous is None or previous.invalidated is not state.invalidated or previous.settings != state.settings:
+                    self._purge(config_name, state)
+        return state
+
+    def _purge(self, config_name: str, state: ConfigState) -> None:
+        for key in [key for key, tile in self.tiles.items() if key[0] == config_name and (
+            state.stale(key[1], tile.created) or not state.admits(key[3])
+        )]:
+            self.size -= self.tiles.pop(key).size
+
+    def get(self, key: tuple, state: ConfigState) -> CachedTile | None:
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None and state.stale(key[1], tile.created):
+                self.size -= self.tiles.pop(key).size
+                tile = None
+            if tile is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: tuple, tile: CachedTile) -> None:
+        if tile.size > self.max_tile_bytes:
+            return
+        with self.lock:
+            previous = self.tiles.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.tiles[key] = tile
+            self.size += tile.size
+            while self.size > self.max_bytes:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= evicted.size
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        app = self.get_app()
+        match = TILE_PATH.match(environ.get("PATH_INFO", ""))
+        if match is None or environ.get("REQUEST_METHOD") != "GET" or environ.get("QUERY_STRING"):
+            return app(environ, start_response)
+
+        z = int(match["z"])
+        key = (match["config"], match["layer"], match["matrix_set"], z, int(match["x"]), int(match["y"]), match["format"])
+        state = self._config_state(match["config"])
+        if not state.admits(z):
+            return app(environ, start_response)
+
+        tile = self.get(key, state)
+        if tile is not None:
+            info = tile_info(environ)
+            if info is not None:
+                info["cache"] = CACHE_MEMORY
+            start_response(tile.status, list(tile.headers))
+            return [tile.body]
+
+        # Taken before reading the tile, so a seed finishing meanwhile invalidates it
+        created = time.time()
+        response = {}
+        def capture_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return start_response(status, headers, exc_info)
+
+        result = app(environ, capture_response)
+        if not response.get("status", "").startswith("200"):
+            return result
+
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        self.put(key, CachedTile(response["status"], list(response["headers"]), body, created))
+        return [body]
@@ -0,0 +1,136 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Iterator
+
+import metrics
+from tile_cache import CACHE_UNKNOWN, TILE_INFO, TILE_PATH
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Series:
+    __slots__ = ("buckets", "seconds", "bytes", "statuses", "caches", "empty")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.seconds = 0.0
+        self.bytes = 0
+        self.statuses: dict[str, int] = {}
+        self.caches: dict[str, int] = {}
+        self.empty = 0
+
+
+class TileMetrics:
+    """
+    WSGI middleware recording the latency, size, status and origin (memory, tile file,
+    rendered) of the WMTS RESTful tiles, by config, layer and zoom level.
+
+    A request only costs a few dict updates, the metrics are handed to `metrics` by a
+    background thread every `flush_interval` seconds.
+    """
+    def __init__(self, get_app: Callable[[], Callable], flush_interval: float = 5.0):
+        self.get_app = get_app
+        self.flush_interval = flush_interval
+        self.series: dict[tuple[str, str, str], _Series] = {}
+        self.lock = threading.Lock()
+        self.flusher_pid: int | None = None
+        metrics.register_collector(self.samples)
+
+    def _start_flusher(self) -> None:
+        # Started in each worker process, threads do not survive the uWSGI fork
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                metrics.flush()
+        threading.Thread(target=run, name="tile-metrics", daemon=True).start()
+
+    def record(self, key: tuple[str, str, str], seconds: float, status: str, size: int, info: dict) -> None:
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = _Series()
+            series.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            series.seconds += seconds
+            series.bytes += size
+            series.statuses[status] = series.statuses.get(status, 0) + 1
+            cache = info.get("cache", CACHE_UNKNOWN)
+            series.caches[cache] = series.caches.get(cache, 0) + 1
+            if info.get("empty") or (size == 0 and status == "200"):
+                series.empty += 1
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        with self.lock:
+            series = [(key, _copy(value)) for key, value in self.series.items()]
+
+        for (config, layer, zoom), value in series:
+            labels = {"config": config, "layer": layer, "zoom": zoom}
+            count = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + (float("inf"),), value.buckets):
+                count += bucket
+                yield "tile_request_seconds_bucket", {**labels, "le": "+Inf" if bound == float("inf") else f"{bound:g}"}, count
+            yield "tile_request_seconds_sum", labels, value.seconds
+            yield "tile_request_seconds_count", labels, count
+            yield "tile_response_bytes_sum", labels, value.bytes
+            yield "tile_response_bytes_count", labels, count
+            for status, status_count in value.statuses.items():
+                yield "tile_responses_total", {**labels, "status": status}, status_count
+            for cache, cache_count in value.caches.items():
+                yield "tile_cache_total", {**labels, "cache": cache}, cache_count
+            yield "tile_empty_total", labels, value.empty
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        app = self.get_app()
+        match = TILE_PATH.match(environ.get("PATH_INFO", ""))
+        if match is None:
+            return app(environ, start_response)
+        if self.flusher_pid != os.getpid():
+            self._start_flusher()
+
+        info = environ[TILE_INFO] = {}
+        response = {}
+        def capture_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return start_response(status, headers, exc_info)
+
+        start_time = time.perf_counter()
+        result = app(environ, capture_response)
+        seconds = time.perf_counter() - start_time
+
+        size = None
+        for name, value in response.get("headers", ()):
+            if name.lower() == "content-length":
+                size = int(value)
+                break
+        if size is None and isinstance(result, list):
+            size = sum(len(chunk) for chunk in result)
+
+        self.record(
+            (match["config"], match["layer"], match["z"]),
+            seconds, response.get("status", "500")[:3], size or 0, info,
+        )
+        return result
+
+
+def _copy(series: _Series) -> _Series:
+    copy = _Series()
+    copy.buckets = list(series.buckets)
+    copy.seconds = series.seconds
+    copy.bytes = series.bytes
+    copy.statuses = dict(series.statuses)
+    copy.caches = dict(series.caches)
+    copy.empty = series.empty
+    return copy
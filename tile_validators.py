@@ -0,0 +1,143 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Iterable
+
+from mapproxy.cache.tile import Tile
+
+from tile_cache import CACHE_FILE, CACHE_RENDER, TILE_PATH, ConfigState, TileConfigs, tile_info
+
+# Headers set by MapProxy that are replaced by the ones derived here
+REPLACED_HEADERS = {"etag", "last-modified", "cache-control", "expires"}
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def _transparent_link(location: str) -> bool:
+    """Whether the tile file links to the single colour tile of a fully transparent colour"""
+    try:
+        target = os.readlink(location)
+    except OSError:
+        # Not a symbolic link, hard links can not be told apart cheaply
+        return False
+    color = os.path.basename(target).split(".")[0]
+    return os.path.basename(os.path.dirname(target)) == "single_color_tiles" and len(color) == 8 and color.endswith("00")
+
+def _not_modified_since(if_modified_since: str, last_modified: int) -> bool:
+    try:
+        return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class TileValidators:
+    """
+    WSGI middleware answering conditional requests for cached WMTS RESTful tiles from the
+    tile file alone, without reading it.
+
+    The ETag of a tile combines the modification time and size of its file with the time its
+    layer was last seeded (see `invalidate_tiles`), so every seed changes it. Responses get a
+    `Cache-Control` max-age when the config sets `tile_max_age`. Tiles of caches that are not
+    plain files, or not cached yet, are served by MapProxy with its own headers.
+    """
+    def __init__(self, get_app: Callable[[], Callable], get_mapproxy_app: Callable[[], Callable], configs: TileConfigs):
+        self.get_app = get_app
+        self.get_mapproxy_app = get_mapproxy_app
+        self.configs = configs
+
+    def tile_location(self, config_name: str, layer: str, matrix_set: str, x: int, y: int, z: int) -> str | None:
+        mapproxy_app = self.get_mapproxy_app()
+        if not mapproxy_app.loader.app_available(config_name):
+            return None
+        wmts = mapproxy_app.proj_app(config_name).handlers.get("wmts")
+        if wmts is None or layer not in wmts.layers or matrix_set not in wmts.layers[layer]:
+            return None
+
+        tile_layer = wmts.layers[layer][matrix_set]
+        tile_coord = tile_layer.grid.internal_tile_coord((x, y, z), False)
+        if tile_coord is None:
+            return None
+        # WMTS rows count from the top, like MapProxy does for the request
+        if tile_layer.grid.origin not in ("ul", "nw"):
+            tile_coord = tile_layer.grid.flip_tile_coord(tile_coord)
+
+        cache = tile_layer.tile_manager.cache
+        if not hasattr(cache, "tile_location"):
+            return None
+        return cache.tile_location(Tile(tile_coord), create_dir=False)
+
+    def validators(self, state: ConfigState, layer: str, location: str | None) -> tuple[str, int] | None:
+        if location is None:
+            return None
+        try:
+            stat = os.stat(location)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        generation = state.generation(layer)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}-{int(generation * 1000):x}"'
+        return etag, int(max(stat.st_mtime, generation))
+
+    def headers(self, state: ConfigState, etag: str, last_modified: int) -> list[tuple[str, str]]:
+        headers = [("ETag", etag), ("Last-Modified", formatdate(last_modified, usegmt=True))]
+        if state.settings is not None and state.settings.max_age is not None:
+            headers.append(("Cache-Control", f"public, max-age={state.settings.max_age}"))
+        return headers
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        app = self.get_app()
+        match = TILE_PATH.match(environ.get("PATH_INFO", ""))
+        if match is None or environ.get("REQUEST_METHOD") not in ("GET", "HEAD"):
+            return app(environ, start_response)
+
+        state = self.configs.get(match["config"])
+        if state.settings is None:
+            return app(environ, start_response)
+
+        layer = match["layer"]
+        try:
+            location = self.tile_location(match["config"], layer, match["matrix_set"], int(match["x"]), int(match["y"]), int(match["z"]))
+        except Exception as e:
+            print(f"Could not locate tile {environ['PATH_INFO']}: {e}")
+            location = None
+
+        validators = self.validators(state, layer, location)
+        info = tile_info(environ)
+        if info is not None and location is not None:
+            info["cache"] = CACHE_FILE if validators is not None else CACHE_RENDER
+            info["empty"] = validators is not None and _transparent_link(location)
+        if validators is not None:
+            etag, last_modified = validators
+            if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+            if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+            if (if_none_match is not None and _etag_matches(if_none_match, etag)) or (
+                if_none_match is None and if_modified_since is not None and _not_modified_since(if_modified_since, last_modified)
+            ):
+                start_response("304 Not Modified", self.headers(state, etag, last_modified))
+                return []
+
+        # MapProxy would compare the request against its own validators
+        environ = {key: value for key, value in environ.items() if key not in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE")}
+
+        def add_validators(status, headers, exc_info=None):
+            nonlocal validators
+            if status.startswith("200"):
+                if validators is None:
+                    # Rendered on demand, the tile file exists now
+                    validators = self.validators(state, layer, location)
+                if validators is not None:
+                    headers = [(name, value) for name, value in headers if name.lower() not in REPLACED_HEADERS]
+                    headers.extend(self.headers(state, *validators))
+            return start_response(status, headers, exc_info)
+
+        return app(environ, add_validators)
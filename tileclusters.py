@@ -0,0 +1,178 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+from shapely import STRtree, box, unary_union, wkt
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
+
+# Digest of the geometry of each tilecluster written to the geometry folder
+MANIFEST_FILE = "manifest.json"
+
+def _write_atomic(file_path: str, content: str) -> None:
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+
+def read_manifest(geom_folder: str) -> dict[str, str]:
+    try:
+        with open(os.path.join(geom_folder, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def fetch_geometry_digests(config: dict, remote_cursor) -> dict[str, str]:
+    remote_cursor.execute(
+        f"SELECT tilecluster_id, md5(ST_AsBinary(geom)) FROM {config['tileclusters_table']} ORDER BY tilecluster_id"
+    )
+    return dict(remote_cursor.fetchall())
+
+def sync_geometries(config: dict, geom_folder: str, remote_cursor, digests: dict[str, str]) -> tuple[list[str], list[str]]:
+    """
+    Write the WKT file of every tilecluster whose geometry changed since the last sync.
+
+    `digests` are the current geometry digests (see `fetch_geometry_digests`), only the
+    geometries of changed tileclusters are fetched. Files are replaced atomically so
+    MapProxy never reads a half written coverage. Returns the changed tilecluster ids and
+    the removed ones, whose files are deleted.
+    """
+    Path(geom_folder).mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(geom_folder)
+
+    changed = [
+        tilecluster_id for tilecluster_id, digest in digests.items()
+        if manifest.get(tilecluster_id) != digest
+        or not os.path.exists(os.path.join(geom_folder, f"{tilecluster_id}.wkt"))
+    ]
+
+    if changed:
+        remote_cursor.execute(
+            f"SELECT tilecluster_id, ST_ASTEXT(geom) FROM {config['tileclusters_table']} WHERE tilecluster_id = ANY(%s)",
+            (changed,)
+        )
+        for tilecluster_id, geom in remote_cursor.fetchall():
+            _write_atomic(os.path.join(geom_folder, f"{tilecluster_id}.wkt"), geom)
+
+    removed = sorted(manifest.keys() - digests.keys())
+    for tilecluster_id in removed:
+        Path(os.path.join(geom_folder, f"{tilecluster_id}.wkt")).unlink(missing_ok=True)
+
+    _write_atomic(os.path.join(geom_folder, MANIFEST_FILE), json.dumps(digests))
+    refresh_index(geom_folder)
+
+    print(f"Tilecluster geometries: {len(changed)} of {len(digests)} changed, {len(removed)} removed")
+    return changed, removed
+
+
+class TileclusterIndex:
+    """
+    STRtree over the tilecluster geometries of a geometry folder, to find the
+    tileclusters (and so the caches) touched by a geometry.
+    """
+    def __init__(self, geom_folder: str):
+        self.geom_folder = geom_folder
+        self.digests: dict[str, str] = {}
+        self.geometries: dict[str, BaseGeometry] = {}
+        self.mtime: float | None = None
+        self.lock = threading.Lock()
+        self._build()
+
+    def _build(self) -> None:
+        ids = list(self.geometries)
+        # Swapped as a whole so concurrent queries never mix an old tree with new ids
+        self.tree = (STRtree([self.geometries[tilecluster_id] for tilecluster_id in ids]), ids)
+
+    def _manifest_mtime(self) -> float | None:
+        try:
+            return os.path.getmtime(os.path.join(self.geom_folder, MANIFEST_FILE))
+        except FileNotFoundError:
+            return None
+
+    def refresh(self) -> None:
+        """Reload the geometries whose digest changed in the manifest since the last refresh"""
+        with self.lock:
+            self.mtime = self._manifest_mtime()
+            manifest = read_manifest(self.geom_folder)
+            changed = [tilecluster_id for tilecluster_id, digest in manifest.items() if self.digests.get(tilecluster_id) != digest]
+            removed = self.digests.keys() - manifest.keys()
+            if not changed and not removed:
+                return
+
+            geometries = dict(self.geometries)
+            for tilecluster_id in removed:
+                del geometries[tilecluster_id]
+            for tilecluster_id in changed:
+                with open(os.path.join(self.geom_folder, f"{tilecluster_id}.wkt"), "r") as f:
+                    geometries[tilecluster_id] = wkt.loads(f.read())
+            self.geometries = geometries
+            self.digests = manifest
+            self._build()
+
+    def _refresh_if_changed(self) -> None:
+        # Other workers may have synced the geometries since
+        if self._manifest_mtime() != self.mtime:
+            self.refresh()
+
+    def all(self) -> dict[str, BaseGeometry]:
+        """Geometry of every tilecluster"""
+        self._refresh_if_changed()
+        return self.geometries
+
+    def intersecting(self, geometry: BaseGeometry) -> dict[str, BaseGeometry]:
+        """Tileclusters intersecting `geometry`, with their geometry clipped to it"""
+        self._refresh_if_changed()
+
+        tree, ids = self.tree
+        result = {}
+        for i in tree.query(geometry, predicate="intersects"):
+            clipped = tree.geometries[i].intersection(geometry)
+            if not clipped.is_empty:
+                result[ids[i]] = clipped
+        return result
+
+
+_indexes: dict[str, TileclusterIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_index(geom_folder: str) -> TileclusterIndex:
+    """Process wide index of `geom_folder`, built on first use"""
+    with _indexes_lock:
+        index = _indexes.get(geom_folder)
+        if index is None:
+            index = _indexes[geom_folder] = TileclusterIndex(geom_folder)
+            index.refresh()
+        return index
+
+def refresh_index(geom_folder: str) -> None:
+    """Bring the index of `geom_folder` up to date if it has been built in this process"""
+    index = _indexes.get(geom_folder)
+    if index is not None:
+        index.refresh()
+
+def geojson_geometry(geojson: dict) -> BaseGeometry:
+    """Geometry of a GeoJSON geometry, Feature or FeatureCollection (merged)"""
+    if geojson.get("type") == "FeatureCollection":
+        return unary_union([shape(feature["geometry"]) for feature in geojson["features"] if feature.get("geometry")])
+    # Accept a Feature as well as a bare geometry
+    return shape(geojson.get("geometry", geojson))
+
+def parse_geometry(geometry: str | None = None, bbox: str | None = None) -> BaseGeometry:
+    """Geometry from a GeoJSON or WKT string, or a `minx,miny,maxx,maxy` bbox"""
+    if bbox is not None:
+        minx, miny, maxx, maxy = (float(value) for value in bbox.split(","))
+        return box(minx, miny, maxx, maxy)
+    if geometry is None:
+        raise ValueError("Either geometry or bbox must be provided")
+
+    geometry = geometry.strip()
+    if geometry.startswith("{"):
+        return geojson_geometry(json.loads(geometry))
+    return wkt.loads(geometry)
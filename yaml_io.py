@@ -0,0 +1,28 @@
+"""
+Copyright © 2025 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+from typing import Any, IO
+
+import yaml
+
+# libyaml's loader and dumper when PyYAML was built with it, about ten times faster than the pure Python ones
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class NoAliasDumper(SafeDumper):
+    """Writes values used several times in full, for documents dumped in separate parts"""
+    def ignore_aliases(self, data: Any) -> bool:
+        return True
+
+
+def load(stream: str | IO) -> Any:
+    """`yaml.safe_load` with libyaml"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+def dump(data: Any, stream: IO | None = None, aliases: bool = True, **kwargs) -> str | None:
+    """`yaml.safe_dump` with libyaml, without anchors and aliases if `aliases` is False"""
+    return yaml.dump(data, stream, Dumper=SafeDumper if aliases else NoAliasDumper, **kwargs)